@@ -8,31 +8,102 @@ It handles:
 3. Forwarding requests to Power Automate via webhook
 """
 
-import msal
-import requests
 from flask import Flask, request, jsonify
-from flask_socketio import SocketIO, join_room
 import uuid
-from datetime import datetime, timedelta
+import re
+import json
+import functools
+import hashlib
+import hmac
+import math
+import atexit
+import signal
+import sys
+import threading
+import asyncio
+from datetime import datetime
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import os
 from flask_cors import CORS
 from datetime import timezone
+from token_manager import TokenManager, DELEGATED
+from graph_client import GraphClient, GRAPH_BASE_URL, TOKEN_OPERATION
+from async_graph import AsyncGraphClient
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from graph_batch import GraphBatcher
+from worker_pool import PriorityWorkerPool, ShardedWorkerPool
+from conversation_store import create_conversation_store
+from conversation_archive import ConversationArchive, ArchivingConversationStore
+from support_directory import SupportDirectory
+from chat_pool import create_warm_chat_pool
+from outbound_queue import OutboundMessageQueue
+from idempotency import IdempotencyConflict, create_idempotency_cache
+from event_log import create_event_log
+from queue_view import create_queue_view
+from message_dedup import create_message_deduplicator, dedup_key
+from socketio_queue import create_client_manager
+from subscription_scheduler import SubscriptionScheduler, parse_graph_datetime
+from delta_poller import DeltaPoller, create_webhook_monitor
+from notification_crypto import (EncryptionKeyRing, NotificationDecryptionError, NotificationValidationError,
+                                 ValidationKeysUnavailable, ValidationTokenValidator, decrypt_notification_content)
+from structured_log import configure_logging, get_logger, logging_stats
+import metrics
+import profiler
+import tracing
 
-app = Flask(__name__)
-CORS(app)  # Add this line to enable CORS for all routes
-socketio = SocketIO(app, cors_allowed_origins="*")
-
-import os
 from dotenv import load_dotenv
 
 load_dotenv()  # Load environment variables from .env
 
+# Logs are written by a background thread; LOG_LEVEL, LOG_FORMAT=json|text
+configure_logging()
+log = get_logger("app")
+
+# Span trees per support request and notification, for /api/admin/traces;
+# TRACING=off, TRACE_BUFFER (request IDs kept), TRACE_FILE (JSON lines)
+tracing.configure_tracing()
+
+# Prometheus metrics, served on GET /metrics (Graph call metrics live in graph_client.py)
+WEBHOOK_SECONDS = metrics.histogram(
+    "webhook_request_duration_seconds", "Time to accept a Graph notification POST", ["endpoint"]
+)
+WEBHOOK_NOTIFICATIONS = metrics.counter(
+    "webhook_notifications_total", "Change notifications received, by what happened to them", ["result"]
+)
+REPLY_DELIVERY_SECONDS = metrics.histogram(
+    "reply_delivery_seconds", "From an agent's reply being posted in Teams to its socket emit",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+)
+SUPPORT_REQUESTS = metrics.counter(
+    "support_requests_total", "New support requests, by admission result", ["result"]
+)
+
+app = Flask(__name__)
+CORS(app)  # Add this line to enable CORS for all routes
+
+# With several workers (see scale_out.py) emits fan out through a shared message queue
+SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE")
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+# `python app.py` serves with debug=True, whose reloader runs this module twice: a watcher
+# process that only restarts the server, and the server itself (WERKZEUG_RUN_MAIN=true)
+RELOADER_PARENT = (__name__ == '__main__' and not os.environ.get('SCALE_OUT_FD')
+                   and os.environ.get('WERKZEUG_RUN_MAIN') != 'true')
+socketio_client_manager = create_client_manager(SOCKETIO_MESSAGE_QUEUE)
+if socketio_client_manager is not None:
+    socketio = SocketIO(app, cors_allowed_origins="*", client_manager=socketio_client_manager)
+elif SOCKETIO_MESSAGE_QUEUE:
+    socketio = SocketIO(app, cors_allowed_origins="*", message_queue=SOCKETIO_MESSAGE_QUEUE)
+else:
+    socketio = SocketIO(app, cors_allowed_origins="*")
+
 # Use your existing configuration
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 TENANT_ID = os.getenv("TENANT_ID")
-AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
+# AUTHORITY_HOST and GRAPH_URL point the app at another cloud or at fake_graph.py
+AUTHORITY_HOST = os.getenv("AUTHORITY_HOST", "https://login.microsoftonline.com")
+AUTHORITY = f"{AUTHORITY_HOST}/{TENANT_ID}"
+GRAPH_URL = os.getenv("GRAPH_URL", GRAPH_BASE_URL)
 SCOPE = ["https://graph.microsoft.com/.default"]
 
 # This will be the ID of your support team members
@@ -43,152 +114,366 @@ SCOPE = ["https://graph.microsoft.com/.default"]
 #     {"@odata.type": "microsoft.graph.aadUserConversationMember", "userId": "b376ef58-43a1-4b28-b3f2-968e8f8af8fc"}
 # ]
 
-# Store active support requests
-active_requests = {}
+# Store active support requests.
+# CONVERSATION_STORE=sqlite keeps them in CONVERSATION_DB so they survive restarts
+# and can be shared by several worker processes.
+CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", "memory")
+if SOCKETIO_MESSAGE_QUEUE and CONVERSATION_STORE == 'memory':
+    log.warning("Running with a message queue but an in-memory conversation store; "
+                "other workers won't see this worker's conversations")
+CONVERSATION_DB = os.getenv("CONVERSATION_DB", "conversations.db")
+active_requests = create_conversation_store(CONVERSATION_STORE, CONVERSATION_DB)
+
+# Finished conversations (after CONVERSATION_TERMINAL_GRACE) and idle ones (after
+# CONVERSATION_IDLE_TTL) move to a compressed on-disk archive and are paged back in
+# when the customer sends another message. CONVERSATION_ARCHIVE=off keeps everything live.
+if os.getenv("CONVERSATION_ARCHIVE", "on") != "off":
+    active_requests = ArchivingConversationStore(
+        active_requests,
+        ConversationArchive(
+            os.getenv("CONVERSATION_ARCHIVE_DIR", "conversation_archive"),
+            retention_days=int(os.getenv("CONVERSATION_ARCHIVE_RETENTION_DAYS", 30))
+        ),
+        terminal_grace=int(os.getenv("CONVERSATION_TERMINAL_GRACE", 300)),
+        idle_ttl=int(os.getenv("CONVERSATION_IDLE_TTL", 24 * 3600)),
+        on_evict=lambda request_id, record: retire_conversation(request_id),
+        on_page_in=lambda request_id, record: intake_pool.submit(resume_conversation, request_id)
+    )
+
+# Teams messages already forwarded (or being fetched), so duplicate notifications
+# cost one fetch and one emit. Shared between workers with the sqlite store.
+message_dedup = create_message_deduplicator(
+    CONVERSATION_STORE,
+    CONVERSATION_DB,
+    ttl=int(os.getenv("MESSAGE_DEDUP_TTL", 24 * 3600)),
+    max_entries=int(os.getenv("MESSAGE_DEDUP_MAX_ENTRIES", 100000))
+)
+
+# Repeated /api/support submissions with the same Idempotency-Key within
+# SUPPORT_IDEMPOTENCY_TTL seconds get the first response instead of a new chat
+support_idempotency = create_idempotency_cache(
+    CONVERSATION_STORE,
+    CONVERSATION_DB,
+    ttl=int(os.getenv("SUPPORT_IDEMPOTENCY_TTL", 600))
+)
+
+# The last EVENT_LOG_CAPACITY events of each conversation, numbered, so a client
+# that reconnects gets exactly what it missed (shared between workers with sqlite)
+event_log = create_event_log(
+    CONVERSATION_STORE,
+    CONVERSATION_DB,
+    capacity=int(os.getenv("EVENT_LOG_CAPACITY", 100)),
+    ttl=int(os.getenv("EVENT_LOG_TTL", 24 * 3600))
+)
+
+# Open conversations indexed by status and age for the supervisors' queue view
+# (/api/queue and the agent namespace); shared between workers with sqlite
+queue_view = create_queue_view(
+    CONVERSATION_STORE,
+    CONVERSATION_DB,
+    history=int(os.getenv("QUEUE_VIEW_HISTORY", 1000))
+)
+QUEUE_PAGE_SIZE = int(os.getenv("QUEUE_PAGE_SIZE", 50))
+QUEUE_PAGE_MAX = int(os.getenv("QUEUE_PAGE_MAX", 500))
+# Socket.IO namespace for agent dashboards, and the room that gets queue deltas
+AGENT_NAMESPACE = '/agents'
+QUEUE_ROOM = 'queue'
+
+# Bearer tokens: ADMIN_TOKEN for the admin, stats and metrics endpoints; the queue
+# view (it lists customers' names and emails) also takes AGENT_TOKEN.
+# Endpoints whose token isn't set refuse every request.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+AGENT_TOKEN = os.getenv("AGENT_TOKEN")
+# Lets a Prometheus scraper read /metrics without the admin token
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+def token_matches(supplied, *tokens):
+    """Whether supplied ('Bearer <token>' or the bare token) is one of the configured tokens"""
+    supplied = (supplied or '').removeprefix('Bearer ').encode()
+    return any(token and hmac.compare_digest(supplied, token.encode()) for token in tokens)
+
+def require_token(*tokens):
+    """Decorator rejecting requests without 'Authorization: Bearer <token>' for one of tokens"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not token_matches(request.headers.get('Authorization'), *tokens):
+                return jsonify({'success': False, 'message': 'Authorization required'}), 403
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+admin_only = require_token(ADMIN_TOKEN)
+agent_only = require_token(AGENT_TOKEN, ADMIN_TOKEN)
+metrics_only = require_token(METRICS_TOKEN, ADMIN_TOKEN)
+
+def agent_socket_authorized(auth, authorization_header):
+    """Agent dashboards connect with auth={'token': ...} or an Authorization header"""
+    token = auth.get('token') if isinstance(auth, dict) else None
+    return token_matches(token or authorization_header, AGENT_TOKEN, ADMIN_TOKEN)
+
+# One token manager for the whole process; keeps both credential types in memory
+token_manager = TokenManager(CLIENT_ID, AUTHORITY, CLIENT_SECRET, SCOPE, cache_file="token_cache.json",
+                             validate_authority=AUTHORITY_HOST == "https://login.microsoftonline.com")
+token_manager.start()
+
+# Shared, pooled HTTP client for every Graph call
+# Circuit breakers per Graph operation. While one is open, calls fail
+# immediately and requests go straight to the fallback responder.
+GRAPH_OPERATIONS = (TOKEN_OPERATION, 'chat_create', 'message_send', 'subscription')
+graph_breakers = {
+    name: CircuitBreaker(
+        name,
+        failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5)),
+        reset_timeout=int(os.getenv("CIRCUIT_RESET_TIMEOUT", 30))
+    )
+    for name in GRAPH_OPERATIONS
+}
+# SERVER_MODE=async (set by async_server.py) runs Graph calls as coroutines on an
+# event loop; provisioning, follow-ups and message fetches await them there
+# (see use_event_loop below) instead of holding a pool thread per in-flight call
+SERVER_MODE = os.getenv("SERVER_MODE", "threaded")
+if SERVER_MODE == 'async':
+    graph_client = AsyncGraphClient(token_manager, base_url=GRAPH_URL, breakers=graph_breakers)
+else:
+    graph_client = GraphClient(token_manager, base_url=GRAPH_URL, breakers=graph_breakers)
+
+# Message fetches and user lookups issued close together share one $batch call
+GRAPH_BATCH_WINDOW = float(os.getenv("GRAPH_BATCH_WINDOW", 0.05))
+graph_batcher = GraphBatcher(graph_client, window=GRAPH_BATCH_WINDOW)
+
+# How long a worker waits for a batched Graph response
+GRAPH_BATCH_TIMEOUT = 60
+
+# Renews every subscription we create shortly before it expires
+subscription_scheduler = SubscriptionScheduler(
+    graph_batcher,
+    on_lost=lambda subscription_id: intake_pool.submit(replace_lost_subscription, subscription_id)
+)
+
+# Delta polling fallback for when Graph can't reach NOTIFICATION_URL:
+#   auto   - poll only while webhook delivery looks broken (default)
+#   always - always poll tracked chats
+#   off    - rely on webhooks only
+POLLING_MODE = os.getenv("POLLING_MODE", "auto")
+delta_poller = DeltaPoller(
+    graph_batcher,
+    on_message=lambda request_id, message_id, message_data: queue_polled_message(request_id, message_id, message_data),
+    active_interval=int(os.getenv("POLLING_ACTIVE_INTERVAL", 5)),
+    idle_interval=int(os.getenv("POLLING_IDLE_INTERVAL", 120)),
+    requests_per_minute=int(os.getenv("POLLING_REQUESTS_PER_MINUTE", 600)),
+    enabled=POLLING_MODE == 'always'
+)
+# Shared between workers with sqlite: the echo of a message often reaches another worker
+webhook_monitor = create_webhook_monitor(
+    CONVERSATION_STORE,
+    CONVERSATION_DB,
+    timeout=int(os.getenv("WEBHOOK_DELIVERY_TIMEOUT", 30)),
+    on_change=lambda healthy: delta_poller.set_enabled(not healthy) if POLLING_MODE == 'auto' else None
+)
+
+# Public URL Graph posts change notifications to
+NOTIFICATION_URL = os.getenv(
+    "NOTIFICATION_URL",
+    "https://5d77-2603-3024-1807-6200-b102-a610-1adf-6f38.ngrok-free.app/api/notifications"
+)
+
+# Graph posts subscription lifecycle events (reauthorizationRequired, subscriptionRemoved) here
+LIFECYCLE_NOTIFICATION_URL = os.getenv(
+    "LIFECYCLE_NOTIFICATION_URL",
+    NOTIFICATION_URL.rsplit("/api/notifications", 1)[0] + "/api/notifications/lifecycle"
+)
+
+# How chat messages are subscribed to:
+#   per_chat      - one subscription per support request (clientState = request ID)
+#   tenant        - one /chats/getAllMessages subscription for the whole tenant
+#   support_user  - one /users/{id}/chats/getAllMessages subscription for a support agent
+# The shared modes route notifications through the store's teams_chat_id index instead of clientState.
+SUBSCRIPTION_MODE = os.getenv("SUBSCRIPTION_MODE", "per_chat")
+# Set SUBSCRIPTION_CLIENT_STATE when using a persistent store or several workers,
+# otherwise each process generates its own and rejects the others' notifications
+SHARED_SUBSCRIPTION_CLIENT_STATE = os.getenv("SUBSCRIPTION_CLIENT_STATE") or uuid.uuid4().hex
+
+# Shared subscriptions by ID (only used when SUBSCRIPTION_MODE is not per_chat)
+shared_subscriptions = {}
+shared_subscription_lock = threading.Lock()
+
+# Opt-in: subscribe with includeResourceData so agent replies arrive inside the
+# notification (encrypted with a certificate from NOTIFICATION_CERT_DIR)
+RICH_NOTIFICATIONS = os.getenv("RICH_NOTIFICATIONS", "false").lower() in ("1", "true", "yes")
+notification_key_ring = EncryptionKeyRing(
+    cert_dir=os.getenv("NOTIFICATION_CERT_DIR") if RICH_NOTIFICATIONS else None,
+    current_id=os.getenv("NOTIFICATION_CERT_ID")
+)
+# Decrypted content is only trusted with validationTokens Azure AD signed for this app
+notification_token_validator = ValidationTokenValidator(
+    CLIENT_ID,
+    TENANT_ID,
+    os.getenv("NOTIFICATION_JWKS_URL", f"{AUTHORITY_HOST}/common/discovery/v2.0/keys"),
+    authority_host=AUTHORITY_HOST
+)
+
+# Admission control: one bounded intake pool runs the Graph work for customers,
+# most urgent first - follow-ups on live chats (and their upkeep), then Teams chats
+# for new requests, then test-fallback responses. New requests may take up to
+# INTAKE_NEW_SHARE of the queue and fallbacks INTAKE_FALLBACK_SHARE, so there is
+# always room left for follow-ups; past that /api/support is shed with a 503 and
+# a Retry-After based on how fast the queue drains.
+# Waiting requests get their queue position as 'support_queue' events.
+PRIORITY_FOLLOW_UP, PRIORITY_NEW, PRIORITY_FALLBACK = 0, 1, 2
+INTAKE_WORKERS = int(os.getenv("INTAKE_WORKERS", 8))
+INTAKE_MAX_QUEUE = int(os.getenv("INTAKE_MAX_QUEUE", 200))
+INTAKE_RETRY_AFTER = 5
+INTAKE_MAX_RETRY_AFTER = 60
+intake_pool = PriorityWorkerPool(
+    "intake",
+    workers=INTAKE_WORKERS,
+    max_queue=INTAKE_MAX_QUEUE,
+    limits={
+        PRIORITY_NEW: int(INTAKE_MAX_QUEUE * float(os.getenv("INTAKE_NEW_SHARE", 0.7))),
+        PRIORITY_FALLBACK: int(INTAKE_MAX_QUEUE * float(os.getenv("INTAKE_FALLBACK_SHARE", 0.1)))
+    },
+    default_priority=PRIORITY_FOLLOW_UP,
+    on_positions=lambda positions: report_queue_positions(positions)
+)
+
+# Workers that fetch and emit agent replies after the webhook has been acknowledged.
+# Notifications for the same request always land on the same worker to keep order.
+NOTIFICATION_WORKERS = int(os.getenv("NOTIFICATION_WORKERS", 8))
+NOTIFICATION_MAX_QUEUE = int(os.getenv("NOTIFICATION_MAX_QUEUE", 1000))
+notification_pool = ShardedWorkerPool("notifications", workers=NOTIFICATION_WORKERS, max_queue=NOTIFICATION_MAX_QUEUE)
+
+if SERVER_MODE == 'async':
+    # The pools' coroutine tasks (aprovision_support_chat, asend_queued_messages,
+    # afetch_and_process_chat_message) run on the Graph loop; the workers only hand
+    # them over, and at most *_CONCURRENCY of each are waiting on Graph at once
+    intake_pool.use_event_loop(graph_client.run, int(os.getenv("INTAKE_CONCURRENCY", 100)))
+    notification_pool.use_event_loop(graph_client.run, int(os.getenv("NOTIFICATION_CONCURRENCY", 200)))
+
+    async def send_outbound(chat_id, items):
+        return await asend_queued_messages(chat_id, items)
+else:
+    def send_outbound(chat_id, items):
+        return send_queued_messages(chat_id, items)
+
+# Customer follow-ups are queued per chat, merged when they arrive in a burst and
+# rate limited per chat and per app (Teams write limits); results go to the room.
+outbound_messages = OutboundMessageQueue(
+    send=send_outbound,
+    on_result=lambda request_id, items, result: report_message_delivery(request_id, items, result),
+    coalesce_window=float(os.getenv("OUTBOUND_COALESCE_WINDOW", 0.3)),
+    max_pending=int(os.getenv("OUTBOUND_MAX_PENDING", 50)),
+    chat_rate=float(os.getenv("OUTBOUND_CHAT_RATE", 1)),
+    chat_burst=int(os.getenv("OUTBOUND_CHAT_BURST", 3)),
+    app_rate=float(os.getenv("OUTBOUND_APP_RATE", 20)),
+    app_burst=int(os.getenv("OUTBOUND_APP_BURST", 40)),
+    submit=lambda fn, *args: intake_pool.submit_prioritized(PRIORITY_FOLLOW_UP, None, fn, *args) is not None
+)
+OUTBOUND_RETRY_AFTER = 2
 
 def get_access_token():
     """
     Get an access token using application-only authentication (client credentials flow).
     This is good for most Graph API operations but won't work for sending Teams messages.
+    Tokens are cached in memory and refreshed in the background before they expire.
     """
-    app = msal.ConfidentialClientApplication(
-        CLIENT_ID,
-        authority=AUTHORITY,
-        client_credential=CLIENT_SECRET
-    )
-    
-    result = app.acquire_token_for_client(scopes=SCOPE)
-    
-    if "access_token" in result:
-        return result["access_token"]
-    else:
-        print(f"Error getting token: {result.get('error')}")
-        print(f"Error description: {result.get('error_description')}")
-        return None
-
-import asyncio
-from msgraph import GraphServiceClient
-from msgraph.generated.models.chat_message import ChatMessage
-from msgraph.generated.models.item_body import ItemBody
-from azure.identity import UsernamePasswordCredential
+    return token_manager.get_app_token()
 
 def get_token_with_device_code():
     """
     Get an access token using device code flow.
-    This requires user interaction once, but can save the refresh token for future use.
+    This requires user interaction once; afterwards the token is served from memory
+    and refreshed silently, and token_cache.json is only rewritten when it changes.
     """
-    token_cache_file = "token_cache.json"
-    
-    # Create token cache on disk
-    cache = msal.SerializableTokenCache()
-    
-    # Load the token cache from file if it exists
-    if os.path.exists(token_cache_file):
-        with open(token_cache_file, "r") as f:
-            cache.deserialize(f.read())
-            
-    # Initialize MSAL app
-    app = msal.PublicClientApplication(
-        CLIENT_ID,
-        authority=AUTHORITY,
-        token_cache=cache
-    )
-    
-    # Try to find a token in cache first
-    accounts = app.get_accounts()
-    if accounts:
-        result = app.acquire_token_silent(
-            ["https://graph.microsoft.com/.default"],
-            account=accounts[0]
-        )
-        if "access_token" in result:
-            print("Got token from cache")
-            # Save cache for future use
-            with open(token_cache_file, "w") as f:
-                f.write(cache.serialize())
-            return result["access_token"]
-    
-    # No suitable token in cache, we need to acquire a new one using device code flow
-    flow = app.initiate_device_flow(scopes=["https://graph.microsoft.com/.default"])
-    if "user_code" not in flow:
-        print("Failed to create device flow")
-        return None
-    
-    print(f"To sign in, use a web browser to open the page {flow['verification_uri']} and enter the code {flow['user_code']} to authenticate.")
-    
-    # This will block until user authenticates or times out
-    result = app.acquire_token_by_device_flow(flow)
-    
-    if "access_token" in result:
-        # Save cache for future use
-        with open(token_cache_file, "w") as f:
-            f.write(cache.serialize())
-        return result["access_token"]
-    else:
-        print(f"Failed to get token: {result.get('error')}")
-        print(f"Error description: {result.get('error_description')}")
-        return None
+    return token_manager.get_delegated_token()
     
+@tracing.traced(root=False)
 def send_message_with_delegated_auth(chat_id, content):
     """
     Send a message to a Teams chat using delegated authentication.
     """
     try:
-        # Get a delegated access token
-        access_token = get_token_with_device_code()
-        if not access_token:
-            print("Failed to obtain delegated access token")
-            return None
+        message_content = chat_message_content(content)
         
-        # Prepare the message content
-        message_content = {}
-        if isinstance(content, dict) and "body" in content:
-            message_content = content
-        else:
-            message_content = {
-                "body": {
-                    "contentType": "text",
-                    "content": content
-                }
-            }
-        
-        # Send the message using a direct REST API call
-        response = requests.post(
-            f"https://graph.microsoft.com/v1.0/chats/{chat_id}/messages",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json"
-            },
-            json=message_content
+        if SERVER_MODE == 'async':
+            # Through the msgraph SDK on the Graph event loop
+            message_data = graph_client.send_chat_message(chat_id, message_content["body"])
+            if message_data is None:
+                return None
+            log.info(f"Successfully sent message with ID: {message_data.get('id')}")
+            webhook_monitor.expect(message_data.get('id'))
+            return message_data
+
+        # Send the message using a delegated token through the shared Graph client
+        response = graph_client.post(
+            f"/chats/{chat_id}/messages", auth=DELEGATED, json=message_content, operation='message_send'
         )
+        if response is None:
+            log.warning("Failed to obtain delegated access token")
+            return None
         
         # Check if the message was sent successfully
         if response.status_code in (200, 201):
             message_data = response.json()
             message_id = message_data.get('id')
-            print(f"Successfully sent message with ID: {message_id}")
+            log.info(f"Successfully sent message with ID: {message_id}")
+            # Our own message should come back as a change notification
+            webhook_monitor.expect(message_id)
             return message_data
         else:
-            print(f"Error sending message: {response.status_code}")
-            print(f"Response: {response.text}")
+            log.error(f"Error sending message: {response.status_code}", chat_id=chat_id, response=response.text)
             return None
 
+    except CircuitOpenError as e:
+        log.warning(f"Not sending message: {str(e)}")
+        return None
     except Exception as e:
-        print(f"Error sending message: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"Error sending message: {str(e)}", chat_id=chat_id)
         return None
+
+async def asend_message_with_delegated_auth(chat_id, content):
+    """
+    send_message_with_delegated_auth for async mode: the send is awaited on
+    the Graph event loop through the msgraph SDK
+    """
+    try:
+        message_data = await graph_client.asend_chat_message(chat_id, chat_message_content(content)["body"])
+        if message_data is None:
+            return None
+        log.info(f"Successfully sent message with ID: {message_data.get('id')}")
+        await asyncio.to_thread(webhook_monitor.expect, message_data.get('id'))
+        return message_data
+    except CircuitOpenError as e:
+        log.warning(f"Not sending message: {str(e)}")
+        return None
+    except Exception as e:
+        log.exception(f"Error sending message: {str(e)}", chat_id=chat_id)
+        return None
+
+def chat_message_content(content):
+    """Graph chatMessage payload for a message body dict or plain text"""
+    if isinstance(content, dict) and "body" in content:
+        return content
+    return {
+        "body": {
+            "contentType": "text",
+            "content": content
+        }
+    }
     
 
 @app.route('/api/message', methods=['POST'])
 def send_followup_message():
     """
     Endpoint for sending follow-up messages in an existing support conversation.
+    The message is queued for the chat and 202 is returned straight away; the
+    outcome arrives as a 'message_delivery' event in the request's room.
     """
     # Get request data
     data = request.json
     request_id = data.get('requestId')
     user_message = data.get('message', '')
+    client_message_id = data.get('clientMessageId') or str(uuid.uuid4())
     
     if not request_id or not user_message:
         return jsonify({
@@ -196,15 +481,16 @@ def send_followup_message():
             'message': 'Missing requestId or message'
         }), 400
     
-    # Check if this is an active request
-    if request_id not in active_requests:
+    # Check if this is an active request; a customer writing again brings an archived one back
+    request_data = active_requests.resume(request_id)
+    if request_data is None:
         return jsonify({
             'success': False,
             'message': 'Unknown request ID'
         }), 404
     
     # Get the Teams chat ID for this request
-    chat_id = active_requests[request_id].get('teams_chat_id')
+    chat_id = request_data.get('teams_chat_id')
     if not chat_id:
         return jsonify({
             'success': False,
@@ -212,40 +498,31 @@ def send_followup_message():
         }), 400
     
     try:
-        # Get user information
-        user_name = active_requests[request_id].get('user_name', 'Anonymous User')
-        
-        # Create message content with a special format that we can detect later
-        message_content = {
-            "body": {
-                "contentType": "html",
-                "content": f"""
-                    <p><strong>From {user_name}:</strong> {user_message}</p>
-                    <!-- client_message_marker -->
-                """
-            }
-        }
-        
-        # Send message to Teams chat using delegated auth
-        message_result = send_message_with_delegated_auth(chat_id, message_content)
-        
-        if not message_result:
+        queued = outbound_messages.enqueue(request_id, chat_id, {
+            'clientMessageId': client_message_id,
+            'userName': request_data.get('user_name', 'Anonymous User'),
+            'message': user_message
+        })
+        if not queued:
             return jsonify({
                 'success': False,
-                'message': 'Failed to send message to Teams'
-            }), 500
+                'message': 'Too many messages waiting to be delivered, please slow down'
+            }), 429, {'Retry-After': str(OUTBOUND_RETRY_AFTER)}
+        
+        # The customer is active, so a reply is likely soon
+        delta_poller.touch(request_id)
+        active_requests.touch(request_id)
         
-        # Don't emit via WebSocket since we already have this message in the UI
+        # Don't emit the message itself via WebSocket since we already have it in the UI
         
         return jsonify({
             'success': True,
-            'message': 'Message sent successfully'
-        }), 200
+            'clientMessageId': client_message_id,
+            'message': 'Message queued'
+        }), 202
         
     except Exception as e:
-        print(f"Exception sending follow-up message: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"Exception sending follow-up message: {str(e)}", request_id=request_id)
         
         return jsonify({
             'success': False,
@@ -253,336 +530,1138 @@ def send_followup_message():
         }), 500
 
 
+def send_queued_messages(chat_id, items):
+    """
+    Post a burst of queued customer messages to Teams as one message, in order
+    """
+    # Send message to Teams chat using delegated auth
+    return send_message_with_delegated_auth(chat_id, queued_message_content(items))
+
+async def asend_queued_messages(chat_id, items):
+    """send_queued_messages for async mode"""
+    return await asend_message_with_delegated_auth(chat_id, queued_message_content(items))
+
+def queued_message_content(items):
+    user_name = items[-1]['userName']
+    text = "<br>".join(item['message'] for item in items)
+    # Create message content with a special format that we can detect later
+    return {
+        "body": {
+            "contentType": "html",
+            "content": f"""
+                <p><strong>From {user_name}:</strong> {text}</p>
+                <!-- client_message_marker -->
+            """
+        }
+    }
+
+def report_message_delivery(request_id, items, message_result):
+    """Tell the client whether its queued messages reached Teams"""
+    emit_conversation_event(request_id, 'message_delivery', {
+        'requestId': request_id,
+        'clientMessageIds': [item['clientMessageId'] for item in items],
+        'status': 'sent' if message_result else 'failed',
+        'teamsMessageId': message_result.get('id') if message_result else None,
+        'timestamp': datetime.now().isoformat()
+    })
+
 @app.route('/api/support', methods=['POST'])
+@tracing.traced('POST /api/support')
 def submit_support_request():
     """
     Endpoint for submitting a new support request.
-    This will create a new group chat in Teams for this specific conversation.
+    The request is recorded and acknowledged immediately; the Teams group chat is
+    created by a background worker, which reports progress to the request's
+    Socket.IO room via 'support_status' events.
+    Requests repeated with the same Idempotency-Key get the original response.
     """
     # Get request data
     data = request.json
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotencyKey')
+    if not idempotency_key:
+        body, status, headers = create_support_request(data)
+        return jsonify(body), status, headers
+    
+    fingerprint = hashlib.sha256(json.dumps(
+        [data.get('message', ''), data.get('userName'), data.get('userEmail')]
+    ).encode()).hexdigest()
+    try:
+        owner, cached = support_idempotency.begin(idempotency_key, fingerprint)
+    except IdempotencyConflict:
+        return jsonify({
+            'success': False,
+            'message': 'Idempotency-Key was already used for a different request'
+        }), 422
+    
+    if not owner:
+        if cached is None:
+            # The first submission is still being handled
+            return jsonify({
+                'success': False,
+                'message': 'This request is still being processed'
+            }), 409, {'Retry-After': '1'}
+        body, status = cached
+        log.info(f"Replaying support request {body.get('requestId')} for idempotency key {idempotency_key}")
+        return jsonify(body), status, {'Idempotent-Replayed': 'true'}
+    
+    try:
+        body, status, headers = create_support_request(data)
+    except Exception:
+        support_idempotency.fail(idempotency_key)
+        raise
+    if status == 200:
+        support_idempotency.complete(idempotency_key, body, status)
+    else:
+        # Nothing was created, so a retry should try again
+        support_idempotency.fail(idempotency_key)
+    return jsonify(body), status, headers
+
+def create_support_request(data):
+    """
+    Record a support request and queue its Teams chat.
+    Returns (body, status, headers) for the response.
+    """
     user_message = data.get('message', '')
     user_name = data.get('userName', 'Anonymous User')
     user_email = data.get('userEmail', '')
     chat_history = data.get('chatHistory', '')
     
-    print(f"Received support request from {user_name} ({user_email}): {user_message}")
+    log.info(f"Received support request from {user_name} ({user_email}): {user_message}")
     
-    # Generate unique request ID
-    request_id = str(uuid.uuid4())
+    # A spare chat from the warm pool already has its request ID (its subscription's clientState)
+    spare_chat = warm_chat_pool.claim() if warm_chat_pool else None
+    request_id = spare_chat['request_id'] if spare_chat else str(uuid.uuid4())
+    tracing.set_request_id(request_id)
     
     # Store request details
     timestamp = datetime.now().isoformat()
-    active_requests[request_id] = {
+    active_requests.create(request_id, {
         'user_name': user_name,
         'user_email': user_email,
         'message': user_message,
         'timestamp': timestamp,
-        'status': 'pending'
+        'status': 'pending',
+        'provisioning': 'queued'
+    })
+    update_queue_view(
+        request_id, status='pending', provisioning='queued', userName=user_name, userEmail=user_email,
+        createdAt=timestamp
+    )
+    
+    accepted = {
+        'success': True,
+        'requestId': request_id,
+        'message': 'Support request received'
     }
     
-    try:
-        # Get Microsoft Graph access token
-        print("Attempting to get Microsoft Graph access token...")
-        access_token = get_access_token()
-        if not access_token:
-            print("Failed to get Microsoft Graph access token")
-            # Fall back to test mode
-            send_test_response(request_id, user_message)
-            return jsonify({
-                'success': True,
-                'requestId': request_id,
-                'message': 'Support request submitted (fallback mode)'
-            }), 200
-        
-        print("Successfully obtained access token")
-        
-        # Step 1: Create a new group chat - UPDATED FORMAT
-        print("Attempting to create Teams chat...")
-        
-        # Convert SUPPORT_TEAM_MEMBERS to the proper format
-        members = []
-        for member in SUPPORT_TEAM_MEMBERS:
-            user_id = member.get('userId')
-            if user_id:
-                members.append({
-                    "@odata.type": "#microsoft.graph.aadUserConversationMember",
-                    "roles": ["owner"],
-                    "user@odata.bind": f"https://graph.microsoft.com/v1.0/users('{user_id}')"
-                })
-        
-        chat_data = {
-            "chatType": "group",
-            "topic": f"Support Request from {user_name} - {request_id[:8]}",
-            "members": members
-        }
-        
-        print(f"Chat request data: {chat_data}")
-        
-        chat_response = requests.post(
-            "https://graph.microsoft.com/v1.0/chats",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json"
-            },
-            json=chat_data
+    if not spare_chat and (graph_breakers['chat_create'].is_open() or graph_breakers[TOKEN_OPERATION].is_open()):
+        # Graph is known to be down; don't make a worker find that out again
+        priority = PRIORITY_FALLBACK
+        position = intake_pool.submit_prioritized(
+            priority, request_id, fall_back_to_test_response, request_id, user_message, 'graph unavailable'
         )
-        
-        print(f"Chat creation response status: {chat_response.status_code}")
-        print(f"Chat creation response: {chat_response.text}")
-        
-        if chat_response.status_code not in (201, 200):
-            print(f"Error creating chat: {chat_response.status_code}")
-            print(f"Response: {chat_response.text}")
-            # Fall back to test mode
-            send_test_response(request_id, user_message)
-            return jsonify({
-                'success': True,
-                'requestId': request_id,
-                'message': 'Support request submitted (fallback mode - chat creation failed)'
-            }), 200
-        
-        chat_info = chat_response.json()
-        chat_id = chat_info['id']
-        print(f"Successfully created chat with ID: {chat_id}")
+    else:
+        priority = PRIORITY_NEW
+        provision = aprovision_support_chat if SERVER_MODE == 'async' else provision_support_chat
+        position = intake_pool.submit_prioritized(
+            priority, request_id, provision, request_id, user_name, user_email, user_message,
+            chat_history, timestamp, spare_chat
+        )
+    if position is None:
+        # Saturated; shed the request and ask the client to come back once the queue has drained
+        log.warning(f"Intake full for priority {priority}, rejecting request {request_id}")
+        SUPPORT_REQUESTS.labels(result="shed").inc()
+        active_requests.delete(request_id)
+        publish_queue_delta(queue_view.remove(request_id))
+        if spare_chat:
+            warm_chat_pool.return_spare(spare_chat)
+        retry_after = intake_retry_after()
+        return {
+            'success': False,
+            'message': 'Support is busy right now, please try again shortly',
+            'retryAfter': retry_after
+        }, 503, {'Retry-After': str(retry_after)}
+    
+    accepted['queuePosition'] = position
+    SUPPORT_REQUESTS.labels(result="fallback" if priority == PRIORITY_FALLBACK else "accepted").inc()
+    return accepted, 200, {}
+
+def intake_retry_after():
+    """Seconds a shed client should wait: about how long the current intake queue takes to drain"""
+    wait = intake_pool.estimated_wait(intake_pool.depth())
+    if wait is None:
+        return INTAKE_RETRY_AFTER
+    return max(1, min(INTAKE_MAX_RETRY_AFTER, int(math.ceil(wait))))
+
+def queue_position_event(request_id, position):
+    return {
+        'requestId': request_id,
+        'position': position,
+        'timestamp': datetime.now().isoformat()
+    }
+
+def report_queue_positions(positions):
+    """Tell waiting clients where their request is in the intake queue"""
+    for request_id, position in positions.items():
+        socketio.emit('support_queue', queue_position_event(request_id, position), room=request_id)
+
+def emit_conversation_event(request_id, event, payload):
+    """Emit an event to the request's room, numbered and kept for replay after a reconnect"""
+    socketio.emit(event, event_log.record(request_id, event, payload), room=request_id)
+
+def update_queue_view(request_id, **fields):
+    """Apply a change to the conversation's queue entry and stream it to agent dashboards"""
+    publish_queue_delta(queue_view.upsert(request_id, **fields))
+
+def publish_queue_delta(delta):
+    if delta is not None:
+        socketio.emit('queue_delta', delta, room=QUEUE_ROOM, namespace=AGENT_NAMESPACE)
+
+def emit_provisioning_status(request_id, status, **extra):
+    """Record a provisioning step and tell the client about it"""
+    active_requests.update(request_id, provisioning=status)
+    update_queue_view(request_id, provisioning=status)
+    payload = {
+        'requestId': request_id,
+        'status': status,
+        'timestamp': datetime.now().isoformat()
+    }
+    payload.update(extra)
+    emit_conversation_event(request_id, 'support_status', payload)
+
+@tracing.traced()
+def fall_back_to_test_response(request_id, user_message, reason):
+    """Switch a request to the test responder when Teams can't be used"""
+    log.warning(f"Falling back to test response for {request_id}: {reason}")
+    emit_provisioning_status(request_id, 'fallback', reason=reason)
+    send_test_response(request_id, user_message)
+
+@tracing.traced(root=False)
+def support_chat_members():
+    """
+    Member list for a new support chat, or None if the support team isn't resolved yet
+    """
+    # Last known-good support team; only waits if nothing was ever resolved
+    support_user_ids = support_directory.members(timeout=SUPPORT_DIRECTORY_WAIT)
+    if not support_user_ids:
+        return None
+    members = []
+    for user_id in support_user_ids:
+        members.append({
+            "@odata.type": "#microsoft.graph.aadUserConversationMember",
+            "roles": ["owner"],
+            "user@odata.bind": f"{GRAPH_URL}/users('{user_id}')"
+        })
+    return members
+
+@tracing.traced()
+def provision_support_chat(request_id, user_name, user_email, user_message, chat_history, timestamp,
+                           spare_chat=None):
+    """
+    Create the Teams group chat for a support request, post the initial message
+    and subscribe to replies. Runs on the provisioning worker pool.
+    With a spare_chat from the warm pool, the chat and subscription already
+    exist and only the topic is updated.
+    """
+    topic = f"Support Request from {user_name} - {request_id[:8]}"
+    try:
+        if spare_chat:
+            # Step 1: Take over a pre-provisioned chat
+            chat_id = spare_chat['chat_id']
+            chat_info = {'id': chat_id, 'webUrl': spare_chat.get('web_url')}
+            log.info(f"Using spare chat {chat_id} for request {request_id}")
+            topic_response = graph_client.patch(f"/chats/{chat_id}", json={"topic": topic})
+            spare_topic_updated(request_id, chat_id, topic_response, spare_chat)
+        else:
+            # Step 1: Create a new group chat - UPDATED FORMAT
+            log.debug("Attempting to create Teams chat...")
+            
+            members = support_chat_members()
+            if not members:
+                fall_back_to_test_response(request_id, user_message, 'support team not resolved')
+                return
+            
+            chat_data = {
+                "chatType": "group",
+                "topic": topic,
+                "members": members
+            }
+            
+            log.debug(f"Chat request data: {chat_data}")
+            
+            chat_response = graph_client.post("/chats", json=chat_data, operation='chat_create')
+            chat_info = chat_created(request_id, user_message, chat_response)
+            if chat_info is None:
+                return
+            chat_id = chat_info['id']
         
         # Store the chat ID for future reference
-        active_requests[request_id]['teams_chat_id'] = chat_id
+        record_support_chat(request_id, chat_id)
         
         # Step 2: Send the initial message to the chat
-        print("Sending initial message to Teams chat...")
-        message_content = {
-            "body": {
-                "contentType": "html",
-                "content": f"""
-                    <h2>New Support Request</h2>
-                    <p><strong>From:</strong> {user_name} ({user_email})</p>
-                    <p><strong>Request ID:</strong> {request_id}</p>
-                    <p><strong>Time:</strong> {timestamp}</p>
-                    <hr>
-                    <p><strong>Message:</strong></p>
-                    <p>{user_message}</p>
-                    <hr>
-                    {f'<p><strong>Previous chatbot conversation:</strong></p><pre>{chat_history}</pre><hr>' if chat_history else ''}
-                    <p>Reply to this message to respond directly to the user.</p>
-                """
-            }
-        }
-
+        log.debug("Sending initial message to Teams chat...")
+        message_content = initial_message_content(request_id, user_name, user_email, user_message,
+                                                  chat_history, timestamp)
         message_result = send_message_with_delegated_auth(chat_id, message_content)
+        initial_message_sent(request_id, chat_info, message_result)
         
-        # Handle the message result, whether it's a dictionary or an object
-        if message_result:
+        # Step 3: Create a subscription for messages in this chat (spares already have one)
+        if not (active_requests.get(request_id) or {}).get('subscription_id'):
+            log.debug("Creating subscription for chat messages...")
             try:
-                # Check if message_result is a dictionary or an object
-                if isinstance(message_result, dict):
-                    message_id = message_result.get('id')
-                    print(f"Successfully sent message with ID: {message_id}")
-                    if message_id:
-                        active_requests[request_id]['initial_message_id'] = message_id
-                else:
-                    # Assuming it's an object with an id attribute
-                    print(f"Successfully sent message with ID: {message_result.id}")
-                    active_requests[request_id]['initial_message_id'] = message_result.id
-            except Exception as e:
-                print(f"Error processing message result: {str(e)}")
-                # Continue with the function instead of jumping to fallback
-        else:
-            print("Failed to send message using Graph SDK")
-            # We'll continue anyway since the chat was created
-            chat_link = chat_info.get('webUrl')
-            active_requests[request_id]['teams_chat_link'] = chat_link
-        
-        # Step 3: Create a subscription for messages in this chat
-        print("Creating subscription for chat messages...")
-        try:
-            create_chat_subscription(request_id, chat_id)
-        except Exception as subscription_error:
-            print(f"Error creating subscription: {str(subscription_error)}")
-            print("Continuing without subscription - webhook notifications will not work")
-            # Continue anyway, as this is not critical for the initial flow
-        
-        return jsonify({
-            'success': True,
-            'requestId': request_id,
-            'message': 'Support request submitted successfully'
-        }), 200
+                create_chat_subscription(request_id, chat_id)
+            except Exception as subscription_error:
+                log.error(f"Error creating subscription: {str(subscription_error)}; "
+                          "continuing without subscription - webhook notifications will not work", request_id=request_id)
+                # Continue anyway, as this is not critical for the initial flow
+        report_subscribed(request_id)
             
+    except CircuitOpenError as e:
+        fall_back_to_test_response(request_id, user_message, f"graph unavailable ({e.name})")
     except Exception as e:
-        print(f"Exception in support request: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"Exception in support request: {str(e)}", request_id=request_id)
         
         # Fall back to test mode
-        send_test_response(request_id, user_message)
-        return jsonify({
-            'success': True,
-            'requestId': request_id,
-            'message': 'Support request submitted (fallback mode - exception)'
-        }), 200
+        fall_back_to_test_response(request_id, user_message, 'exception')
+
+async def aprovision_support_chat(request_id, user_name, user_email, user_message, chat_history, timestamp,
+                                  spare_chat=None):
+    """
+    provision_support_chat for async mode: the Graph calls are awaited on the
+    Graph event loop, and only the store and emit work between them takes a
+    thread (asyncio.to_thread)
+    """
+    with tracing.trace("provision_support_chat", request_id=request_id):
+        topic = f"Support Request from {user_name} - {request_id[:8]}"
+        try:
+            if spare_chat:
+                # Step 1: Take over a pre-provisioned chat
+                chat_id = spare_chat['chat_id']
+                chat_info = {'id': chat_id, 'webUrl': spare_chat.get('web_url')}
+                log.info(f"Using spare chat {chat_id} for request {request_id}")
+                topic_response = await graph_client.arequest("PATCH", f"/chats/{chat_id}", json={"topic": topic})
+                await asyncio.to_thread(spare_topic_updated, request_id, chat_id, topic_response, spare_chat)
+            else:
+                # Step 1: Create a new group chat; the directory may still be resolving the support team
+                members = await asyncio.to_thread(support_chat_members)
+                if not members:
+                    await asyncio.to_thread(fall_back_to_test_response, request_id, user_message,
+                                            'support team not resolved')
+                    return
+                chat_data = {
+                    "chatType": "group",
+                    "topic": topic,
+                    "members": members
+                }
+                chat_response = await graph_client.arequest("POST", "/chats", json=chat_data, operation='chat_create')
+                chat_info = await asyncio.to_thread(chat_created, request_id, user_message, chat_response)
+                if chat_info is None:
+                    return
+                chat_id = chat_info['id']
+            
+            await asyncio.to_thread(record_support_chat, request_id, chat_id)
+            
+            # Step 2: Send the initial message to the chat
+            message_content = initial_message_content(request_id, user_name, user_email, user_message,
+                                                      chat_history, timestamp)
+            message_result = await asend_message_with_delegated_auth(chat_id, message_content)
+            await asyncio.to_thread(initial_message_sent, request_id, chat_info, message_result)
+            
+            # Step 3: Create a subscription for messages in this chat (spares already have one)
+            request_data = await asyncio.to_thread(active_requests.get, request_id)
+            if not (request_data or {}).get('subscription_id'):
+                try:
+                    await acreate_chat_subscription(request_id, chat_id)
+                except Exception as subscription_error:
+                    log.error(f"Error creating subscription: {str(subscription_error)}; "
+                              "continuing without subscription - webhook notifications will not work",
+                              request_id=request_id)
+            await asyncio.to_thread(report_subscribed, request_id)
+        
+        except CircuitOpenError as e:
+            await asyncio.to_thread(fall_back_to_test_response, request_id, user_message,
+                                    f"graph unavailable ({e.name})")
+        except Exception as e:
+            log.exception(f"Exception in support request: {str(e)}", request_id=request_id)
+            await asyncio.to_thread(fall_back_to_test_response, request_id, user_message, 'exception')
+
+def spare_topic_updated(request_id, chat_id, topic_response, spare_chat):
+    if topic_response is None or topic_response.status_code not in (200, 204):
+        # The chat still works with the placeholder topic
+        log.warning(f"Could not update topic of chat {chat_id}")
+    if spare_chat.get('subscription_id'):
+        active_requests.update(request_id, subscription_id=spare_chat['subscription_id'])
+
+def chat_created(request_id, user_message, chat_response):
+    """
+    The new chat from a chat creation response, or None after falling back
+    to the test responder because it failed
+    """
+    if chat_response is None:
+        fall_back_to_test_response(request_id, user_message, 'no access token')
+        return None
+    
+    log.debug(f"Chat creation response status: {chat_response.status_code}", response=chat_response.text)
+    
+    if chat_response.status_code not in (201, 200):
+        log.error(f"Error creating chat: {chat_response.status_code}", request_id=request_id,
+                  response=chat_response.text)
+        fall_back_to_test_response(request_id, user_message, 'chat creation failed')
+        return None
+    
+    chat_info = chat_response.json()
+    log.info(f"Successfully created chat with ID: {chat_info['id']}")
+    return chat_info
+
+def record_support_chat(request_id, chat_id):
+    active_requests.update(request_id, teams_chat_id=chat_id)
+    delta_poller.track(request_id, chat_id)
+    emit_provisioning_status(request_id, 'chat_created')
+
+def initial_message_content(request_id, user_name, user_email, user_message, chat_history, timestamp):
+    return {
+        "body": {
+            "contentType": "html",
+            "content": f"""
+                <h2>New Support Request</h2>
+                <p><strong>From:</strong> {user_name} ({user_email})</p>
+                <p><strong>Request ID:</strong> {request_id}</p>
+                <p><strong>Time:</strong> {timestamp}</p>
+                <hr>
+                <p><strong>Message:</strong></p>
+                <p>{user_message}</p>
+                <hr>
+                {f'<p><strong>Previous chatbot conversation:</strong></p><pre>{chat_history}</pre><hr>' if chat_history else ''}
+                <p>Reply to this message to respond directly to the user.</p>
+            """
+        }
+    }
+
+def initial_message_sent(request_id, chat_info, message_result):
+    # Handle the message result, whether it's a dictionary or an object
+    if message_result:
+        try:
+            # Check if message_result is a dictionary or an object
+            if isinstance(message_result, dict):
+                message_id = message_result.get('id')
+                log.info(f"Successfully sent message with ID: {message_id}")
+                if message_id:
+                    active_requests.update(request_id, initial_message_id=message_id)
+            else:
+                # Assuming it's an object with an id attribute
+                log.info(f"Successfully sent message with ID: {message_result.id}")
+                active_requests.update(request_id, initial_message_id=message_result.id)
+        except Exception as e:
+            log.error(f"Error processing message result: {str(e)}")
+            # Continue with the function instead of jumping to fallback
+        emit_provisioning_status(request_id, 'agent_notified')
+    else:
+        log.warning("Failed to send message using Graph SDK")
+        # We'll continue anyway since the chat was created
+        chat_link = chat_info.get('webUrl')
+        active_requests.update(request_id, teams_chat_link=chat_link)
+
+def report_subscribed(request_id):
+    if (active_requests.get(request_id) or {}).get('subscription_id'):
+        emit_provisioning_status(request_id, 'subscribed')
 
 def send_test_response(request_id, user_message):
     """Send a test response for cases where Microsoft Graph API is unavailable"""
     def _send_response():
-        print(f"Sending test response to request {request_id}")
+        log.info(f"Sending test response to request {request_id}")
         response_data = {
             'requestId': request_id,
             'message': f"This is a test response to: {user_message}",
             'responderName': 'Test Support Agent',
             'timestamp': datetime.now().isoformat()
         }
-        socketio.emit('support_response', response_data, room=request_id)
+        emit_conversation_event(request_id, 'support_response', response_data)
     
     socketio.start_background_task(lambda: (socketio.sleep(2), _send_response()))
 
-def create_chat_subscription(request_id, chat_id):
+def build_subscription(resource, client_state):
     """
-    Create a subscription to receive notifications for new messages in a chat
+    Subscription payload for new chat messages on the given resource
     """
-    access_token = get_access_token()
-    if not access_token:
-        print("Failed to get token for subscription creation")
-        return
-    
-    # Configure the subscription with shorter expiration (within 1 hour)
-    # to avoid needing lifecycleNotificationUrl
+    # Chat message subscriptions last at most an hour; subscription_scheduler renews them
     subscription = {
         "changeType": "created",
-        "notificationUrl": "https://5d77-2603-3024-1807-6200-b102-a610-1adf-6f38.ngrok-free.app/api/notifications",
-        "resource": f"/chats/{chat_id}/messages",
-        "expirationDateTime": (datetime.now(timezone.utc) + timedelta(minutes=50)).isoformat(),
-        "clientState": request_id  # Use request_id as client state for correlation
+        "notificationUrl": NOTIFICATION_URL,
+        "lifecycleNotificationUrl": LIFECYCLE_NOTIFICATION_URL,
+        "resource": resource,
+        "expirationDateTime": subscription_scheduler.next_expiration(),
+        "clientState": client_state
     }
     
-    try:
-        response = requests.post(
-            "https://graph.microsoft.com/v1.0/subscriptions",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json"
-            },
-            json=subscription
-        )
-        
-        print(f"Subscription creation response status: {response.status_code}")
-        print(f"Subscription creation response: {response.text}")
-        
-        if response.status_code in (201, 200):
-            subscription_data = response.json()
-            active_requests[request_id]['subscription_id'] = subscription_data.get('id')
-            print(f"Subscription created: {subscription_data.get('id')}")
+    if RICH_NOTIFICATIONS:
+        # Ask Graph to embed the (encrypted) message so we don't have to fetch it
+        encryption_fields = notification_key_ring.subscription_fields()
+        if encryption_fields:
+            subscription.update(encryption_fields)
         else:
-            print(f"Error creating subscription: {response.status_code}")
-            print(f"Response: {response.text}")
+            log.warning("No notification encryption certificate loaded, creating a basic subscription")
+    
+    return subscription
+
+@tracing.traced()
+def create_chat_subscription(request_id, chat_id):
+    """
+    Create a subscription to receive notifications for new messages in a chat.
+    In the shared subscription modes the chat is already covered, so this only
+    makes sure the shared subscription exists.
+    """
+    if SUBSCRIPTION_MODE != 'per_chat':
+        if ensure_shared_subscription():
+            active_requests.update(request_id, subscription_id=next(iter(shared_subscriptions), None))
+        return
+    
+    subscription_id = post_chat_subscription(request_id, chat_id)
+    if subscription_id:
+        active_requests.update(request_id, subscription_id=subscription_id)
+
+async def acreate_chat_subscription(request_id, chat_id):
+    """create_chat_subscription for async mode"""
+    if SUBSCRIPTION_MODE != 'per_chat':
+        # Created once and shared by every chat, so this rarely calls Graph
+        await asyncio.to_thread(create_chat_subscription, request_id, chat_id)
+        return
+    
+    subscription = build_subscription(f"/chats/{chat_id}/messages", request_id)
+    try:
+        response = await graph_client.arequest("POST", "/subscriptions", json=subscription, operation='subscription')
+        subscription_id = await asyncio.to_thread(chat_subscription_created, request_id, response)
+    except Exception as e:
+        log.error(f"Exception creating subscription: {str(e)}", request_id=request_id)
+        return
+    if subscription_id:
+        await asyncio.to_thread(active_requests.update, request_id, subscription_id=subscription_id)
+
+def post_chat_subscription(request_id, chat_id):
+    """
+    Subscribe to new messages in one chat and start renewing the subscription.
+    Returns the subscription ID, or None on failure.
+    """
+    # Use request_id as client state for correlation
+    subscription = build_subscription(f"/chats/{chat_id}/messages", request_id)
+    
+    try:
+        response = graph_client.post("/subscriptions", json=subscription, operation='subscription')
+        return chat_subscription_created(request_id, response)
     except Exception as e:
-        print(f"Exception creating subscription: {str(e)}")
-        print(f"Response: {response.text if 'response' in locals() else 'No response'}")
+        log.error(f"Exception creating subscription: {str(e)}", request_id=request_id)
+    return None
+
+def chat_subscription_created(request_id, response):
+    """Track the subscription from a creation response; returns its ID, or None on failure"""
+    if response is None:
+        log.warning("Failed to get token for subscription creation")
+        return None
+    
+    log.debug(f"Subscription creation response status: {response.status_code}", response=response.text)
+    
+    if response.status_code in (201, 200):
+        subscription_data = response.json()
+        subscription_id = subscription_data.get('id')
+        subscription_scheduler.track(subscription_id, subscription_data.get('expirationDateTime'))
+        log.info(f"Subscription created: {subscription_id}")
+        return subscription_id
+    log.error(f"Error creating subscription: {response.status_code}", request_id=request_id,
+              response=response.text)
+    # Usually means Graph couldn't validate NOTIFICATION_URL
+    webhook_monitor.mark_unreachable(f"subscription creation failed ({response.status_code})")
+    return None
+
+def shared_subscription_resource():
+    """
+    Resource for the single consolidated chat message subscription
+    """
+    if SUBSCRIPTION_MODE == 'tenant':
+        return "/chats/getAllMessages"
+    if SUBSCRIPTION_MODE == 'support_user':
+        # Every support chat includes all support members, so one member's scope covers them all
+        user_id = os.getenv("SUBSCRIPTION_USER_ID") or next(
+            iter(support_directory.members(timeout=SUPPORT_DIRECTORY_WAIT)), None
+        )
+        return f"/users/{user_id}/chats/getAllMessages" if user_id else None
+    return None
+
+def ensure_shared_subscription():
+    """
+    Create the consolidated chat message subscription if we don't have one yet.
+    Returns True if a shared subscription is active.
+    """
+    if shared_subscriptions:
+        return True
+    with shared_subscription_lock:
+        if shared_subscriptions:
+            return True
+        resource = shared_subscription_resource()
+        if not resource:
+            log.error(f"No resource available for subscription mode {SUBSCRIPTION_MODE}")
+            return False
+        subscription = build_subscription(resource, SHARED_SUBSCRIPTION_CLIENT_STATE)
+        try:
+            response = graph_client.post("/subscriptions", json=subscription, operation='subscription')
+        except Exception as e:
+            log.error(f"Exception creating shared subscription: {str(e)}")
+            return False
+        if response is None:
+            log.warning("Failed to get token for subscription creation")
+            return False
+        if response.status_code not in (201, 200):
+            log.error(f"Error creating shared subscription: {response.status_code}", response=response.text)
+            return False
+        subscription_data = response.json()
+        shared_subscriptions[subscription_data['id']] = {
+            'resource': resource,
+            'expirationDateTime': subscription_data.get('expirationDateTime')
+        }
+        subscription_scheduler.track(subscription_data['id'], subscription_data.get('expirationDateTime'))
+        log.info(f"Shared subscription created: {subscription_data['id']} for {resource}")
+        return True
+
+def replace_lost_subscription(subscription_id):
+    """
+    Recreate a subscription that Graph removed or that we failed to renew in time
+    """
+    if warm_chat_pool and warm_chat_pool.discard_subscription(subscription_id):
+        # The spare is retired and the pool creates a fresh one
+        return
+    if shared_subscriptions.pop(subscription_id, None) is not None:
+        log.info(f"Recreating shared subscription {subscription_id}")
+        if ensure_shared_subscription():
+            new_id = next(iter(shared_subscriptions))
+            for request_id in active_requests.find_by_subscription(subscription_id):
+                active_requests.update(request_id, subscription_id=new_id)
+        return
+    
+    request_id = next(iter(active_requests.find_by_subscription(subscription_id)), None)
+    request_data = active_requests.get(request_id)
+    if not request_data or request_data.get('status') == 'aborted' or not request_data.get('teams_chat_id'):
+        return
+    log.info(f"Recreating subscription for request {request_id}")
+    active_requests.update(request_id, subscription_id=None)
+    create_chat_subscription(request_id, request_data['teams_chat_id'])
+
+def release_subscription(request_id):
+    """
+    Delete a request's own subscription once the conversation is over
+    """
+    request_data = active_requests.get(request_id) or {}
+    subscription_id = request_data.get('subscription_id')
+    # Shared subscriptions outlive individual conversations
+    if not subscription_id or subscription_id in shared_subscriptions:
+        return
+    subscription_scheduler.delete(subscription_id)
+    active_requests.update(request_id, subscription_id=None)
+
+CHAT_RESOURCE_PATTERN = re.compile(r"chats\('([^']+)'\)|chats/([^/]+)/messages")
+
+def resolve_notification_request(notification):
+    """
+    Map a change notification to the support request it belongs to.
+    Returns None for notifications we don't track.
+    """
+    client_state = notification.get('clientState')
+    if SUBSCRIPTION_MODE == 'per_chat':
+        return client_state if client_state in active_requests else None
+    
+    # Shared subscription: clientState is a secret, the chat comes from the resource path
+    if client_state != SHARED_SUBSCRIPTION_CLIENT_STATE:
+        return None
+    match = CHAT_RESOURCE_PATTERN.search(notification.get('resource', ''))
+    if not match:
+        return None
+    return active_requests.find_by_chat(match.group(1) or match.group(2))
 
 @app.route('/api/notifications', methods=['POST'])
+@metrics.timed(WEBHOOK_SECONDS.labels(endpoint="notifications"))
 def handle_notifications():
     """
-    Webhook endpoint for receiving Microsoft Graph notifications
+    Webhook endpoint for receiving Microsoft Graph notifications.
+    Notifications are only validated and queued here so Graph gets its 202
+    straight away; notification_pool fetches and emits the messages.
     """
     # Validate the notification
     if request.args.get('validationToken'):
         # Handle subscription validation
         return request.args.get('validationToken'), 200, {'Content-Type': 'text/plain'}
     
-    notifications = request.json.get('value', [])
+    payload = request.get_json(silent=True) or {}
+    notifications = payload.get('value', [])
     
+    trusted = rich_content_trusted(payload)
+    if trusted is False:
+        WEBHOOK_NOTIFICATIONS.labels(result="invalid").inc(len(notifications))
+        return jsonify({}), 202
+    
+    rejected = 0
     for notification in notifications:
+        if not queue_notification(notification, trusted):
+            rejected += 1
+    
+    if rejected:
+        # Graph redelivers the batch later; already processed messages are skipped
+        log.warning(f"Notification queue full or message in flight, asking Graph to retry {rejected} notification(s)")
+        return jsonify({}), 503, {'Retry-After': '5'}
+    
+    return jsonify({}), 202
+
+def rich_content_trusted(payload):
+    """
+    Whether the encrypted content in a notification payload can be used:
+    True once its validationTokens check out, False if they are missing or
+    invalid (the payload is dropped), None if the signing keys can't be
+    fetched right now (the messages are fetched from Graph instead).
+    """
+    if not RICH_NOTIFICATIONS or not any(n.get('encryptedContent') for n in payload.get('value', [])):
+        return True
+    try:
+        notification_token_validator.validate(payload.get('validationTokens'))
+        return True
+    except ValidationKeysUnavailable as e:
+        log.warning(f"Can't check notification validation tokens, fetching from Graph instead: {str(e)}")
+        return None
+    except NotificationValidationError as e:
+        log.warning(f"Dropping notifications with invalid validation tokens: {str(e)}")
+        return False
+
+@tracing.traced('notification')
+def queue_notification(notification, trusted=True):
+    """
+    Queue the message of one change notification for notification_pool.
+    Its encrypted content is only used if trusted (see rich_content_trusted).
+    Returns False if Graph should redeliver it: the queue is full, or the
+    message is still being handled for an earlier delivery.
+    """
+    # Notifications for chats we don't track are dropped without a Graph call
+    client_state = resolve_notification_request(notification)
+    resource_data = notification.get('resourceData', {})
+    message_id = resource_data.get('id')
+    tracing.set_request_id(client_state)
+    
+    # Check if this is a message in a tracked chat
+    if not (client_state and message_id):
+        WEBHOOK_NOTIFICATIONS.labels(result="untracked").inc()
+        return True
+    chat_id = (active_requests.get(client_state) or {}).get('teams_chat_id')
+    if not chat_id:
+        WEBHOOK_NOTIFICATIONS.labels(result="untracked").inc()
+        return True
+    # Only a notification that passed the clientState (and validationTokens) checks shows Graph can reach us
+    webhook_monitor.delivered(message_id)
+    # Redeliveries and messages another worker is already handling stop here
+    key = dedup_key(client_state, message_id)
+    if not message_dedup.claim(key):
+        if message_dedup.is_in_flight(key):
+            # Acking would lose the message if the attempt in flight fails; have Graph redeliver it instead
+            WEBHOOK_NOTIFICATIONS.labels(result="in_flight").inc()
+            return False
+        WEBHOOK_NOTIFICATIONS.labels(result="duplicate").inc()
+        return True
+    encrypted_content = notification.get('encryptedContent')
+    if encrypted_content and RICH_NOTIFICATIONS and trusted:
+        # Rich notification: the message is embedded, no Graph fetch needed
+        queued = notification_pool.submit_keyed(
+            client_state, decrypt_and_process_chat_message, client_state, message_id, encrypted_content
+        )
+    else:
+        # The fetch starts once the pool accepts the task, so a rejected notification costs no Graph call;
+        # the workers' concurrent fetches still share $batch calls
+        fetch = afetch_and_process_chat_message if SERVER_MODE == 'async' else fetch_and_process_chat_message
+        queued = notification_pool.submit_keyed(client_state, fetch, client_state, message_id)
+    if not queued:
+        message_dedup.release(key)
+    WEBHOOK_NOTIFICATIONS.labels(result="queued" if queued else "rejected").inc()
+    return queued
+
+@app.route('/api/notifications/lifecycle', methods=['POST'])
+@metrics.timed(WEBHOOK_SECONDS.labels(endpoint="lifecycle"))
+def handle_lifecycle_notifications():
+    """
+    Webhook endpoint for Microsoft Graph subscription lifecycle events
+    """
+    if request.args.get('validationToken'):
+        return request.args.get('validationToken'), 200, {'Content-Type': 'text/plain'}
+    
+    payload = request.get_json(silent=True) or {}
+    for notification in payload.get('value', []):
+        subscription_id = notification.get('subscriptionId')
+        event = notification.get('lifecycleEvent')
         client_state = notification.get('clientState')
-        resource_data = notification.get('resourceData', {})
         
-        # Check if this is a message in a tracked chat
-        if client_state in active_requests:
-            # Get the message details from Microsoft Graph
-            fetch_and_process_chat_message(client_state, resource_data.get('id'))
+        # Only act on subscriptions we created
+        if subscription_id in shared_subscriptions:
+            if client_state != SHARED_SUBSCRIPTION_CLIENT_STATE:
+                continue
+        elif client_state not in active_requests.find_by_subscription(subscription_id):
+            # A spare chat's subscription has the spare's request ID as clientState
+            spare = warm_chat_pool.find_by_subscription(subscription_id) if warm_chat_pool else None
+            if spare is None or client_state != spare['request_id']:
+                continue
+        
+        log.info(f"Lifecycle event {event} for subscription {subscription_id}")
+        if event == 'reauthorizationRequired':
+            # Renewing the subscription also reauthorizes it
+            subscription_scheduler.renew_now(subscription_id)
+        elif event == 'subscriptionRemoved':
+            subscription_scheduler.untrack(subscription_id)
+            intake_pool.submit(replace_lost_subscription, subscription_id)
+        elif event == 'missed':
+            log.warning(f"Graph reports missed notifications for subscription {subscription_id}")
+            webhook_monitor.mark_unreachable("Graph reported missed notifications")
     
     return jsonify({}), 202
 
+@tracing.traced()
 def fetch_and_process_chat_message(request_id, message_id):
     """
-    Fetch a specific message from a Teams chat and process it
+    Fetch a specific message from a Teams chat (through graph_batcher, so
+    concurrent fetches share $batch calls) and process it.
+    The caller has claimed the message in message_dedup; the claim is
+    released if the fetch fails so a redelivered notification can retry.
     """
-    # Skip already processed messages
-    if request_id in active_requests and message_id in active_requests[request_id].get('processed_messages', set()):
-        print(f"Skipping already processed message {message_id} for request {request_id}")
+    key = dedup_key(request_id, message_id)
+    request_data = active_requests.get(request_id)
+    if not request_data or not request_data.get('teams_chat_id'):
+        message_dedup.release(key)
         return
+    chat_id = request_data['teams_chat_id']
     
-    access_token = get_access_token()
-    if not access_token:
-        print("Failed to get token for fetching message")
+    try:
+        pending_response = graph_batcher.get(f"/chats/{chat_id}/messages/{message_id}")
+        with tracing.span("graph_batch_wait"):
+            response = pending_response.result(timeout=GRAPH_BATCH_TIMEOUT)
+        process_fetched_message(request_id, message_id, response)
+    except Exception as e:
+        log.error(f"Exception fetching message: {str(e)}")
+        message_dedup.release(key)
+
+async def afetch_and_process_chat_message(request_id, message_id):
+    """
+    fetch_and_process_chat_message for async mode: the $batch fetch is
+    awaited on the Graph event loop, and only the store work takes a thread
+    """
+    with tracing.trace("fetch_and_process_chat_message", request_id=request_id):
+        key = dedup_key(request_id, message_id)
+        try:
+            request_data = await asyncio.to_thread(active_requests.get, request_id)
+            if not request_data or not request_data.get('teams_chat_id'):
+                await asyncio.to_thread(message_dedup.release, key)
+                return
+            chat_id = request_data['teams_chat_id']
+            pending_response = graph_batcher.get(f"/chats/{chat_id}/messages/{message_id}")
+            with tracing.span("graph_batch_wait"):
+                # Shielded so a timeout doesn't cancel the batcher's future under it
+                response = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(pending_response)),
+                                                  GRAPH_BATCH_TIMEOUT)
+            await asyncio.to_thread(process_fetched_message, request_id, message_id, response)
+        except Exception as e:
+            log.error(f"Exception fetching message: {str(e)}")
+            await asyncio.to_thread(message_dedup.release, key)
+
+def process_fetched_message(request_id, message_id, response):
+    """Process a fetched message, or release its claim if the fetch failed"""
+    key = dedup_key(request_id, message_id)
+    if response is None:
+        log.warning("Failed to get token for fetching message")
+        message_dedup.release(key)
         return
     
-    chat_id = active_requests[request_id]['teams_chat_id']
-    
+    if response.status_code == 200:
+        process_chat_message(request_id, message_id, response.json())
+    else:
+        log.error(f"Error fetching message: {response.status_code}", request_id=request_id,
+                  message_id=message_id, response=response.text)
+        message_dedup.release(key)
+
+@tracing.traced()
+def decrypt_and_process_chat_message(request_id, message_id, encrypted_content):
+    """
+    Process a message embedded in a rich notification.
+    Falls back to fetching it from Graph if it can't be decrypted.
+    """
     try:
-        response = requests.get(
-            f"https://graph.microsoft.com/v1.0/chats/{chat_id}/messages/{message_id}",
-            headers={"Authorization": f"Bearer {access_token}"}
-        )
-        
-        if response.status_code == 200:
-            message_data = response.json()
-            
-            # Skip processing if this is the initial message we sent
-            if message_id == active_requests[request_id].get('initial_message_id'):
-                return
-            
-            # Extract the message content - strip HTML if present
-            content = message_data.get('body', {}).get('content', '')
-            # Very basic HTML stripping - in production you'd want a proper HTML parser
-            if message_data.get('body', {}).get('contentType') == 'html':
-                import re
-                # Try to extract just the message text (skip the "From [username]:" part)
-                user_message_match = re.search(r'<p><strong>From.*?:</strong>\s*(.*?)</p>', content)
-                if user_message_match:
-                    # This is a message from the user that we sent to Teams
-                    # We should skip it since we already show it in the UI
-                    print(f"Skipping user message echo: {user_message_match.group(1)}")
-                    
-                    # Still mark as processed
-                    if 'processed_messages' not in active_requests[request_id]:
-                        active_requests[request_id]['processed_messages'] = set()
-                    active_requests[request_id]['processed_messages'].add(message_id)
-                    return
-                
-                # For other HTML messages, strip tags
-                content = re.sub(r'<[^>]+>', '', content)
-            
-            from_user = message_data.get('from', {}).get('user', {}).get('displayName', 'Support Agent')
-            
-            # Update request status
-            active_requests[request_id]['status'] = 'responded'
-            
-            # Prepare response data
-            response_data = {
-                'requestId': request_id,
-                'message': content,
-                'responderName': from_user,
-                'timestamp': datetime.now().isoformat()
-            }
-            
-            # Send response via WebSocket
-            socketio.emit('support_response', response_data, room=request_id)
-            
-            # Mark this message as processed to avoid duplicates
-            if 'processed_messages' not in active_requests[request_id]:
-                active_requests[request_id]['processed_messages'] = set()
-            active_requests[request_id]['processed_messages'].add(message_id)
-            
-            print(f"Processed message from {from_user} for request {request_id}")
-        else:
-            print(f"Error fetching message: {response.status_code}")
-            print(f"Response: {response.text}")
+        message_data = decrypt_notification_content(notification_key_ring, encrypted_content)
+    except NotificationDecryptionError as e:
+        log.warning(f"Could not decrypt notification for message {message_id}: {str(e)}")
+        fetch_and_process_chat_message(request_id, message_id)
+        return
+    process_claimed_message(request_id, message_id, message_data)
+
+def process_claimed_message(request_id, message_id, message_data):
+    """
+    process_chat_message for a message that's already in hand, releasing the
+    claim if it fails so a redelivery (or the next poll) can try again
+    """
+    try:
+        process_chat_message(request_id, message_id, message_data)
     except Exception as e:
-        print(f"Exception fetching message: {str(e)}")
+        log.error(f"Exception processing message {message_id}: {str(e)}", request_id=request_id)
+        message_dedup.release(dedup_key(request_id, message_id))
+
+def queue_polled_message(request_id, message_id, message_data):
+    """
+    Queue a message found by delta polling, unless a webhook already delivered it
+    """
+    key = dedup_key(request_id, message_id)
+    if not message_dedup.claim(key):
+        return
+    # Polled messages join the same per-request queue as webhook notifications
+    if not notification_pool.submit_keyed(request_id, process_claimed_message, request_id, message_id, message_data):
+        message_dedup.release(key)
+
+@tracing.traced()
+def process_chat_message(request_id, message_id, message_data):
+    """
+    Forward a Teams chat message to the customer, skipping our own messages.
+    The caller has claimed the message in message_dedup.
+    """
+    key = dedup_key(request_id, message_id)
+    request_data = active_requests.get(request_id)
+    if request_data is None:
+        message_dedup.release(key)
+        return
+    
+    # Skip processing if this is the initial message we sent
+    if message_id == request_data.get('initial_message_id'):
+        message_dedup.complete(key)
+        return
+    
+    # Extract the message content - strip HTML if present
+    content = message_data.get('body', {}).get('content', '')
+    # Very basic HTML stripping - in production you'd want a proper HTML parser
+    if message_data.get('body', {}).get('contentType') == 'html':
+        # Try to extract just the message text (skip the "From [username]:" part)
+        user_message_match = re.search(r'<p><strong>From.*?:</strong>\s*(.*?)</p>', content)
+        if user_message_match:
+            # This is a message from the user that we sent to Teams
+            # We should skip it since we already show it in the UI
+            log.debug(f"Skipping user message echo: {user_message_match.group(1)}")
+            
+            # Still mark as processed
+            message_dedup.complete(key)
+            return
+        
+        # For other HTML messages, strip tags
+        content = re.sub(r'<[^>]+>', '', content)
+    
+    from_user = (message_data.get('from') or {}).get('user', {}).get('displayName', 'Support Agent')
+    
+    # Update request status
+    active_requests.update(request_id, status='responded')
+    update_queue_view(request_id, status='responded')
+    
+    # Prepare response data
+    response_data = {
+        'requestId': request_id,
+        'message': content,
+        'responderName': from_user,
+        'timestamp': datetime.now().isoformat()
+    }
+    
+    # Send response via WebSocket
+    emit_conversation_event(request_id, 'support_response', response_data)
+    observe_reply_delivery(message_data)
+    
+    # Mark this message as processed to avoid duplicates
+    message_dedup.complete(key)
+    
+    log.info(f"Processed message from {from_user} for request {request_id}")
+
+def observe_reply_delivery(message_data):
+    """Time from the agent posting in Teams to the customer's socket emit"""
+    created = parse_graph_datetime(message_data.get('createdDateTime'))
+    if created is not None:
+        REPLY_DELIVERY_SECONDS.observe(max(0.0, (datetime.now(timezone.utc) - created).total_seconds()))
+
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 30))
+
+@app.route('/api/admin/traces', methods=['GET'])
+@admin_only
+def trace_report():
+    """
+    Span trees recorded for ?requestId=..., or the most recent traces
+    (?limit=20, ?minMs=1000 for only the slow ones)
+    """
+    request_id = request.args.get('requestId')
+    if request_id:
+        return jsonify({'requestId': request_id, 'traces': tracing.traces(request_id)}), 200
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), 500))
+        min_ms = float(request.args.get('minMs', 0))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'limit and minMs must be numbers'}), 400
+    return jsonify({'traces': tracing.recent_traces(limit=limit, min_ms=min_ms), 'stats': tracing.tracing_stats()}), 200
+
+@app.route('/api/admin/profile', methods=['POST'])
+@admin_only
+def profile_process():
+    """
+    Sample every thread of this worker for ?seconds=10 (every ?interval=0.005s)
+    and return folded stacks for flamegraph.pl or speedscope.
+    ?idle=1 keeps threads that are only waiting.
+    """
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = float(request.args.get('interval', 0.005))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'seconds and interval must be numbers'}), 400
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+    interval = max(0.001, min(interval, 1.0))
+    try:
+        folded, samples = profiler.sample(seconds, interval, include_idle=request.args.get('idle') == '1')
+    except profiler.ProfilerBusy as e:
+        return jsonify({'success': False, 'message': str(e)}), 409
+    log.info(f"Profiled worker {WORKER_INDEX} for {seconds}s ({samples} samples)")
+    return folded, 200, {'Content-Type': 'text/plain; charset=utf-8', 'X-Profile-Samples': str(samples)}
+
+@app.route('/api/admin/breakers', methods=['GET'])
+@admin_only
+def breaker_status():
+    """
+    State of the circuit breaker for each Graph operation
+    """
+    return jsonify(graph_client.breaker_report()), 200
+
+@app.route('/api/admin/breakers/<name>/reset', methods=['POST'])
+@admin_only
+def reset_breaker(name):
+    """
+    Close a breaker by hand, e.g. after fixing credentials
+    """
+    breaker = graph_breakers.get(name)
+    if breaker is None:
+        return jsonify({'success': False, 'message': f'Unknown breaker {name}'}), 404
+    breaker.reset()
+    return jsonify(breaker.stats()), 200
+
+@app.route('/api/queue', methods=['GET'])
+@agent_only
+def queue_snapshot():
+    """
+    One page of the support queue, oldest first: ?status=pending&limit=50&cursor=...
+    Pass nextCursor back for the following page. Dashboards then follow
+    'version' with deltas from the agent namespace instead of polling.
+    """
+    try:
+        limit = int(request.args.get('limit', QUEUE_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'limit must be a number'}), 400
+    limit = max(1, min(limit, QUEUE_PAGE_MAX))
+    return jsonify(queue_view.snapshot(
+        status=request.args.get('status'), limit=limit, cursor=request.args.get('cursor')
+    )), 200
+
+@app.route('/api/graph/stats', methods=['GET'])
+@admin_only
+def graph_stats():
+    """
+    Per-endpoint latency, retry and error counts for Graph calls
+    """
+    return jsonify(graph_client.latency_report()), 200
+
+def socket_rooms():
+    """Rooms of the default namespace; every connected socket also has a room of its own"""
+    return socketio.server.manager.rooms.get('/', {})
+
+def connected_sockets():
+    return len(socket_rooms().get(None, ()))
+
+def live_rooms():
+    rooms = socket_rooms()
+    return len(rooms) - (None in rooms) - connected_sockets()
+
+metrics.gauge("process_resident_memory_bytes", "Resident memory of this worker").set_function(metrics.resident_memory_bytes)
+metrics.gauge("active_requests", "Conversations held by the conversation store").set_function(lambda: active_requests.count())
+metrics.gauge("socketio_connected_sockets", "Connected Socket.IO clients").set_function(connected_sockets)
+metrics.gauge("socketio_live_rooms", "Request rooms with at least one connected client").set_function(live_rooms)
+metrics.gauge("intake_queue_depth", "Support intake tasks waiting for a worker").set_function(lambda: intake_pool.depth())
+metrics.gauge("notification_queue_depth", "Notifications waiting for a worker").set_function(lambda: notification_pool.depth())
+
+@app.route('/metrics', methods=['GET'])
+@metrics_only
+def prometheus_metrics():
+    """
+    Prometheus scrape endpoint for this worker
+    """
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+@app.route('/api/workers/stats', methods=['GET'])
+@admin_only
+def worker_stats():
+    """
+    Queue depth and queue latency of the background worker pools
+    """
+    return jsonify({
+        'intake': intake_pool.stats(),
+        'notifications': notification_pool.stats(),
+        'graph_batch': graph_batcher.stats(),
+        'subscriptions': subscription_scheduler.stats(),
+        'polling': delta_poller.stats(),
+        'message_dedup': message_dedup.stats(),
+        'support_directory': support_directory.stats(),
+        'warm_chat_pool': warm_chat_pool.stats() if warm_chat_pool else None,
+        'outbound_messages': outbound_messages.stats(),
+        'conversations': active_requests.stats(),
+        'support_idempotency': support_idempotency.stats(),
+        'event_log': event_log.stats(),
+        'queue_view': queue_view.stats(),
+        'logging': logging_stats(),
+        'tracing': tracing.tracing_stats(),
+        'webhook_healthy': webhook_monitor.healthy
+    }), 200
 
 @socketio.on('connect')
 def handle_connect():
     """Handle WebSocket connection"""
-    print('Client connected')
+    log.debug('Client connected')
+
+def registration_events(request_id, last_seq=None):
+    """
+    (event, payload) pairs to send a client that just joined a request's room:
+    progress events may have been emitted before it joined.
+    A client that sends the seq of the last event it received gets everything
+    after it in one 'support_replay'; the summary below is only added when
+    the replay can't be complete.
+    """
+    events = []
+    position = intake_pool.position(request_id)
+    if position is not None:
+        events.append(('support_queue', queue_position_event(request_id, position)))
+    try:
+        last_seq = int(last_seq) if last_seq is not None else None
+    except (TypeError, ValueError):
+        last_seq = None
+    if last_seq is not None:
+        missed, complete = event_log.since(request_id, max(0, last_seq))
+        events.append(('support_replay', {
+            'requestId': request_id,
+            'events': missed,
+            'lastSeq': missed[-1]['seq'] if missed else event_log.last_seq(request_id),
+            'complete': complete,
+            'timestamp': datetime.now().isoformat()
+        }))
+        if complete:
+            return events
+    request_data = active_requests.get(request_id) or {}
+    provisioning = request_data.get('provisioning')
+    if provisioning:
+        events.append(('support_status', {
+            'requestId': request_id,
+            'status': provisioning,
+            'timestamp': datetime.now().isoformat()
+        }))
+
+    # If there's already an update, send it immediately
+    if request_data.get('status') == 'responded':
+        events.append(('support_response', {
+            'requestId': request_id,
+            'message': 'A response has already been provided. Please check your history.',
+            'responderName': 'System',
+            'timestamp': datetime.now().isoformat()
+        }))
+    return events
 
 @socketio.on('register')
 def handle_register(data):
@@ -591,16 +1670,9 @@ def handle_register(data):
     if request_id:
         # Join a room specific to this request ID
         join_room(request_id)
-        print(f'Client joined room: {request_id}')
-        
-        # If there's already an update, send it immediately
-        if request_id in active_requests and active_requests[request_id]['status'] == 'responded':
-            emit('support_response', {
-                'requestId': request_id,
-                'message': 'A response has already been provided. Please check your history.',
-                'responderName': 'System',
-                'timestamp': datetime.now().isoformat()
-            })
+        log.debug(f'Client joined room: {request_id}')
+        for event, payload in registration_events(request_id, data.get('lastSeq')):
+            emit(event, payload)
 
 @socketio.on('user_message_echo')
 def handle_user_message(data):
@@ -612,7 +1684,48 @@ def handle_user_message(data):
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle WebSocket disconnection"""
-    print('Client disconnected')
+    log.debug('Client disconnected')
+
+def queue_subscription_events(data):
+    """
+    (event, payload) pairs for an agent dashboard subscribing to the queue:
+    the deltas after the 'sinceVersion' it already has, or a first snapshot
+    page when it has none or it's too far behind. Live 'queue_delta' events
+    follow; the dashboard skips any with a version it already has.
+    """
+    since = data.get('sinceVersion')
+    if since is not None:
+        try:
+            since = int(since)
+            changes, complete = queue_view.changes_since(since)
+        except (TypeError, ValueError):
+            complete = False
+        if complete:
+            return [('queue_changes', {
+                'changes': changes,
+                'version': changes[-1]['version'] if changes else since
+            })]
+    try:
+        limit = max(1, min(int(data.get('limit') or QUEUE_PAGE_SIZE), QUEUE_PAGE_MAX))
+    except (TypeError, ValueError):
+        limit = QUEUE_PAGE_SIZE
+    return [('queue_snapshot', queue_view.snapshot(status=data.get('status'), limit=limit))]
+
+@socketio.on('connect', namespace=AGENT_NAMESPACE)
+def handle_agent_connect(auth=None):
+    """Accept an agent dashboard only with the agent token"""
+    if not agent_socket_authorized(auth, request.headers.get('Authorization')):
+        log.warning('Rejected agent dashboard without a valid token')
+        return False
+    log.debug('Agent dashboard connected')
+
+@socketio.on('queue_subscribe', namespace=AGENT_NAMESPACE)
+def handle_queue_subscribe(data):
+    """Stream queue changes to an agent dashboard, starting from a snapshot or its last version"""
+    # Join first so no delta falls between the snapshot and the live stream
+    join_room(QUEUE_ROOM)
+    for event, payload in queue_subscription_events(data or {}):
+        emit(event, payload)
 
 # Add this handler to your Flask backend
 
@@ -623,56 +1736,219 @@ def handle_unregister(data):
     if request_id:
         # Leave the room for this request ID
         leave_room(request_id)
-        print(f'Client left room: {request_id}')
+        log.debug(f'Client left room: {request_id}')
         
         # Confirm to the client
         emit('unregister_success', {'requestId': request_id})
         
-        # Optionally, you can update any server-side state about active requests
-        # For example, you might want to mark this request as "concluded" or "aborted"
-        if request_id in active_requests:
-            active_requests[request_id]['status'] = 'aborted'
+        end_conversation(request_id)
     else:
         emit('error', {'message': 'No request ID provided for unregistration'})
 
+def end_conversation(request_id):
+    """The customer ended the conversation: mark it aborted and stop watching the chat"""
+    # Archived conversations are already over; only live ones need ending
+    if active_requests.update(request_id, status='aborted'):
+        update_queue_view(request_id, status='aborted')
+        release_subscription(request_id)
+        delta_poller.untrack(request_id)
+        outbound_messages.forget(request_id)
+
+def use_socketio_server(server):
+    """
+    Send the app's emits and background tasks through another Socket.IO
+    server (async_server.py) instead of the Flask-SocketIO one.
+    """
+    global socketio
+    socketio = server
+
 def get_user_id_by_email(email):
-    access_token = get_access_token()
-    if not access_token:
-        print("Failed to get access token")
+    return get_user_ids_by_email([email])[0]
+
+def get_user_ids_by_email(emails):
+    """
+    Look up Azure AD user IDs for several emails in a single $batch call.
+    Returns the IDs in the same order, with None for lookups that failed.
+    """
+    pending = [graph_batcher.get(f"/users/{email}") for email in emails]
+    user_ids = []
+    for email, pending_response in zip(emails, pending):
+        try:
+            response = pending_response.result(timeout=GRAPH_BATCH_TIMEOUT)
+        except Exception as e:
+            log.error(f"Exception fetching user {email}: {str(e)}")
+            user_ids.append(None)
+            continue
+        if response is None:
+            log.warning("Failed to get access token")
+            user_ids.append(None)
+        elif response.status_code == 200:
+            user_ids.append(response.json()['id'])
+        else:
+            log.error(f"Error fetching user: {response.status_code}", response=response.text)
+            user_ids.append(None)
+    return user_ids
+
+# Support team members by email (comma separated in SUPPORT_TEAM_EMAILS).
+# Their user IDs are resolved in the background and cached in SUPPORT_TEAM_CACHE,
+# so startup never waits on Graph.
+SUPPORT_TEAM_EMAILS = [
+    email.strip() for email in
+    os.getenv("SUPPORT_TEAM_EMAILS", "david@canopywave.com,yachal@canopywave.com").split(",")
+    if email.strip()
+]
+# How long provisioning waits for the first resolution when there's no cache yet
+SUPPORT_DIRECTORY_WAIT = int(os.getenv("SUPPORT_DIRECTORY_WAIT", 30))
+support_directory = SupportDirectory(
+    get_user_ids_by_email,
+    SUPPORT_TEAM_EMAILS,
+    cache_file=os.getenv("SUPPORT_TEAM_CACHE", "support_team_cache.json"),
+    ttl=int(os.getenv("SUPPORT_TEAM_TTL", 3600))
+)
+support_directory.start()
+
+log.info(f"Configured support team: {', '.join(SUPPORT_TEAM_EMAILS)}")
+
+def create_spare_chat():
+    """
+    Create a chat (and in per_chat mode its subscription) for the warm pool.
+    The request ID is chosen now because it's the subscription's clientState.
+    """
+    members = support_chat_members()
+    if not members:
         return None
-    
-    response = requests.get(
-        f"https://graph.microsoft.com/v1.0/users/{email}",
-        headers={"Authorization": f"Bearer {access_token}"}
-    )
-    
-    if response.status_code == 200:
-        user_data = response.json()
-        return user_data['id']
-    else:
-        print(f"Error fetching user: {response.status_code}")
-        print(f"Response: {response.text}")
+    request_id = str(uuid.uuid4())
+    chat_response = graph_client.post("/chats", operation='chat_create', json={
+        "chatType": "group",
+        "topic": "Support Request (waiting for customer)",
+        "members": members
+    })
+    if chat_response is None or chat_response.status_code not in (201, 200):
+        log.error(f"Error creating spare chat: {chat_response.status_code if chat_response is not None else 'no token'}")
         return None
+    chat_info = chat_response.json()
+    spare = {'request_id': request_id, 'chat_id': chat_info['id'], 'web_url': chat_info.get('webUrl')}
+    if SUBSCRIPTION_MODE == 'per_chat':
+        spare['subscription_id'] = post_chat_subscription(request_id, chat_info['id'])
+        if not spare['subscription_id']:
+            retire_spare_chat(spare)
+            return None
+    log.info(f"Spare chat {chat_info['id']} ready")
+    return spare
 
-# Example usage:
-# Get support team members by email
-support_email_1 = "david@canopywave.com"
-support_email_2 = "yachal@canopywave.com"
+def retire_spare_chat(spare):
+    """Delete an unused spare chat and its subscription"""
+    if spare.get('subscription_id'):
+        subscription_scheduler.delete(spare['subscription_id'])
+    response = graph_client.delete(f"/chats/{spare['chat_id']}")
+    if response is not None and response.status_code not in (200, 204, 404):
+        log.error(f"Error deleting spare chat {spare['chat_id']}: {response.status_code}")
 
-user_id_1 = get_user_id_by_email(support_email_1)
-user_id_2 = get_user_id_by_email(support_email_2)
+def reclaim_spare_chat(spare):
+    """Renew the subscription of a spare chat a previous run left in the shared pool"""
+    subscription_id = spare.get('subscription_id')
+    if subscription_id and not subscription_scheduler.is_tracked(subscription_id):
+        # Expiry is unknown after a restart, so renew right away
+        subscription_scheduler.track(subscription_id, datetime.now(timezone.utc))
 
-SUPPORT_TEAM_MEMBERS = [
-    {"@odata.type": "microsoft.graph.aadUserConversationMember", "userId": user_id_1},
-    {"@odata.type": "microsoft.graph.aadUserConversationMember", "userId": user_id_2}
-]
+# Warm pool of pre-created support chats; WARM_CHAT_POOL_SIZE=0 (default) disables it.
+# With the sqlite store the spares are shared by all workers (worker 0 tops them up)
+# and kept across restarts; otherwise each worker keeps its own and deletes them on exit.
+WARM_CHAT_POOL_SIZE = int(os.getenv("WARM_CHAT_POOL_SIZE", 0))
+warm_chat_pool = None
+if WARM_CHAT_POOL_SIZE > 0:
+    warm_chat_pool = create_warm_chat_pool(
+        CONVERSATION_STORE,
+        CONVERSATION_DB,
+        create_spare_chat,
+        retire_spare_chat,
+        target=WARM_CHAT_POOL_SIZE,
+        max_size=int(os.getenv("WARM_CHAT_POOL_MAX", 10)),
+        max_idle=int(os.getenv("WARM_CHAT_MAX_IDLE", 4 * 3600)),
+        on_reclaim=reclaim_spare_chat
+    )
+    # The debug reloader's watcher process never serves, so it mustn't create chats
+    if not RELOADER_PARENT and (WORKER_INDEX == 0 or not warm_chat_pool.persistent):
+        warm_chat_pool.start()
+
+def shutdown():
+    """Clean up before the process exits: an in-process warm pool deletes its spare chats"""
+    if warm_chat_pool:
+        warm_chat_pool.stop()
+
+atexit.register(shutdown)
 
-print(f"Configured support team members: {SUPPORT_TEAM_MEMBERS}")
+def restore_conversations():
+    """
+    Resume renewals and polling for conversations persisted by a previous run
+    """
+    restored = 0
+    for status in ('pending', 'responded'):
+        for request_id in active_requests.find_by_status(status):
+            request_data = active_requests.get(request_id) or {}
+            if request_data.get('teams_chat_id'):
+                delta_poller.track(request_id, request_data['teams_chat_id'])
+            subscription_id = request_data.get('subscription_id')
+            if subscription_id and not subscription_scheduler.is_tracked(subscription_id):
+                # Expiry is unknown after a restart, so renew right away
+                subscription_scheduler.track(subscription_id, datetime.now(timezone.utc))
+            restored += 1
+    if restored:
+        log.info(f"Restored {restored} conversation(s) from the {CONVERSATION_STORE} store")
+
+def retire_conversation(request_id):
+    """
+    Stop all background work for a conversation that's leaving the live store
+    """
+    release_subscription(request_id)
+    delta_poller.untrack(request_id)
+    outbound_messages.forget(request_id)
+    event_log.forget(request_id)
+    publish_queue_delta(queue_view.remove(request_id))
+
+def resume_conversation(request_id):
+    """
+    Restart replies for a conversation paged back in from the archive
+    """
+    request_data = active_requests.get(request_id) or {}
+    update_queue_view(
+        request_id, status=request_data.get('status'), provisioning=request_data.get('provisioning'),
+        userName=request_data.get('user_name'), userEmail=request_data.get('user_email'),
+        createdAt=request_data.get('timestamp')
+    )
+    chat_id = request_data.get('teams_chat_id')
+    if request_data.get('status') == 'aborted' or not chat_id:
+        return
+    delta_poller.track(request_id, chat_id)
+    if not request_data.get('subscription_id'):
+        create_chat_subscription(request_id, chat_id)
+
+# Each worker can also serve its metrics on a port of its own, so a scraper
+# sees every worker rather than whichever one the shared socket picked
+METRICS_PORT = os.getenv("METRICS_PORT")
+if METRICS_PORT:
+    metrics.serve(int(METRICS_PORT) + WORKER_INDEX, tokens=(METRICS_TOKEN, ADMIN_TOKEN))
+
+# Only one worker resumes background renewals and polling after a restart,
+# and archives finished conversations
+if WORKER_INDEX == 0:
+    restore_conversations()
+    if isinstance(active_requests, ArchivingConversationStore):
+        active_requests.start()
 
 if __name__ == '__main__':
-    # Run the Flask app with SocketIO
-    port = int(os.environ.get('PORT', 5001))
-    socketio.run(app, host='0.0.0.0', port=port, debug=True)
+    # scale_out.py stops workers with SIGTERM; exit normally so shutdown() runs
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if os.environ.get('SCALE_OUT_FD'):
+        # Started by scale_out.py: serve on the listening socket shared by all workers
+        from werkzeug.serving import make_server
+        server = make_server('0.0.0.0', 0, app, threaded=True, fd=int(os.environ['SCALE_OUT_FD']))
+        log.info(f"Worker {WORKER_INDEX} (pid {os.getpid()}) serving")
+        server.serve_forever()
+    else:
+        # Run the Flask app with SocketIO
+        port = int(os.environ.get('PORT', 5001))
+        socketio.run(app, host='0.0.0.0', port=port, debug=True)
 
 
 
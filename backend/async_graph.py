@@ -0,0 +1,297 @@
+"""
+Async Graph Client
+
+GraphClient's drop-in replacement for the async serving mode
+(SERVER_MODE=async, see async_server.py). Every Graph call runs as a
+coroutine on one asyncio event loop using httpx, sharing one connection pool:
+
+- await client.call(client.arequest(...)) from any event loop
+- client.request(...) (and get/post/patch/delete) from worker threads,
+  which block until the coroutine's result is ready
+
+Only callers that await arequest() avoid holding a thread for the call.
+In app.py those are the intake and notification pools' tasks (provisioning,
+follow-up sends, message fetches) and the $batch sender; the
+schedulers and lifecycle handling use the blocking methods, so each of
+their in-flight calls still costs a thread, as with GraphClient.
+
+Retries, Retry-After handling, circuit breakers and latency stats behave
+exactly as in GraphClient, and both share the same stats.
+
+Chat messages are sent through the msgraph SDK (GraphServiceClient) when it
+is installed, authenticated with tokens from the shared TokenManager.
+"""
+
+import asyncio
+import threading
+import time
+from urllib.parse import urlparse
+
+import httpx
+
+from circuit_breaker import CircuitOpenError
+from graph_client import (
+    GraphClient, GRAPH_BASE_URL, DEFAULT_TIMEOUT, IDEMPOTENT_METHODS, endpoint_name, is_retryable
+)
+from token_manager import APP_ONLY, DELEGATED
+from structured_log import get_logger
+
+try:
+    from kiota_abstractions.api_error import APIError
+    from kiota_abstractions.authentication import (
+        AccessTokenProvider, AllowedHostsValidator, BaseBearerTokenAuthenticationProvider
+    )
+    from msgraph import GraphRequestAdapter, GraphServiceClient
+    from msgraph.generated.models.body_type import BodyType
+    from msgraph.generated.models.chat_message import ChatMessage
+    from msgraph.generated.models.item_body import ItemBody
+    HAS_MSGRAPH = True
+except ImportError:
+    HAS_MSGRAPH = False
+
+
+log = get_logger(__name__)
+
+
+class TokenUnavailable(Exception):
+    """TokenManager had no token for the SDK request"""
+
+
+if HAS_MSGRAPH:
+    class TokenManagerTokenProvider(AccessTokenProvider):
+        """Feeds the msgraph SDK tokens from TokenManager instead of its own credential"""
+
+        def __init__(self, graph_client, auth):
+            self.graph_client = graph_client
+            self.auth = auth
+            self._hosts = AllowedHostsValidator([urlparse(graph_client.base_url).hostname])
+
+        async def get_authorization_token(self, uri, additional_authentication_context={}):
+            breaker, token_breaker = self.graph_client._admit(None)
+            try:
+                access_token = await asyncio.to_thread(self.graph_client._token, self.auth)
+            except Exception as e:
+                self.graph_client._token_failed(breaker, token_breaker, e)
+                raise
+            if not self.graph_client._token_acquired(breaker, token_breaker, self.auth, access_token):
+                raise TokenUnavailable(self.auth)
+            return access_token
+
+        def get_allowed_hosts_validator(self):
+            return self._hosts
+
+
+class AsyncGraphClient(GraphClient):
+    """
+    GraphClient whose requests run on a private asyncio event loop.
+    The loop runs on one daemon thread started with the client.
+    """
+
+    def __init__(self, token_manager, base_url=GRAPH_BASE_URL, timeout=DEFAULT_TIMEOUT,
+                 max_retries=3, backoff_factor=0.5, max_backoff=30, pool_size=100, breakers=None):
+        super().__init__(token_manager, base_url=base_url, timeout=timeout, max_retries=max_retries,
+                         backoff_factor=backoff_factor, max_backoff=max_backoff, pool_size=1,
+                         breakers=breakers)
+        self.pool_size = pool_size
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="graph-async-loop", daemon=True)
+        self._thread.start()
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+        self._sdk_clients = {}
+
+    def run(self, coroutine):
+        """Schedule a coroutine on the Graph loop; returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    async def call(self, coroutine):
+        """Await a Graph coroutine from another event loop"""
+        return await asyncio.wrap_future(self.run(coroutine))
+
+    def _wait(self, coroutine):
+        """Run a Graph coroutine for a worker thread, which stays blocked until it finishes"""
+        if threading.current_thread() is self._thread:
+            coroutine.close()
+            raise RuntimeError("blocking Graph call made on the Graph event loop; await it instead")
+        return self.run(coroutine).result()
+
+    def _httpx_timeout(self, timeout):
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        return httpx.Timeout(read, connect=connect)
+
+    # Blocking API, same as GraphClient
+
+    def request(self, method, path, auth=APP_ONLY, timeout=None, headers=None, operation=None, **kwargs):
+        return self._wait(self.arequest(method, path, auth=auth, timeout=timeout, headers=headers,
+                                        operation=operation, **kwargs))
+
+    # Async API
+
+    async def arequest(self, method, path, auth=APP_ONLY, timeout=None, headers=None, operation=None, **kwargs):
+        """
+        Coroutine version of GraphClient.request; returns an httpx.Response
+        (status_code, json(), text and headers work as with requests).
+        """
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            breaker, token_breaker = self._admit(operation)
+            try:
+                access_token = await asyncio.to_thread(self._token, auth)
+            except Exception as e:
+                self._token_failed(breaker, token_breaker, e)
+                raise
+            if not self._token_acquired(breaker, token_breaker, auth, access_token):
+                outcome = "no_token"
+                log.warning(f"Failed to get {auth} token for {path}")
+                return None
+
+            try:
+                response = await self._asend(method, path, auth, access_token, timeout, headers, **kwargs)
+            except Exception as e:
+                self._record_outcome(breaker, error=e)
+                raise
+            self._record_outcome(breaker, response.status_code)
+            outcome = str(response.status_code)
+            return response
+        except CircuitOpenError:
+            outcome = "circuit_open"
+            raise
+        finally:
+            self.record_operation(operation, started, outcome)
+
+    async def _asend(self, method, path, auth, access_token, timeout, headers, **kwargs):
+        method = method.upper()
+        url = self._url(path)
+        endpoint = endpoint_name(method, url)
+        idempotent = method in IDEMPOTENT_METHODS
+
+        request_headers = {"Authorization": f"Bearer {access_token}"}
+        if headers:
+            request_headers.update(headers)
+        if "data" in kwargs:
+            # requests' raw body argument
+            kwargs["content"] = kwargs.pop("data")
+
+        started = time.monotonic()
+        attempt = 0
+        refreshed_token = False
+        while True:
+            try:
+                response = await self._client.request(
+                    method, url,
+                    headers=request_headers,
+                    timeout=self._httpx_timeout(timeout or self.timeout),
+                    **kwargs
+                )
+            except (httpx.TransportError, httpx.TimeoutException) as e:
+                # Only retry non-idempotent calls if the request never reached Graph
+                can_retry = idempotent or isinstance(e, httpx.ConnectTimeout)
+                if not can_retry or attempt >= self.max_retries:
+                    self.record_latency(endpoint, time.monotonic() - started, None, attempt)
+                    raise
+                delay = self._backoff(attempt)
+                log.warning(f"Graph {endpoint} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            if response.status_code == 401 and not refreshed_token:
+                # Token was revoked or expired early; fetch a new one and try once more
+                refreshed_token = True
+                self.token_manager.invalidate(auth, access_token)
+                access_token = await asyncio.to_thread(self._token, auth)
+                if access_token:
+                    request_headers["Authorization"] = f"Bearer {access_token}"
+                    continue
+
+            if is_retryable(response.status_code, response.headers, idempotent) and attempt < self.max_retries:
+                delay = self._backoff(attempt, response)
+                log.warning(f"Graph {endpoint} returned {response.status_code}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            self.record_latency(endpoint, time.monotonic() - started, response.status_code, attempt)
+            return response
+
+    async def aget(self, path, **kwargs):
+        return await self.arequest("GET", path, **kwargs)
+
+    async def apost(self, path, **kwargs):
+        return await self.arequest("POST", path, **kwargs)
+
+    # Chat messages through the msgraph SDK
+
+    def _sdk_client(self, auth):
+        client = self._sdk_clients.get(auth)
+        if client is None:
+            provider = BaseBearerTokenAuthenticationProvider(TokenManagerTokenProvider(self, auth))
+            adapter = GraphRequestAdapter(provider)
+            adapter.base_url = self.base_url
+            client = self._sdk_clients[auth] = GraphServiceClient(request_adapter=adapter)
+        return client
+
+    async def asend_chat_message(self, chat_id, body, auth=DELEGATED):
+        """
+        Post a message to a chat. body is a Graph itemBody dict
+        ({'contentType': 'html'|'text', 'content': ...}).
+        Returns {'id', 'webUrl'} of the new message, or None on failure.
+        """
+        if not HAS_MSGRAPH:
+            response = await self.arequest("POST", f"/chats/{chat_id}/messages", auth=auth,
+                                           json={"body": body}, operation='message_send')
+            if response is None or response.status_code not in (200, 201):
+                return None
+            return response.json()
+
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            result, outcome = await self._sdk_send(chat_id, body, auth)
+            return result
+        except CircuitOpenError:
+            outcome = "circuit_open"
+            raise
+        finally:
+            self.record_operation('message_send', started, outcome)
+
+    async def _sdk_send(self, chat_id, body, auth):
+        """(message dict or None, outcome)"""
+        breaker = self.breakers.get('message_send')
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(breaker.name)
+        message = ChatMessage(body=ItemBody(
+            content=body.get('content', ''),
+            content_type=BodyType.Html if body.get('contentType') == 'html' else BodyType.Text
+        ))
+        endpoint = "POST /chats/{id}/messages"
+        started = time.monotonic()
+        try:
+            result = await self._sdk_client(auth).chats.by_chat_id(chat_id).messages.post(message)
+        except APIError as e:
+            status_code = e.response_status_code or 500
+            self.record_latency(endpoint, time.monotonic() - started, status_code, 0)
+            self._record_outcome(breaker, status_code)
+            log.error(f"Error sending message: {status_code} {str(e)}", chat_id=chat_id)
+            return None, str(status_code)
+        except TokenUnavailable:
+            log.warning(f"Failed to get {auth} token for chat {chat_id} message")
+            if breaker is not None:
+                breaker.release()
+            return None, "no_token"
+        except CircuitOpenError:
+            if breaker is not None:
+                breaker.release()
+            raise
+        except Exception as e:
+            self.record_latency(endpoint, time.monotonic() - started, None, 0)
+            self._record_outcome(breaker, error=e)
+            raise
+        self.record_latency(endpoint, time.monotonic() - started, 201, 0)
+        self._record_outcome(breaker, 201)
+        return {'id': result.id, 'webUrl': result.web_url}, "201"
+
+    def send_chat_message(self, chat_id, body, auth=DELEGATED):
+        return self._wait(self.asend_chat_message(chat_id, body, auth=auth))
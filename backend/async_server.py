@@ -0,0 +1,199 @@
+"""
+Async Server
+
+Runs the backend on an asyncio event loop (uvicorn + python-socketio's
+AsyncServer) instead of Flask-SocketIO's thread-per-connection server, so
+idle websockets don't each pin a thread:
+
+- Socket.IO connections are coroutines; event handlers that touch the
+  stores hop to a thread with asyncio.to_thread
+- Graph HTTP runs as coroutines on AsyncGraphClient's loop (app.py switches
+  to it when SERVER_MODE=async), and chat messages go through the msgraph SDK
+- the intake and notification pools run their Graph work as coroutines
+  on that loop (WorkerPool.use_event_loop): provisioning a support chat,
+  fetching a notified message and sending follow-ups await the calls, so
+  a pool thread is only held while it hands the task over, and
+  INTAKE_CONCURRENCY / NOTIFICATION_CONCURRENCY bound the work in flight
+
+What stays threaded: the Flask routes are served through an ASGI adapter
+that runs each request on a thread, though they only validate and queue
+work; store and Socket.IO calls inside the coroutines hop to threads; and
+the subscription scheduler, delta poller and lifecycle handling still use
+the blocking client methods.
+
+    python async_server.py                # PORT, default 5001
+    SERVER_MODE=async python scale_out.py --workers 4
+
+Needs uvicorn, httpx and asgiref. SOCKETIO_MESSAGE_QUEUE may be a
+sqlite:/// or redis:// URL.
+"""
+
+import asyncio
+import contextvars
+import os
+import threading
+import time
+
+os.environ.setdefault("SERVER_MODE", "async")
+
+import socketio
+import uvicorn
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+
+import app as backend
+from socketio_queue import create_async_client_manager
+from structured_log import get_logger
+
+
+log = get_logger(__name__)
+
+
+class SocketIOBridge:
+    """
+    The subset of Flask-SocketIO's API app.py uses (emit,
+    start_background_task, sleep), callable from any thread and forwarded
+    to the AsyncServer's event loop.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.loop = None
+
+    def bind(self, loop):
+        self.loop = loop
+
+    def emit(self, event, *args, room=None, to=None, namespace=None, skip_sid=None, **kwargs):
+        data = args[0] if args else None
+        coroutine = self.server.emit(event, data, to=to or room, namespace=namespace, skip_sid=skip_sid)
+        if self.loop is None:
+            coroutine.close()
+            log.warning(f"Dropped '{event}' emitted before the server started")
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.loop.create_task(coroutine)
+        else:
+            asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def start_background_task(self, target, *args, **kwargs):
+        thread = threading.Thread(target=target, args=args, kwargs=kwargs, daemon=True)
+        thread.start()
+        return thread
+
+    def sleep(self, seconds=0):
+        time.sleep(seconds)
+
+
+class ConcurrentWsgiToAsgi(WsgiToAsgi):
+    """
+    WsgiToAsgi runs every WSGI call on one shared thread; a context per
+    request gives each its own, so a slow route doesn't stall the others.
+    """
+
+    async def __call__(self, scope, receive, send):
+        # On a keep-alive connection uvicorn may start the next request from
+        # within the previous response's send(), whose context still points at
+        # that request's finished AsyncToSync executor; start from a clean one
+        await contextvars.Context().run(asyncio.ensure_future, self._serve(scope, receive, send))
+
+    async def _serve(self, scope, receive, send):
+        async with ThreadSensitiveContext():
+            await super().__call__(scope, receive, send)
+
+
+sio = socketio.AsyncServer(
+    async_mode='asgi',
+    cors_allowed_origins='*',
+    client_manager=create_async_client_manager(backend.SOCKETIO_MESSAGE_QUEUE)
+)
+bridge = SocketIOBridge(sio)
+backend.use_socketio_server(bridge)
+
+
+async def on_startup():
+    bridge.bind(asyncio.get_running_loop())
+    log.info(f"Worker {backend.WORKER_INDEX} (pid {os.getpid()}) serving async")
+
+
+@sio.event
+async def connect(sid, environ):
+    """Handle WebSocket connection"""
+    log.debug('Client connected')
+
+
+@sio.event
+async def register(sid, data):
+    """Register client to a specific support request room"""
+    request_id = data.get('requestId')
+    if request_id:
+        await sio.enter_room(sid, request_id)
+        log.debug(f'Client joined room: {request_id}')
+        # The conversation store may hit SQLite or the archive
+        for event, payload in await asyncio.to_thread(backend.registration_events, request_id, data.get('lastSeq')):
+            await sio.emit(event, payload, to=sid)
+
+
+@sio.event
+async def user_message_echo(sid, data):
+    """Echo the user's message back to confirm receipt"""
+    room = data.get('requestId')
+    if room:
+        await sio.emit('user_message_echo', data, room=room)
+
+
+@sio.event
+async def disconnect(sid, *args):
+    """Handle WebSocket disconnection"""
+    log.debug('Client disconnected')
+
+
+@sio.on('connect', namespace=backend.AGENT_NAMESPACE)
+async def agent_connect(sid, environ, auth=None):
+    """Accept an agent dashboard only with the agent token"""
+    if not backend.agent_socket_authorized(auth, environ.get('HTTP_AUTHORIZATION')):
+        log.warning('Rejected agent dashboard without a valid token')
+        return False
+    log.debug('Agent dashboard connected')
+
+
+@sio.on('queue_subscribe', namespace=backend.AGENT_NAMESPACE)
+async def queue_subscribe(sid, data):
+    """Stream queue changes to an agent dashboard, starting from a snapshot or its last version"""
+    await sio.enter_room(sid, backend.QUEUE_ROOM, namespace=backend.AGENT_NAMESPACE)
+    for event, payload in await asyncio.to_thread(backend.queue_subscription_events, data or {}):
+        await sio.emit(event, payload, to=sid, namespace=backend.AGENT_NAMESPACE)
+
+
+@sio.event
+async def unregister(sid, data):
+    """Unregister client from a specific support request room when ending a conversation"""
+    request_id = data.get('requestId')
+    if request_id:
+        await sio.leave_room(sid, request_id)
+        log.debug(f'Client left room: {request_id}')
+        await sio.emit('unregister_success', {'requestId': request_id}, to=sid)
+        await asyncio.to_thread(backend.end_conversation, request_id)
+    else:
+        await sio.emit('error', {'message': 'No request ID provided for unregistration'}, to=sid)
+
+
+async def on_shutdown():
+    # uvicorn re-raises SIGTERM once it has shut down, so atexit handlers never run
+    await asyncio.to_thread(backend.shutdown)
+
+
+asgi_app = socketio.ASGIApp(sio, other_asgi_app=ConcurrentWsgiToAsgi(backend.app), on_startup=on_startup,
+                            on_shutdown=on_shutdown)
+
+
+if __name__ == '__main__':
+    if os.environ.get('SCALE_OUT_FD'):
+        # Started by scale_out.py: serve on the listening socket shared by all workers
+        uvicorn.run(asgi_app, fd=int(os.environ['SCALE_OUT_FD']), log_level="warning")
+    else:
+        port = int(os.environ.get('PORT', 5001))
+        uvicorn.run(asgi_app, host='0.0.0.0', port=port, log_level="info")
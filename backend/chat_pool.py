@@ -0,0 +1,310 @@
+"""
+Warm Chat Pool
+
+Creating a Teams group chat is the slowest step in provisioning a support
+request. WarmChatPool keeps `target` spare chats (created together with
+their message subscriptions) ready in the background. A new request claims
+a spare instead of creating a chat, and the pool tops itself back up.
+
+Spares that stay unclaimed for longer than max_idle are retired and
+replaced, so the team isn't left with a pile of stale empty chats.
+
+The Graph work is done by the callbacks passed in:
+- create_spare() returns a dict with at least 'chat_id' and 'request_id'
+  (or None on failure)
+- retire_spare(spare) cleans up a spare that's being thrown away
+- on_reclaim(spare) picks up a spare left by a previous run (SQLite only)
+
+WarmChatPool keeps its spares in memory, so each worker process has its own
+pool and stop() retires them when the process exits; otherwise a restart
+would leave their chats and subscriptions behind in Teams.
+SQLiteWarmChatPool keeps them in a table shared by every worker: any worker
+can claim, one worker refills, and the spares outlive restarts, so the next
+run reclaims them instead of creating new ones.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from structured_log import get_logger
+
+
+log = get_logger(__name__)
+
+
+class WarmChatPool:
+    # Spares survive the process (SQLite), so stop() leaves them for the next run
+    persistent = False
+    # Seconds between refill checks besides claims and expiries; None if every claim wakes the refill
+    check_interval = None
+
+    def __init__(self, create_spare, retire_spare, target=2, max_size=10, max_idle=4 * 3600,
+                 retry_interval=30, on_reclaim=None):
+        self.create_spare = create_spare
+        self.retire_spare = retire_spare
+        self.on_reclaim = on_reclaim
+        self.target = min(target, max_size)
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.retry_interval = retry_interval
+
+        # Oldest spare first
+        self._spares = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.claimed = 0
+        self.missed = 0
+        self.created = 0
+        self.retired = 0
+        self.failures = 0
+
+    # Storage: the in-process deque here, a shared table in SQLiteWarmChatPool
+
+    def _pop_oldest(self):
+        with self._lock:
+            return self._spares.popleft() if self._spares else None
+
+    def _add(self, spare, front=False):
+        """Store a spare; False if the pool is already at max_size (front: a returned spare, always kept)"""
+        with self._lock:
+            if front:
+                self._spares.appendleft(spare)
+            elif len(self._spares) >= self.max_size:
+                return False
+            else:
+                self._spares.append(spare)
+            return True
+
+    def _remove(self, spare):
+        """Take this spare out of the pool; False if someone else already did"""
+        with self._lock:
+            try:
+                self._spares.remove(spare)
+                return True
+            except ValueError:
+                return False
+
+    def spares(self):
+        """The spares waiting to be claimed, oldest first"""
+        with self._lock:
+            return list(self._spares)
+
+    def size(self):
+        with self._lock:
+            return len(self._spares)
+
+    def claim(self):
+        """Take the oldest spare chat, or None if the pool is empty"""
+        spare = self._pop_oldest()
+        with self._lock:
+            if spare is None:
+                self.missed += 1
+            else:
+                self.claimed += 1
+        self._wakeup.set()
+        return spare
+
+    def return_spare(self, spare):
+        """Put back a claimed spare that ended up unused"""
+        self._add(spare, front=True)
+        with self._lock:
+            self.claimed -= 1
+
+    def find_by_subscription(self, subscription_id):
+        """The waiting spare using this subscription, or None"""
+        return next((s for s in self.spares() if s.get('subscription_id') == subscription_id), None)
+
+    def discard_subscription(self, subscription_id):
+        """
+        Drop the spare using this subscription (e.g. Graph removed it).
+        Returns True if it belonged to a spare.
+        """
+        spare = self.find_by_subscription(subscription_id)
+        if spare is None or not self._remove(spare):
+            return False
+        self._retire(spare, 'subscription lost')
+        self._wakeup.set()
+        return True
+
+    def _retire(self, spare, reason):
+        log.info(f"Retiring spare chat {spare['chat_id']} ({reason})")
+        try:
+            self.retire_spare(spare)
+        except Exception as e:
+            log.error(f"Exception retiring spare chat {spare['chat_id']}: {str(e)}")
+        self.retired += 1
+
+    def _retire_idle(self):
+        cutoff = time.time() - self.max_idle
+        for spare in self.spares():
+            if spare['created_at'] < cutoff and self._remove(spare):
+                self._retire(spare, 'unused for too long')
+
+    def _refill(self):
+        """Create spares up to target; returns False if a creation failed"""
+        while not self._stop.is_set() and self.size() < self.target:
+            try:
+                spare = self.create_spare()
+            except Exception as e:
+                log.error(f"Exception creating spare chat: {str(e)}")
+                spare = None
+            if not spare:
+                self.failures += 1
+                return False
+            spare.setdefault('created_at', time.time())
+            if not self._add(spare):
+                self._retire(spare, 'pool full')
+                return True
+            self.created += 1
+        return True
+
+    def start(self):
+        if self.target <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        if self.on_reclaim:
+            for spare in self.spares():
+                try:
+                    self.on_reclaim(spare)
+                except Exception as e:
+                    log.error(f"Exception reclaiming spare chat {spare['chat_id']}: {str(e)}")
+        self._thread = threading.Thread(target=self._run, name="warm-chat-pool", daemon=True)
+        self._thread.start()
+
+    def stop(self, retire=None):
+        """
+        Stop refilling and clean up the remaining spares, unless they're
+        persistent (or retire=False) and the next run will reclaim them.
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if retire is None:
+            retire = not self.persistent
+        if retire:
+            for spare in self.spares():
+                if self._remove(spare):
+                    self._retire(spare, 'pool stopped')
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._retire_idle()
+            healthy = self._refill()
+            spares = self.spares()
+            oldest = spares[0]['created_at'] if spares else None
+            # Wake up for the next claim, the next spare to expire, or to retry a failure
+            delay = self.retry_interval if not healthy else self.max_idle
+            if oldest is not None:
+                delay = min(delay, oldest + self.max_idle - time.time())
+            if self.check_interval is not None:
+                delay = min(delay, self.check_interval)
+            self._wakeup.wait(timeout=max(delay, 1))
+            self._wakeup.clear()
+
+    def stats(self):
+        return {
+            'spares': self.size(),
+            'target': self.target,
+            'max_size': self.max_size,
+            'claimed': self.claimed,
+            'missed': self.missed,
+            'created': self.created,
+            'retired': self.retired,
+            'failures': self.failures,
+        }
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS warm_chats (
+    request_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    spare TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_warm_chats_created ON warm_chats (created_at);
+"""
+
+
+class SQLiteWarmChatPool(WarmChatPool):
+    """
+    Spares shared by every worker through a SQLite table. Claims take the
+    oldest row in an IMMEDIATE transaction, so two workers never get the
+    same spare. Only the worker that start()s the pool refills it; claims
+    made elsewhere are noticed within check_interval.
+    """
+
+    persistent = True
+
+    def __init__(self, path, create_spare, retire_spare, check_interval=5, **options):
+        super().__init__(create_spare, retire_spare, **options)
+        self.path = path
+        self.check_interval = check_interval
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._connection()
+        connection.executescript(_SCHEMA)
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _pop_oldest(self):
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT request_id, spare FROM warm_chats ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute("DELETE FROM warm_chats WHERE request_id = ?", (row[0],))
+        return json.loads(row[1])
+
+    def _add(self, spare, front=False):
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            if not front:
+                count = connection.execute("SELECT COUNT(*) FROM warm_chats").fetchone()[0]
+                if count >= self.max_size:
+                    return False
+            # A returned spare keeps its created_at, so it's claimed first again
+            connection.execute(
+                "INSERT OR REPLACE INTO warm_chats (request_id, created_at, spare) VALUES (?, ?, ?)",
+                (spare['request_id'], spare['created_at'], json.dumps(spare))
+            )
+        return True
+
+    def _remove(self, spare):
+        connection = self._connection()
+        with connection:
+            cursor = connection.execute("DELETE FROM warm_chats WHERE request_id = ?", (spare['request_id'],))
+        return cursor.rowcount == 1
+
+    def spares(self):
+        rows = self._connection().execute("SELECT spare FROM warm_chats ORDER BY created_at").fetchall()
+        self._connection().commit()
+        return [json.loads(row[0]) for row in rows]
+
+    def size(self):
+        count = self._connection().execute("SELECT COUNT(*) FROM warm_chats").fetchone()[0]
+        self._connection().commit()
+        return count
+
+
+def create_warm_chat_pool(backend, path, create_spare, retire_spare, **options):
+    """Shared (sqlite) pool when conversations are shared, otherwise in-process"""
+    if backend == 'sqlite':
+        return SQLiteWarmChatPool(path or "conversations.db", create_spare, retire_spare, **options)
+    return WarmChatPool(create_spare, retire_spare, **options)
@@ -0,0 +1,127 @@
+"""
+Circuit Breakers
+
+One breaker per Graph operation (token, chat creation, message send,
+subscriptions). After failure_threshold consecutive failures a breaker
+opens and calls fail immediately with CircuitOpenError, so callers go
+straight to their fallback instead of waiting on a degraded Graph. After
+reset_timeout seconds it goes half-open and lets a limited number of probe
+calls through; a successful probe closes it again, a failed one reopens it.
+
+Only failures that say something about Graph's health should be recorded
+(5xx, throttling that outlasted retries, network errors, no token), not
+4xx responses caused by the request itself.
+"""
+
+import threading
+import time
+
+from structured_log import get_logger
+
+
+log = get_logger(__name__)
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an operation whose breaker is open"""
+
+    def __init__(self, name):
+        super().__init__(f"circuit '{name}' is open")
+        self.name = name
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, half_open_max_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.rejected = 0
+        self.successes = 0
+        self.failures = 0
+        self.last_failure = None
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now):
+        """Caller holds the lock."""
+        if self._state == OPEN and now - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def is_open(self):
+        """Cheap check for callers that want to skip work entirely; doesn't use up a probe"""
+        return self.state == OPEN
+
+    def allow(self):
+        """True if a call may go ahead; every allowed call must be followed by a record_* or release()"""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def release(self):
+        """An allowed call was abandoned without reaching Graph"""
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def record_success(self):
+        with self._lock:
+            self.successes += 1
+            self._failures = 0
+            if self._state != CLOSED:
+                log.info(f"Circuit {self.name} closed")
+            self._state = CLOSED
+
+    def record_failure(self, reason=None):
+        with self._lock:
+            self.failures += 1
+            self.last_failure = reason
+            self._failures += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self.opened += 1
+                log.warning(f"Circuit {self.name} opened ({reason})")
+
+    def reset(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            return {
+                'state': state,
+                'consecutive_failures': self._failures,
+                'retry_in': round(max(0.0, self._opened_at + self.reset_timeout - now), 1) if state == OPEN else None,
+                'opened': self.opened,
+                'rejected': self.rejected,
+                'successes': self.successes,
+                'failures': self.failures,
+                'last_failure': self.last_failure,
+            }
@@ -0,0 +1,416 @@
+"""
+Conversation Archive
+
+Keeps the live conversation store small. Conversations that are over
+(terminal status) or have been idle past a TTL are moved out of the store
+into an append-only, compressed archive on disk, and paged back in when
+the customer returns.
+
+ConversationArchive writes each record as one zlib-compressed frame,
+appended to segment files that roll over at segment_bytes:
+
+    [4 bytes payload length][2 bytes id length][request id][compressed JSON]
+
+The request_id -> (segment, offset) index lives in a SQLite file next to
+the segments (index.db), not in memory, so a long retention period doesn't
+grow the process. Every process writes its own frames into it as it
+appends; frames nobody indexed (segments written before the index existed,
+or a crash between the write and the index update) are picked up by scanning
+each segment from where the last scan stopped, at most once per
+refresh_interval: an unknown ID (anyone can send one) is answered from the
+index instead of listing the directory each time. Segments older than
+retention_days are deleted together with their index entries.
+
+ArchivingConversationStore wraps any ConversationStore with the eviction
+timer and the page-in path. Looking a conversation up (get) never brings it
+back; only resume() does, for a customer who returned to it.
+"""
+
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+from conversation_store import ConversationStore
+from structured_log import get_logger
+
+
+log = get_logger(__name__)
+
+
+_HEADER = struct.Struct('>IH')
+_SEGMENT_SUFFIX = '.arc'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archived (
+    request_id TEXT PRIMARY KEY,
+    segment TEXT NOT NULL,
+    position INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_archived_segment ON archived (segment);
+CREATE TABLE IF NOT EXISTS segments (
+    segment TEXT PRIMARY KEY,
+    scanned INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+# A scan only replaces an entry with a later frame; segment names sort by creation time
+_INDEX_SCANNED_FRAME = """
+INSERT INTO archived (request_id, segment, position) VALUES (?, ?, ?)
+ON CONFLICT (request_id) DO UPDATE SET segment = excluded.segment, position = excluded.position
+WHERE excluded.segment > archived.segment
+   OR (excluded.segment = archived.segment AND excluded.position > archived.position)
+"""
+
+
+class ConversationArchive:
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, retention_days=30, refresh_interval=5):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_days = retention_days
+        self.refresh_interval = refresh_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self.index_path = os.path.join(directory, 'index.db')
+        self._local = threading.local()
+        connection = self._connection()
+        connection.executescript(_SCHEMA)
+        connection.commit()
+        self._lock = threading.Lock()
+        self._current = None
+        self._caught_up_at = None
+        self.archived = 0
+        self.loaded = 0
+        self.catch_ups = 0
+        self._catch_up()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.index_path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(_SEGMENT_SUFFIX))
+
+    def _path(self, segment):
+        return os.path.join(self.directory, segment)
+
+    def _scan(self, segment):
+        """Index frames appended to a segment since the last scan. Caller holds the lock."""
+        connection = self._connection()
+        row = connection.execute("SELECT scanned FROM segments WHERE segment = ?", (segment,)).fetchone()
+        connection.commit()
+        offset = row[0] if row else 0
+        frames = []
+        try:
+            with open(self._path(segment), 'rb') as f:
+                f.seek(offset)
+                while True:
+                    header = f.read(_HEADER.size)
+                    if len(header) < _HEADER.size:
+                        break
+                    payload_length, id_length = _HEADER.unpack(header)
+                    request_id = f.read(id_length)
+                    if len(request_id) < id_length:
+                        break
+                    f.seek(payload_length, os.SEEK_CUR)
+                    end = f.tell()
+                    if end > os.fstat(f.fileno()).st_size:
+                        # Frame still being written by another process
+                        break
+                    frames.append((request_id.decode(), segment, offset))
+                    offset = end
+        except FileNotFoundError:
+            pass
+        with connection:
+            connection.executemany(_INDEX_SCANNED_FRAME, frames)
+            connection.execute(
+                "INSERT INTO segments (segment, scanned) VALUES (?, ?) "
+                "ON CONFLICT (segment) DO UPDATE SET scanned = max(scanned, excluded.scanned)",
+                (segment, offset)
+            )
+        return offset
+
+    def _catch_up(self, min_age=0):
+        """Index frames other processes appended, unless we did so less than min_age seconds ago"""
+        with self._lock:
+            now = time.monotonic()
+            if self._caught_up_at is not None and now - self._caught_up_at < min_age:
+                return
+            self._caught_up_at = now
+            self.catch_ups += 1
+            for segment in self._segments():
+                self._scan(segment)
+
+    def _segment_for_write(self):
+        """Caller holds the lock."""
+        if self._current is not None:
+            try:
+                if os.path.getsize(self._path(self._current)) < self.segment_bytes:
+                    return self._current
+            except FileNotFoundError:
+                pass
+        self._current = f"{int(time.time() * 1000):015d}{_SEGMENT_SUFFIX}"
+        return self._current
+
+    def append(self, request_id, record):
+        payload = zlib.compress(json.dumps({
+            'request_id': request_id,
+            'archived_at': time.time(),
+            'record': record
+        }).encode())
+        encoded_id = request_id.encode()
+        frame = _HEADER.pack(len(payload), len(encoded_id)) + encoded_id + payload
+        with self._lock:
+            segment = self._segment_for_write()
+            # Index anything other writers added so our offset bookkeeping stays right
+            scanned = self._scan(segment)
+            with open(self._path(segment), 'ab') as f:
+                offset = f.tell()
+                f.write(frame)
+            connection = self._connection()
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO archived (request_id, segment, position) VALUES (?, ?, ?)",
+                    (request_id, segment, offset)
+                )
+                # Unless another process appended in between (a later scan picks that up)
+                if offset == scanned:
+                    connection.execute("UPDATE segments SET scanned = ? WHERE segment = ? AND scanned = ?",
+                                       (offset + len(frame), segment, offset))
+            self.archived += 1
+
+    def _lookup(self, request_id):
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT segment, position FROM archived WHERE request_id = ?", (request_id,)
+        ).fetchone()
+        connection.commit()
+        return row
+
+    def _locate(self, request_id):
+        """(segment, offset) of request_id's latest frame, or None"""
+        location = self._lookup(request_id)
+        if location is None:
+            # A miss only rescans once per refresh_interval, however many unknown IDs are asked for
+            self._catch_up(min_age=self.refresh_interval)
+            location = self._lookup(request_id)
+        return location
+
+    def __contains__(self, request_id):
+        return self._locate(request_id) is not None
+
+    def load(self, request_id):
+        """The most recently archived record for request_id, or None"""
+        location = self._locate(request_id)
+        if location is None:
+            return None
+        segment, offset = location
+        try:
+            with open(self._path(segment), 'rb') as f:
+                f.seek(offset)
+                payload_length, id_length = _HEADER.unpack(f.read(_HEADER.size))
+                f.seek(id_length, os.SEEK_CUR)
+                entry = json.loads(zlib.decompress(f.read(payload_length)))
+        except (OSError, zlib.error, ValueError) as e:
+            log.error(f"Could not read archived conversation {request_id}: {str(e)}")
+            return None
+        self.loaded += 1
+        return entry['record']
+
+    def prune(self):
+        """Delete segments past retention; returns how many were removed"""
+        cutoff = time.time() - self.retention_days * 86400
+        removed = 0
+        with self._lock:
+            for segment in self._segments():
+                if segment == self._current:
+                    continue
+                try:
+                    if os.path.getmtime(self._path(segment)) >= cutoff:
+                        continue
+                    os.remove(self._path(segment))
+                except FileNotFoundError:
+                    pass
+                connection = self._connection()
+                with connection:
+                    connection.execute("DELETE FROM archived WHERE segment = ?", (segment,))
+                    connection.execute("DELETE FROM segments WHERE segment = ?", (segment,))
+                removed += 1
+        return removed
+
+    def stats(self):
+        with self._lock:
+            segments = self._segments()
+            size = 0
+            for segment in segments:
+                try:
+                    size += os.path.getsize(self._path(segment))
+                except FileNotFoundError:
+                    pass
+            indexed = self._connection().execute("SELECT COUNT(*) FROM archived").fetchone()[0]
+            self._connection().commit()
+            return {
+                'segments': len(segments),
+                'bytes': size,
+                'indexed': indexed,
+                'archived': self.archived,
+                'loaded': self.loaded,
+                'catch_ups': self.catch_ups,
+            }
+
+
+class ArchivingConversationStore(ConversationStore):
+    """
+    A ConversationStore that moves finished and idle conversations into a
+    ConversationArchive. get() also finds archived conversations but leaves
+    them in the archive; resume() pages one back in. update() and touch()
+    only apply to live conversations.
+
+    on_evict(request_id, record) runs before a conversation leaves the store
+    (release subscriptions etc.); on_page_in(request_id, record) runs after
+    one comes back.
+    """
+
+    def __init__(self, store, archive, terminal_statuses=('aborted',), terminal_grace=300,
+                 idle_ttl=24 * 3600, interval=60, on_evict=None, on_page_in=None):
+        self.store = store
+        self.archive = archive
+        self.terminal_statuses = terminal_statuses
+        self.terminal_grace = terminal_grace
+        self.idle_ttl = idle_ttl
+        self.interval = interval
+        self.on_evict = on_evict
+        self.on_page_in = on_page_in
+
+        self._page_in_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.evicted = 0
+        self.paged_in = 0
+
+    # Store interface, delegated to the live store
+
+    def create(self, request_id, record):
+        self.store.create(request_id, record)
+
+    def get(self, request_id):
+        record = self.store.get(request_id)
+        if record is None and request_id is not None:
+            # Read-only: a lookup alone (a notification, a reconnecting socket) doesn't resume it
+            record = self.archive.load(request_id)
+        return record
+
+    def resume(self, request_id):
+        record = self.store.get(request_id)
+        if record is None and request_id is not None:
+            record = self._page_in(request_id)
+        return record
+
+    def update(self, request_id, **fields):
+        return self.store.update(request_id, **fields)
+
+    def delete(self, request_id):
+        self.store.delete(request_id)
+
+    def _find(self, field, value):
+        return self.store._find(field, value)
+
+    def touch(self, request_id):
+        self.store.touch(request_id)
+
+    def find_idle(self, before):
+        return self.store.find_idle(before)
+
+    def count(self):
+        return self.store.count()
+
+    def flush(self):
+        self.store.flush()
+
+    def __contains__(self, request_id):
+        if request_id is None:
+            return False
+        return self.store.get(request_id) is not None or request_id in self.archive
+
+    # Lifecycle
+
+    def _page_in(self, request_id):
+        with self._page_in_lock:
+            record = self.store.get(request_id)
+            if record is not None:
+                return record
+            record = self.archive.load(request_id)
+            if record is None:
+                return None
+            self.store.create(request_id, record)
+            self.paged_in += 1
+        log.info(f"Paged conversation {request_id} back in from the archive")
+        if self.on_page_in:
+            try:
+                self.on_page_in(request_id, record)
+            except Exception as e:
+                log.error(f"Exception paging in conversation {request_id}: {str(e)}")
+        return self.store.get(request_id)
+
+    def evict(self, request_id):
+        record = self.store.get(request_id)
+        if record is None:
+            return False
+        if self.on_evict:
+            try:
+                self.on_evict(request_id, record)
+            except Exception as e:
+                log.error(f"Exception evicting conversation {request_id}: {str(e)}")
+            # on_evict may have changed it (e.g. cleared the subscription)
+            record = self.store.get(request_id) or record
+        self.archive.append(request_id, record)
+        self.store.delete(request_id)
+        self.evicted += 1
+        return True
+
+    def evict_expired(self):
+        """Archive terminal conversations past the grace period and idle ones past the TTL"""
+        now = time.time()
+        candidates = set(self.store.find_idle(now - self.idle_ttl))
+        past_grace = self.store.find_idle(now - self.terminal_grace)
+        for status in self.terminal_statuses:
+            candidates |= self.store.find_by_status(status) & past_grace
+        evicted = sum(1 for request_id in candidates if self.evict(request_id))
+        if evicted:
+            log.info(f"Archived {evicted} conversation(s); {self.store.count()} still live")
+        self.archive.prune()
+        return evicted
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="conversation-archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.evict_expired()
+            except Exception as e:
+                log.error(f"Exception archiving conversations: {str(e)}")
+
+    def stats(self):
+        stats = self.store.stats()
+        stats.update({
+            'evicted': self.evicted,
+            'paged_in': self.paged_in,
+            'archive': self.archive.stats(),
+        })
+        return stats
@@ -0,0 +1,484 @@
+"""
+Conversation Store
+
+State for every support conversation (request details, Teams chat,
+subscription and status), behind one small interface with two backends:
+
+- MemoryConversationStore: dicts in this process, lost on restart
+- SQLiteConversationStore: durable SQLite database in WAL mode, shared by
+  every worker process on the host
+
+Both keep secondary indexes by teams_chat_id, status and subscription_id so
+lookups from webhooks never scan all conversations. Records are returned
+as plain dict copies; change them with update().
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from structured_log import get_logger
+
+
+log = get_logger(__name__)
+
+
+INDEXED_FIELDS = ('teams_chat_id', 'status', 'subscription_id')
+
+# Fields every conversation record may have; the memory store keeps them in slots
+RECORD_FIELDS = (
+    'user_name', 'user_email', 'message', 'timestamp', 'status', 'provisioning',
+    'teams_chat_id', 'subscription_id', 'initial_message_id', 'teams_chat_link'
+)
+_RECORD_FIELD_SET = frozenset(RECORD_FIELDS)
+_INTERNED_FIELDS = frozenset(('status', 'provisioning'))
+
+
+class ConversationStore:
+    """Interface shared by the store backends"""
+
+    def create(self, request_id, record):
+        raise NotImplementedError
+
+    def get(self, request_id):
+        """Return a copy of the record, or None"""
+        raise NotImplementedError
+
+    def resume(self, request_id):
+        """
+        Record of a conversation its customer has come back to. Stores that
+        archive conversations (ArchivingConversationStore) make it live again.
+        """
+        return self.get(request_id)
+
+    def update(self, request_id, **fields):
+        """Set fields on an existing record; returns False if it doesn't exist"""
+        raise NotImplementedError
+
+    def delete(self, request_id):
+        raise NotImplementedError
+
+    def find_by_chat(self, chat_id):
+        """request_id of the conversation using this Teams chat, or None"""
+        ids = self._find('teams_chat_id', chat_id)
+        return next(iter(ids), None)
+
+    def find_by_status(self, status):
+        return self._find('status', status)
+
+    def find_by_subscription(self, subscription_id):
+        return self._find('subscription_id', subscription_id)
+
+    def _find(self, field, value):
+        raise NotImplementedError
+
+    def touch(self, request_id):
+        """Record activity on a conversation without changing it"""
+        raise NotImplementedError
+
+    def find_idle(self, before):
+        """request_ids of conversations not changed or touched since `before` (epoch seconds)"""
+        raise NotImplementedError
+
+    def count(self):
+        raise NotImplementedError
+
+    def stats(self):
+        return {'conversations': self.count()}
+
+    def flush(self):
+        """Make buffered writes durable (no-op for the memory backend)"""
+
+    def close(self):
+        self.flush()
+
+    def __contains__(self, request_id):
+        return request_id is not None and self.get(request_id) is not None
+
+
+class _CompactRecord:
+    """
+    Fixed-field form of a conversation kept by the memory store.
+    Slots avoid a per-record __dict__; fields outside RECORD_FIELDS go in extra.
+    """
+
+    __slots__ = RECORD_FIELDS + ('extra', 'updated_at')
+
+    def __init__(self, record):
+        for field in RECORD_FIELDS:
+            setattr(self, field, None)
+        self.extra = None
+        self.updated_at = time.time()
+        self.set(record)
+
+    def set(self, fields):
+        for field, value in fields.items():
+            if field in _RECORD_FIELD_SET:
+                if field in _INTERNED_FIELDS and isinstance(value, str):
+                    # A handful of distinct values shared by every record
+                    value = sys.intern(value)
+                setattr(self, field, value)
+            else:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[field] = value
+        self.updated_at = time.time()
+
+    def get(self, field):
+        if field in _RECORD_FIELD_SET:
+            return getattr(self, field)
+        return self.extra.get(field) if self.extra else None
+
+    def to_dict(self):
+        record = {field: getattr(self, field) for field in RECORD_FIELDS if getattr(self, field) is not None}
+        if self.extra:
+            record.update(self.extra)
+        return record
+
+    def size(self):
+        """Approximate bytes held by this record (shared interned strings excluded)"""
+        total = sys.getsizeof(self)
+        for field in RECORD_FIELDS:
+            value = getattr(self, field)
+            if value is not None and field not in _INTERNED_FIELDS:
+                total += sys.getsizeof(value)
+        if self.extra:
+            total += sys.getsizeof(self.extra)
+            total += sum(sys.getsizeof(value) for value in self.extra.values())
+        return total
+
+
+class MemoryConversationStore(ConversationStore):
+    """In-process store; fast, but state is lost on restart"""
+
+    def __init__(self):
+        # request_id -> _CompactRecord
+        self._records = {}
+        self._indexes = {field: {} for field in INDEXED_FIELDS}
+        self._lock = threading.RLock()
+
+    def _index_add(self, request_id, record):
+        for field in INDEXED_FIELDS:
+            value = record.get(field)
+            if value is not None:
+                self._indexes[field].setdefault(value, set()).add(request_id)
+
+    def _index_remove(self, request_id, record):
+        for field in INDEXED_FIELDS:
+            value = record.get(field)
+            ids = self._indexes[field].get(value)
+            if ids is not None:
+                ids.discard(request_id)
+                if not ids:
+                    del self._indexes[field][value]
+
+    def create(self, request_id, record):
+        with self._lock:
+            if request_id in self._records:
+                self._index_remove(request_id, self._records[request_id])
+            compact = _CompactRecord(record)
+            self._records[request_id] = compact
+            self._index_add(request_id, compact)
+
+    def get(self, request_id):
+        with self._lock:
+            record = self._records.get(request_id)
+            return record.to_dict() if record is not None else None
+
+    def update(self, request_id, **fields):
+        with self._lock:
+            record = self._records.get(request_id)
+            if record is None:
+                return False
+            self._index_remove(request_id, record)
+            record.set(fields)
+            self._index_add(request_id, record)
+            return True
+
+    def touch(self, request_id):
+        with self._lock:
+            record = self._records.get(request_id)
+            if record is not None:
+                record.updated_at = time.time()
+
+    def delete(self, request_id):
+        with self._lock:
+            record = self._records.pop(request_id, None)
+            if record is not None:
+                self._index_remove(request_id, record)
+
+    def _find(self, field, value):
+        with self._lock:
+            return set(self._indexes[field].get(value, ()))
+
+    def find_idle(self, before):
+        with self._lock:
+            return {request_id for request_id, record in self._records.items() if record.updated_at < before}
+
+    def count(self):
+        with self._lock:
+            return len(self._records)
+
+    def stats(self):
+        with self._lock:
+            count = len(self._records)
+            record_bytes = sys.getsizeof(self._records)
+            for request_id, record in self._records.items():
+                record_bytes += sys.getsizeof(request_id) + record.size()
+            index_bytes = 0
+            for index in self._indexes.values():
+                index_bytes += sys.getsizeof(index)
+                index_bytes += sum(sys.getsizeof(ids) for ids in index.values())
+        total = record_bytes + index_bytes
+        return {
+            'conversations': count,
+            'bytes': total,
+            'bytes_per_conversation': round(total / count) if count else None,
+        }
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    request_id TEXT PRIMARY KEY,
+    status TEXT,
+    teams_chat_id TEXT,
+    subscription_id TEXT,
+    updated_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_chat ON conversations (teams_chat_id);
+CREATE INDEX IF NOT EXISTS idx_conversations_status ON conversations (status);
+CREATE INDEX IF NOT EXISTS idx_conversations_subscription ON conversations (subscription_id);
+CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations (updated_at);
+"""
+
+# Marks a conversation deleted in the write buffer
+_DELETED = object()
+
+
+class _Change:
+    """
+    What the next flush has to do to a conversation's row: replace (or
+    delete) it, set some fields, or only refresh updated_at. Immutable, so
+    the writer can tell whether a row changed again while it was flushing.
+    """
+
+    __slots__ = ('replace', 'fields', 'touch')
+
+    def __init__(self, replace=False, fields=frozenset(), touch=False):
+        self.replace = replace
+        self.fields = fields
+        self.touch = touch
+
+    def then(self, replace=False, fields=(), touch=False):
+        return _Change(self.replace or replace, self.fields | frozenset(fields), self.touch or touch)
+
+
+_NO_CHANGE = _Change()
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    Durable store backed by SQLite in WAL mode.
+    Writes are buffered and committed together by a background writer every
+    flush_interval seconds (or once batch_size changes are waiting), so a
+    burst of status changes costs one transaction instead of one fsync each.
+    Reads in this process see buffered writes immediately; other processes
+    see them after the next flush.
+    An update() only writes the fields it changed, merged into the row as it
+    is at flush time, so workers changing different fields of one
+    conversation don't overwrite each other.
+    """
+
+    def __init__(self, path, flush_interval=0.05, batch_size=200):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # request_id -> full record dict or _DELETED, for reads before the flush
+        self._pending = {}
+        # request_id -> _Change to apply at the next flush
+        self._changes = {}
+        self.flushes = 0
+        self.rows_written = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.executescript(_SCHEMA)
+        connection.commit()
+
+        self._writer = threading.Thread(target=self._write_loop, name="conversation-store-writer", daemon=True)
+        self._writer.start()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _load(self, request_id):
+        row = self._connection().execute(
+            "SELECT data FROM conversations WHERE request_id = ?", (request_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _current(self, request_id):
+        """Latest record including buffered writes. Caller holds the lock."""
+        pending = self._pending.get(request_id)
+        if pending is _DELETED:
+            return None
+        if pending is not None:
+            return pending
+        return self._load(request_id)
+
+    def _buffer(self, request_id, record=None, **change):
+        if record is not None:
+            self._pending[request_id] = record
+        self._changes[request_id] = self._changes.get(request_id, _NO_CHANGE).then(**change)
+        if len(self._changes) >= self.batch_size:
+            self._wakeup.set()
+
+    def create(self, request_id, record):
+        with self._lock:
+            self._buffer(request_id, dict(record), replace=True)
+
+    def get(self, request_id):
+        with self._lock:
+            record = self._current(request_id)
+            return dict(record) if record is not None else None
+
+    def update(self, request_id, **fields):
+        with self._lock:
+            record = self._current(request_id)
+            if record is None:
+                return False
+            record = dict(record)
+            record.update(fields)
+            self._buffer(request_id, record, fields=fields)
+            return True
+
+    def delete(self, request_id):
+        with self._lock:
+            self._buffer(request_id, _DELETED, replace=True)
+
+    def _find(self, field, value):
+        rows = self._connection().execute(
+            f"SELECT request_id FROM conversations WHERE {field} = ?", (value,)
+        ).fetchall()
+        ids = {row[0] for row in rows}
+        with self._lock:
+            # Overlay writes that haven't reached the database yet
+            for request_id, record in self._pending.items():
+                if record is not _DELETED and record.get(field) == value:
+                    ids.add(request_id)
+                else:
+                    ids.discard(request_id)
+        return ids
+
+    def touch(self, request_id):
+        with self._lock:
+            if self._current(request_id) is not None:
+                self._buffer(request_id, touch=True)
+
+    def find_idle(self, before):
+        rows = self._connection().execute(
+            "SELECT request_id FROM conversations WHERE updated_at < ?", (before,)
+        ).fetchall()
+        with self._lock:
+            # Anything with a buffered write was just changed
+            return {row[0] for row in rows if row[0] not in self._changes}
+
+    def count(self):
+        row = self._connection().execute("SELECT COUNT(*) FROM conversations").fetchone()
+        with self._lock:
+            pending_new = 0
+            for request_id, record in self._pending.items():
+                exists = self._load(request_id) is not None
+                if record is _DELETED and exists:
+                    pending_new -= 1
+                elif record is not _DELETED and not exists:
+                    pending_new += 1
+        return row[0] + pending_new
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._changes:
+                    return
+                # Keep the buffer readable until the rows are committed
+                changes = dict(self._changes)
+                pending = {request_id: self._pending.get(request_id) for request_id in changes}
+
+            now = time.time()
+            connection = self._connection()
+            with connection:
+                # Other workers can't change a row between our read and write below
+                connection.execute("BEGIN IMMEDIATE")
+                for request_id, change in changes.items():
+                    self._write(connection, request_id, change, pending[request_id], now)
+
+            with self._lock:
+                # Drop only entries that weren't changed again while we were writing
+                for request_id, change in changes.items():
+                    if self._changes.get(request_id) is change:
+                        del self._changes[request_id]
+                        self._pending.pop(request_id, None)
+            self.flushes += 1
+            self.rows_written += len(changes)
+
+    def _write(self, connection, request_id, change, record, now):
+        if change.replace:
+            if record is _DELETED or record is None:
+                connection.execute("DELETE FROM conversations WHERE request_id = ?", (request_id,))
+                return
+            data = record
+        elif change.fields:
+            row = connection.execute(
+                "SELECT data FROM conversations WHERE request_id = ?", (request_id,)
+            ).fetchone()
+            if row is None:
+                # Deleted by another worker since we read it
+                return
+            data = json.loads(row[0])
+            for field in change.fields:
+                data[field] = record.get(field)
+        else:
+            connection.execute("UPDATE conversations SET updated_at = ? WHERE request_id = ?", (now, request_id))
+            return
+        connection.execute(
+            "INSERT OR REPLACE INTO conversations "
+            "(request_id, status, teams_chat_id, subscription_id, updated_at, data) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (request_id, data.get('status'), data.get('teams_chat_id'), data.get('subscription_id'), now,
+             json.dumps(data))
+        )
+
+    def _write_loop(self):
+        while True:
+            self._wakeup.wait(timeout=self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.error(f"Exception flushing conversation store: {str(e)}")
+                time.sleep(1)
+
+
+def create_conversation_store(backend, path=None):
+    """Build the store selected by configuration ('memory' or 'sqlite')"""
+    if backend == 'sqlite':
+        return SQLiteConversationStore(path or "conversations.db")
+    if backend != 'memory':
+        log.warning(f"Unknown conversation store '{backend}', using memory")
+    return MemoryConversationStore()
@@ -0,0 +1,457 @@
+"""
+Delta Polling Fallback
+
+When Graph can't reach our notification URL, agent replies never arrive as
+webhooks. The DeltaPoller keeps a delta link per tracked Teams chat and
+polls /chats/{id}/messages/delta instead, feeding new messages into the same
+processing path the webhook uses.
+
+Chats that recently had messages are polled often; quiet chats back off
+towards idle_interval. All polls draw from one global request budget so a
+large number of open conversations can't exhaust Graph quota.
+
+WebhookMonitor decides when polling is needed: every message we post to a
+chat should come back to us as a change notification. If those echoes stop
+arriving, webhook delivery is considered down and polling switches on until
+notifications flow again. With several workers the echo usually lands on a
+different worker than the one that sent the message, so
+SQLiteWebhookMonitor keeps the expected echoes and the health flag in a
+shared table and every worker follows it.
+"""
+
+import heapq
+import os
+import sqlite3
+import threading
+import time
+
+from structured_log import get_logger
+
+
+log = get_logger(__name__)
+
+
+class WebhookMonitor:
+    """
+    Tracks whether Graph notifications are still reaching us.
+    expect() is called for each message we send, delivered() for each
+    notification received; an expectation older than timeout marks the
+    webhook as down.
+    """
+
+    def __init__(self, timeout=30, on_change=None):
+        self.timeout = timeout
+        self.on_change = on_change
+        self.healthy = True
+        self.last_delivery = None
+        self._expected = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="webhook-monitor", daemon=True)
+            self._thread.start()
+
+    def expect(self, message_id):
+        """We just posted message_id; Graph should notify us about it"""
+        if not message_id:
+            return
+        with self._lock:
+            self._expected[message_id] = time.monotonic()
+        self.start()
+
+    def delivered(self, message_id=None):
+        """A notification arrived, so the webhook is reachable"""
+        with self._lock:
+            self.last_delivery = time.time()
+            if message_id:
+                self._expected.pop(message_id, None)
+        self._set_healthy(True, "notification received")
+
+    def mark_unreachable(self, reason):
+        """Force polling on, e.g. when Graph refused to create a subscription"""
+        self._set_healthy(False, reason)
+
+    def _set_healthy(self, healthy, reason):
+        with self._lock:
+            if self.healthy == healthy:
+                return
+            self.healthy = healthy
+        log.warning(f"Webhook delivery {'restored' if healthy else 'down'}: {reason}")
+        if self.on_change:
+            self.on_change(healthy)
+
+    def _run(self):
+        while True:
+            time.sleep(min(5, self.timeout))
+            try:
+                self._check()
+            except Exception as e:
+                log.error(f"Exception checking webhook delivery: {str(e)}")
+
+    def _check(self):
+        now = time.monotonic()
+        with self._lock:
+            overdue = [m for m, sent in self._expected.items() if now - sent > self.timeout]
+            for message_id in overdue:
+                del self._expected[message_id]
+        if overdue:
+            self._set_healthy(False, f"{len(overdue)} sent message(s) never came back as notifications")
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_expected (
+    message_id TEXT PRIMARY KEY,
+    sent_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_webhook_expected_sent ON webhook_expected (sent_at);
+CREATE TABLE IF NOT EXISTS webhook_health (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    healthy INTEGER NOT NULL,
+    reason TEXT,
+    last_delivery REAL
+);
+INSERT OR IGNORE INTO webhook_health (id, healthy) VALUES (1, 1);
+"""
+
+
+class SQLiteWebhookMonitor(WebhookMonitor):
+    """
+    Webhook health shared by every worker. Expected echoes and the health
+    flag live in SQLite, so a notification received by any worker counts
+    for messages sent by all of them; each worker's monitor thread applies
+    the shared flag locally (and calls on_change) every few seconds.
+    """
+
+    # Skip rewriting last_delivery for every notification in a burst
+    DELIVERY_WRITE_INTERVAL = 1.0
+
+    def __init__(self, path, timeout=30, on_change=None):
+        super().__init__(timeout=timeout, on_change=on_change)
+        self.path = path
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._connection()
+        connection.executescript(_SCHEMA)
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def expect(self, message_id):
+        if not message_id:
+            return
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO webhook_expected (message_id, sent_at) VALUES (?, ?)",
+                (message_id, time.time())
+            )
+        self.start()
+
+    def delivered(self, message_id=None):
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            if message_id:
+                connection.execute("DELETE FROM webhook_expected WHERE message_id = ?", (message_id,))
+            connection.execute(
+                "UPDATE webhook_health SET healthy = 1, reason = ?, last_delivery = ? "
+                "WHERE id = 1 AND (healthy = 0 OR last_delivery IS NULL OR last_delivery < ?)",
+                ("notification received", now, now - self.DELIVERY_WRITE_INTERVAL)
+            )
+        with self._lock:
+            self.last_delivery = now
+        self._set_healthy(True, "notification received")
+        self.start()
+
+    def mark_unreachable(self, reason):
+        connection = self._connection()
+        with connection:
+            connection.execute("UPDATE webhook_health SET healthy = 0, reason = ? WHERE id = 1", (reason,))
+        self._set_healthy(False, reason)
+        self.start()
+
+    def _check(self):
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            overdue = connection.execute(
+                "DELETE FROM webhook_expected WHERE sent_at < ?", (now - self.timeout,)
+            ).rowcount
+            if overdue:
+                connection.execute(
+                    "UPDATE webhook_health SET healthy = 0, reason = ? WHERE id = 1 AND healthy = 1",
+                    (f"{overdue} sent message(s) never came back as notifications",)
+                )
+            healthy, reason, last_delivery = connection.execute(
+                "SELECT healthy, reason, last_delivery FROM webhook_health WHERE id = 1"
+            ).fetchone()
+        with self._lock:
+            self.last_delivery = last_delivery
+        # Another worker may have seen the webhook go down or come back
+        self._set_healthy(bool(healthy), reason or "shared webhook state changed")
+
+
+def create_webhook_monitor(backend, path=None, **options):
+    """Shared (sqlite) webhook health when conversations are shared, otherwise in-process"""
+    if backend == 'sqlite':
+        return SQLiteWebhookMonitor(path or "conversations.db", **options)
+    return WebhookMonitor(**options)
+
+
+class _ChatState:
+    __slots__ = ("request_id", "chat_id", "delta_link", "next_poll", "interval", "last_activity")
+
+    def __init__(self, request_id, chat_id, interval):
+        self.request_id = request_id
+        self.chat_id = chat_id
+        self.delta_link = None
+        self.next_poll = time.monotonic()
+        self.interval = interval
+        self.last_activity = time.monotonic()
+
+
+class DeltaPoller:
+    """
+    Poll tracked chats for new messages with delta queries.
+    on_message(request_id, message_id, message_data) is called for each new message.
+    """
+
+    def __init__(self, graph_batcher, on_message, active_interval=5, idle_interval=120,
+                 active_window=300, requests_per_minute=600, enabled=False):
+        self.graph_batcher = graph_batcher
+        self.on_message = on_message
+        self.active_interval = active_interval
+        self.idle_interval = idle_interval
+        self.active_window = active_window
+        self.requests_per_minute = requests_per_minute
+        self.enabled = enabled
+
+        self._chats = {}
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+        # Token bucket shared by every poll
+        self._tokens = float(requests_per_minute)
+        self._refilled_at = time.monotonic()
+
+        self.polls = 0
+        self.messages_found = 0
+        self.budget_waits = 0
+
+    def start(self):
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="delta-poller", daemon=True)
+            self._thread.start()
+
+    def set_enabled(self, enabled):
+        with self._cond:
+            if self.enabled == enabled:
+                return
+            self.enabled = enabled
+            if enabled:
+                # Poll everything right away; we may already have missed replies
+                now = time.monotonic()
+                for state in self._chats.values():
+                    if state.next_poll is not None:
+                        state.next_poll = now
+                self._heap = self._live_entries()
+            else:
+                # The schedule is only kept while polling; enabling rebuilds it
+                self._heap = []
+            self._cond.notify()
+        log.info(f"Delta polling {'enabled' if enabled else 'disabled'} for {len(self._chats)} chat(s)")
+        if enabled:
+            self.start()
+
+    def track(self, request_id, chat_id):
+        with self._cond:
+            state = _ChatState(request_id, chat_id, self.active_interval)
+            self._chats[request_id] = state
+            self._schedule(state)
+        if self.enabled:
+            self.start()
+
+    def untrack(self, request_id):
+        with self._cond:
+            if self._chats.pop(request_id, None) is not None:
+                self._compact()
+
+    def _schedule(self, state):
+        """Queue state's next poll, if polling. Caller holds the lock."""
+        if not self.enabled:
+            return
+        heapq.heappush(self._heap, (state.next_poll, state.request_id))
+        self._compact()
+        self._cond.notify()
+
+    def _compact(self):
+        """
+        Rebuild the heap once superseded and untracked entries outnumber the
+        live ones, so a long idle_interval can't let them pile up.
+        Caller holds the lock.
+        """
+        if len(self._heap) > 2 * len(self._chats) + 64:
+            self._heap = self._live_entries()
+            heapq.heapify(self._heap)
+
+    def _live_entries(self):
+        """Heap entries for every tracked chat not being polled right now. Caller holds the lock."""
+        return [(state.next_poll, request_id) for request_id, state in self._chats.items()
+                if state.next_poll is not None]
+
+    def touch(self, request_id):
+        """Conversation activity: poll this chat at the active rate again"""
+        with self._cond:
+            state = self._chats.get(request_id)
+            if state is None:
+                return
+            state.last_activity = time.monotonic()
+            # A chat being polled right now is rescheduled from last_activity when the poll ends
+            if state.interval > self.active_interval and state.next_poll is not None:
+                state.interval = self.active_interval
+                state.next_poll = time.monotonic() + self.active_interval
+                self._schedule(state)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'enabled': self.enabled,
+                'tracked_chats': len(self._chats),
+                'scheduled': len(self._heap),
+                'polls': self.polls,
+                'messages_found': self.messages_found,
+                'budget_waits': self.budget_waits,
+                'budget_per_minute': self.requests_per_minute,
+            }
+
+    def _take_token(self):
+        """Consume one request from the global budget; returns seconds to wait if empty"""
+        now = time.monotonic()
+        rate = self.requests_per_minute / 60.0
+        self._tokens = min(self.requests_per_minute, self._tokens + (now - self._refilled_at) * rate)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        self.budget_waits += 1
+        return (1 - self._tokens) / rate
+
+    def _pop_due(self):
+        """Return due chat states that fit in the budget, or how long to sleep. Caller holds the lock."""
+        due = []
+        now = time.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+            next_poll, request_id = self._heap[0]
+            state = self._chats.get(request_id)
+            if state is None or state.next_poll != next_poll:
+                heapq.heappop(self._heap)
+                continue
+            wait = self._take_token()
+            if wait:
+                return due, wait
+            heapq.heappop(self._heap)
+            # In flight until _reschedule
+            state.next_poll = None
+            due.append(state)
+        wait = self._heap[0][0] - now if self._heap else None
+        return due, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self.enabled:
+                        due, wait = self._pop_due()
+                        if due:
+                            break
+                    else:
+                        wait = None
+                    self._cond.wait(timeout=wait)
+            self._poll(due)
+
+    def _poll(self, states):
+        pending = []
+        for state in states:
+            url = state.delta_link or f"/chats/{state.chat_id}/messages/delta"
+            pending.append((state, self.graph_batcher.get(_relative(url))))
+
+        for state, future in pending:
+            found = 0
+            try:
+                response = future.result(timeout=120)
+                found = self._handle_page(state, response)
+            except Exception as e:
+                log.error(f"Exception polling chat {state.chat_id}: {str(e)}")
+            self.polls += 1
+            self._reschedule(state, found)
+
+    def _handle_page(self, state, response):
+        if response is None:
+            return 0
+        if response.status_code == 410:
+            # Delta token expired; start a new sync (already processed messages are skipped)
+            state.delta_link = None
+            return 0
+        if response.status_code != 200:
+            log.warning(f"Error polling chat {state.chat_id}: {response.status_code}")
+            return 0
+
+        data = response.json()
+        found = 0
+        for message in data.get("value", []):
+            if message.get("@removed") or not message.get("id"):
+                continue
+            found += 1
+            try:
+                self.on_message(state.request_id, message["id"], message)
+            except Exception as e:
+                log.error(f"Exception processing polled message {message.get('id')}: {str(e)}")
+        self.messages_found += found
+
+        # nextLink means more pages are waiting; deltaLink means we're caught up
+        state.delta_link = data.get("@odata.nextLink") or data.get("@odata.deltaLink") or state.delta_link
+        if data.get("@odata.nextLink"):
+            state.next_poll = 0
+        return found
+
+    def _reschedule(self, state, found):
+        now = time.monotonic()
+        with self._cond:
+            if state.request_id not in self._chats:
+                return
+            if found:
+                state.last_activity = now
+            if state.next_poll == 0:
+                # More pages waiting: fetch the next one as soon as the budget allows
+                state.next_poll = now
+            else:
+                if now - state.last_activity < self.active_window:
+                    state.interval = self.active_interval
+                else:
+                    # Quiet chat: back off gradually up to idle_interval
+                    state.interval = min(self.idle_interval, state.interval * 2)
+                state.next_poll = now + state.interval
+            self._schedule(state)
+
+
+def _relative(url):
+    """Strip the Graph host/version from nextLink/deltaLink URLs for use in $batch"""
+    marker = "/v1.0/"
+    if marker in url:
+        return "/" + url.split(marker, 1)[1]
+    return url
@@ -0,0 +1,245 @@
+"""
+Conversation Event Log
+
+Every event sent to a conversation's Socket.IO room gets the next sequence
+number for that conversation and is kept in a small ring buffer. A client
+that reconnects says which sequence number it saw last and is sent only the
+events it missed, instead of reloading the conversation.
+
+    payload = event_log.record(request_id, 'support_response', payload)   # adds 'seq'
+    events, complete = event_log.since(request_id, last_seq)
+
+`complete` is False when some of the missed events are no longer in the
+buffer (more than `capacity` events behind, or the log was reset), so the
+client knows its view may have gaps.
+
+EventLog is per process; SQLiteEventLog shares sequence numbers and events
+between workers through SQLite tables.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class _Conversation:
+    __slots__ = ('last_seq', 'events')
+
+    def __init__(self, capacity):
+        self.last_seq = 0
+        # (seq, event, payload), oldest first
+        self.events = deque(maxlen=capacity)
+
+
+def _replay(events, last_seq, current_seq):
+    """Events after last_seq, and whether nothing in between was lost"""
+    if last_seq > current_seq:
+        # The log was reset since the client last saw it; send what we have
+        return [_entry(*event) for event in events], False
+    missed = [_entry(*event) for event in events if event[0] > last_seq]
+    oldest = missed[0]['seq'] if missed else current_seq + 1
+    return missed, oldest == last_seq + 1
+
+
+def _entry(seq, event, payload):
+    return {'seq': seq, 'event': event, 'data': payload}
+
+
+class EventLog:
+    """In-process event buffers for the most recently active conversations"""
+
+    def __init__(self, capacity=100, max_conversations=10000):
+        self.capacity = capacity
+        self.max_conversations = max_conversations
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.replayed = 0
+        self.incomplete = 0
+
+    def record(self, request_id, event, payload):
+        """Append an event; returns the payload with its 'seq' added"""
+        with self._lock:
+            conversation = self._conversations.get(request_id)
+            if conversation is None:
+                conversation = self._conversations[request_id] = _Conversation(self.capacity)
+                while len(self._conversations) > self.max_conversations:
+                    self._conversations.popitem(last=False)
+            else:
+                self._conversations.move_to_end(request_id)
+            conversation.last_seq += 1
+            payload = dict(payload, seq=conversation.last_seq)
+            conversation.events.append((conversation.last_seq, event, payload))
+            self.recorded += 1
+        return payload
+
+    def since(self, request_id, last_seq):
+        """
+        ([{'seq', 'event', 'data'}, ...], complete) for the events after last_seq
+        """
+        with self._lock:
+            conversation = self._conversations.get(request_id)
+            if conversation is None:
+                events, complete = [], last_seq == 0
+            else:
+                events, complete = _replay(conversation.events, last_seq, conversation.last_seq)
+            self._count_replay(events, complete)
+        return events, complete
+
+    def last_seq(self, request_id):
+        with self._lock:
+            conversation = self._conversations.get(request_id)
+            return conversation.last_seq if conversation else 0
+
+    def forget(self, request_id):
+        with self._lock:
+            self._conversations.pop(request_id, None)
+
+    def _count_replay(self, events, complete):
+        self.replayed += len(events)
+        if not complete:
+            self.incomplete += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'conversations': len(self._conversations),
+                'events': sum(len(c.events) for c in self._conversations.values()),
+                'recorded': self.recorded,
+                'replayed': self.replayed,
+                'incomplete_replays': self.incomplete,
+            }
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversation_event_seq (
+    request_id TEXT PRIMARY KEY,
+    last_seq INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_event_seq_updated ON conversation_event_seq (updated_at);
+CREATE TABLE IF NOT EXISTS conversation_events (
+    request_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    PRIMARY KEY (request_id, seq)
+) WITHOUT ROWID;
+"""
+
+
+class SQLiteEventLog(EventLog):
+    """
+    Event buffers shared by every worker. Sequence numbers are assigned in
+    the same transaction that stores the event, so two workers emitting to
+    one conversation never hand out the same number. Conversations with no
+    events for `ttl` seconds are dropped.
+    """
+
+    def __init__(self, path, capacity=100, ttl=24 * 3600):
+        super().__init__(capacity=capacity)
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._last_prune = 0.0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._connection()
+        connection.executescript(_SCHEMA)
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def record(self, request_id, event, payload):
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            # The upsert takes the write lock, so the read below sees our own increment
+            connection.execute(
+                "INSERT INTO conversation_event_seq (request_id, last_seq, updated_at) VALUES (?, 1, ?) "
+                "ON CONFLICT(request_id) DO UPDATE SET last_seq = last_seq + 1, updated_at = excluded.updated_at",
+                (request_id, now)
+            )
+            seq = connection.execute(
+                "SELECT last_seq FROM conversation_event_seq WHERE request_id = ?", (request_id,)
+            ).fetchone()[0]
+            payload = dict(payload, seq=seq)
+            connection.execute(
+                "INSERT INTO conversation_events (request_id, seq, event, payload) VALUES (?, ?, ?, ?)",
+                (request_id, seq, event, json.dumps(payload))
+            )
+            connection.execute(
+                "DELETE FROM conversation_events WHERE request_id = ? AND seq <= ?",
+                (request_id, seq - self.capacity)
+            )
+            if now - self._last_prune > 60:
+                self._last_prune = now
+                self._prune(connection, now - self.ttl)
+        with self._lock:
+            self.recorded += 1
+        return payload
+
+    def _prune(self, connection, cutoff):
+        connection.execute(
+            "DELETE FROM conversation_events WHERE request_id IN "
+            "(SELECT request_id FROM conversation_event_seq WHERE updated_at < ?)", (cutoff,)
+        )
+        connection.execute("DELETE FROM conversation_event_seq WHERE updated_at < ?", (cutoff,))
+
+    def since(self, request_id, last_seq):
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT last_seq FROM conversation_event_seq WHERE request_id = ?", (request_id,)
+        ).fetchone()
+        if row is None:
+            events, complete = [], last_seq == 0
+        else:
+            rows = connection.execute(
+                "SELECT seq, event, payload FROM conversation_events WHERE request_id = ? ORDER BY seq",
+                (request_id,)
+            ).fetchall()
+            events, complete = _replay(
+                [(seq, event, json.loads(payload)) for seq, event, payload in rows], last_seq, row[0]
+            )
+        connection.commit()
+        with self._lock:
+            self._count_replay(events, complete)
+        return events, complete
+
+    def last_seq(self, request_id):
+        row = self._connection().execute(
+            "SELECT last_seq FROM conversation_event_seq WHERE request_id = ?", (request_id,)
+        ).fetchone()
+        self._connection().commit()
+        return row[0] if row else 0
+
+    def forget(self, request_id):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM conversation_events WHERE request_id = ?", (request_id,))
+            connection.execute("DELETE FROM conversation_event_seq WHERE request_id = ?", (request_id,))
+
+    def stats(self):
+        stats = super().stats()
+        connection = self._connection()
+        stats['conversations'] = connection.execute("SELECT COUNT(*) FROM conversation_event_seq").fetchone()[0]
+        stats['events'] = connection.execute("SELECT COUNT(*) FROM conversation_events").fetchone()[0]
+        connection.commit()
+        return stats
+
+
+def create_event_log(backend, path=None, capacity=100, ttl=24 * 3600, max_conversations=10000):
+    """Shared (sqlite) log when conversations are shared, otherwise in-process"""
+    if backend == 'sqlite':
+        return SQLiteEventLog(path or "conversations.db", capacity=capacity, ttl=ttl)
+    return EventLog(capacity=capacity, max_conversations=max_conversations)
@@ -0,0 +1,508 @@
+"""
+Fake Microsoft Graph
+
+A local stand-in for Graph and the Microsoft identity platform, for load
+testing the backend without a tenant. It serves HTTPS (MSAL only accepts
+https authorities) with a self-signed certificate written to --tls-dir.
+
+- /{tenant}/v2.0/.well-known/openid-configuration, /oauth2/v2.0/token and
+  /oauth2/v2.0/devicecode (every grant succeeds immediately)
+- /common/discovery/v2.0/keys, the key rich notifications' validationTokens
+  are signed with (issued for the tenant and client id last seen at /token)
+- /v1.0/users/{email}, /v1.0/chats, /v1.0/chats/{id}, /v1.0/chats/{id}/messages,
+  /v1.0/chats/{id}/messages/{id}, /v1.0/chats/{id}/messages/delta,
+  /v1.0/subscriptions, /v1.0/subscriptions/{id} and /v1.0/$batch
+
+Every new chat message is announced to the matching subscriptions'
+notificationUrl (encrypted when the subscription asked for resource data),
+and a fake agent answers each message the backend posts after --reply-delay.
+
+    python fake_graph.py --port 8443 --latency 80 --jitter 40 --throttle 0.02
+
+    GRAPH_URL=https://127.0.0.1:8443/v1.0 AUTHORITY_HOST=https://127.0.0.1:8443 \\
+    REQUESTS_CA_BUNDLE=fake_graph_tls/cert.pem SSL_CERT_FILE=fake_graph_tls/cert.pem \\
+    NOTIFICATION_URL=http://127.0.0.1:5001/api/notifications python app.py
+
+GET /_fake/stats reports what the fake has seen; POST /_fake/reply
+{"chatId", "text"} makes the agent say something.
+
+Requires the optional 'cryptography' package.
+"""
+
+import argparse
+import heapq
+import ipaddress
+import itertools
+import os
+import random
+import re
+import textwrap
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qsl
+
+import requests
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from flask import Flask, jsonify, request
+
+from fake_notifications import (generate_signing_key, make_chat_message, make_notification, make_validation_token,
+                                signing_key_jwks)
+from graph_client import endpoint_name
+
+
+AGENT_NAME = "Fake Support Agent"
+
+
+def write_tls_certificate(tls_dir, hosts=("localhost", "127.0.0.1")):
+    """Write cert.pem/key.pem for the given hosts into tls_dir, reusing existing ones"""
+    cert_path = os.path.join(tls_dir, "cert.pem")
+    key_path = os.path.join(tls_dir, "key.pem")
+    if os.path.exists(cert_path) and os.path.exists(key_path):
+        return cert_path, key_path
+    os.makedirs(tls_dir, exist_ok=True)
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hosts[0])])
+    alt_names = []
+    for host in hosts:
+        try:
+            alt_names.append(x509.IPAddress(ipaddress.ip_address(host)))
+        except ValueError:
+            alt_names.append(x509.DNSName(host))
+    now = datetime.now(timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(minutes=5))
+        .not_valid_after(now + timedelta(days=30))
+        .add_extension(x509.SubjectAlternativeName(alt_names), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    with open(cert_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ))
+    return cert_path, key_path
+
+
+def der_to_pem(encoded_certificate):
+    """Subscriptions carry the base64 DER certificate; encrypt_resource wants PEM"""
+    body = "\n".join(textwrap.wrap(encoded_certificate, 64))
+    return f"-----BEGIN CERTIFICATE-----\n{body}\n-----END CERTIFICATE-----\n".encode()
+
+
+def graph_error(status, code, message):
+    return status, {"error": {"code": code, "message": message}}, {}
+
+
+class _Scheduler:
+    """Runs callbacks after a delay on a small thread pool"""
+
+    def __init__(self, workers):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fake-graph-notify")
+        threading.Thread(target=self._run, name="fake-graph-scheduler", daemon=True).start()
+
+    def call_later(self, delay, fn, *args):
+        with self._condition:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._sequence), fn, args))
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._condition.wait(timeout=self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, fn, args = heapq.heappop(self._heap)
+            self._executor.submit(fn, *args)
+
+
+class FakeGraph:
+    """In-memory chats, messages and subscriptions behind Graph-shaped handlers"""
+
+    ROUTES = [
+        ("GET", r"/users/(?P<user>[^/]+)", "get_user"),
+        ("POST", r"/chats", "create_chat"),
+        ("GET", r"/chats/(?P<chat_id>[^/]+)", "get_chat"),
+        ("PATCH", r"/chats/(?P<chat_id>[^/]+)", "update_chat"),
+        ("DELETE", r"/chats/(?P<chat_id>[^/]+)", "delete_chat"),
+        ("GET", r"/chats/(?P<chat_id>[^/]+)/messages/delta", "message_delta"),
+        ("POST", r"/chats/(?P<chat_id>[^/]+)/messages", "post_message"),
+        ("GET", r"/chats/(?P<chat_id>[^/]+)/messages/(?P<message_id>[^/]+)", "get_message"),
+        ("POST", r"/subscriptions", "create_subscription"),
+        ("PATCH", r"/subscriptions/(?P<subscription_id>[^/]+)", "update_subscription"),
+        ("DELETE", r"/subscriptions/(?P<subscription_id>[^/]+)", "delete_subscription"),
+        ("POST", r"/\$batch", "batch"),
+    ]
+
+    def __init__(self, latency=0.0, jitter=0.0, throttle=0.0, retry_after=1, reply_delay=1.0,
+                 notify_delay=0.05, validate_subscriptions=True, notify_workers=32):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.reply_delay = reply_delay
+        self.notify_delay = notify_delay
+        self.validate_subscriptions = validate_subscriptions
+        self.base_url = None
+        self.signing_key, self.signing_key_id = generate_signing_key()
+        # (tenant, client id) of the last app that signed in, the audience of validation tokens
+        self.app = ("tenant", "client")
+        self._validation_token = None
+
+        self._routes = [(method, re.compile(pattern + "$"), getattr(self, name))
+                        for method, pattern, name in self.ROUTES]
+        self._chats = {}
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(int(time.time() * 1000) * 1000)
+        self._scheduler = _Scheduler(notify_workers)
+        self._session = requests.Session()
+        self._session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=notify_workers))
+        self._session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=notify_workers))
+
+        self._stats_lock = threading.Lock()
+        self.requests = Counter()
+        self.throttled = Counter()
+        self.notifications = Counter()
+
+    # Request handling
+
+    def handle(self, method, path, query=None, body=None, batched=False):
+        """Returns (status, body, headers) for one Graph request"""
+        path, _, query_string = path.partition("?")
+        # $batch items carry their query string in the url
+        query = query or dict(parse_qsl(query_string))
+        path = "/" + path.strip("/")
+        endpoint = endpoint_name(method, path)
+        with self._stats_lock:
+            self.requests[endpoint] += 1
+        if endpoint != "POST /$batch":
+            if self.throttle and random.random() < self.throttle:
+                with self._stats_lock:
+                    self.throttled[endpoint] += 1
+                status, error, headers = graph_error(429, "TooManyRequests", "Fake throttling")
+                return status, error, {"Retry-After": str(self.retry_after)}
+            if not batched:
+                self._delay()
+        for route_method, pattern, handler in self._routes:
+            match = pattern.match(path)
+            if match and route_method == method:
+                return handler(query=query, body=body or {}, **match.groupdict())
+        return graph_error(404, "NotFound", f"No fake for {method} {path}")
+
+    def _delay(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def batch(self, query, body):
+        # One round trip for the whole batch, like the real service
+        self._delay()
+        responses = []
+        for item in body.get("requests", []):
+            status, payload, headers = self.handle(
+                item["method"].upper(), item["url"], body=item.get("body"), batched=True
+            )
+            responses.append({"id": item["id"], "status": status, "headers": headers, "body": payload})
+        return 200, {"responses": responses}, {}
+
+    def get_user(self, query, body, user):
+        return 200, {
+            "id": str(uuid.uuid5(uuid.NAMESPACE_URL, user.lower())),
+            "mail": user,
+            "userPrincipalName": user,
+            "displayName": user.split("@", 1)[0]
+        }, {}
+
+    def create_chat(self, query, body):
+        chat_id = f"19:{uuid.uuid4().hex}@thread.v2"
+        chat = {
+            "id": chat_id,
+            "topic": body.get("topic"),
+            "chatType": body.get("chatType", "group"),
+            "createdDateTime": datetime.now(timezone.utc).isoformat(),
+            "webUrl": f"https://teams.microsoft.com/l/chat/{chat_id}/0"
+        }
+        with self._lock:
+            self._chats[chat_id] = {"chat": chat, "messages": []}
+        return 201, chat, {}
+
+    def get_chat(self, query, body, chat_id):
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            return graph_error(404, "NotFound", "Chat not found")
+        return 200, entry["chat"], {}
+
+    def update_chat(self, query, body, chat_id):
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            return graph_error(404, "NotFound", "Chat not found")
+        entry["chat"].update({key: value for key, value in body.items() if key == "topic"})
+        return 204, None, {}
+
+    def delete_chat(self, query, body, chat_id):
+        with self._lock:
+            entry = self._chats.pop(chat_id, None)
+        if entry is None:
+            return graph_error(404, "NotFound", "Chat not found")
+        return 204, None, {}
+
+    def post_message(self, query, body, chat_id):
+        content = body.get("body") or {}
+        message = self._add_message(chat_id, content.get("content", ""), "Support Bot",
+                                    content.get("contentType", "text"))
+        if message is None:
+            return graph_error(404, "NotFound", "Chat not found")
+        # Every message the backend posts (new request or follow-up) gets an answer
+        if self.reply_delay >= 0:
+            self._scheduler.call_later(self.reply_delay, self.agent_reply, chat_id, f"Re: message {message['id']}")
+        return 201, message, {}
+
+    def get_message(self, query, body, chat_id, message_id):
+        entry = self._chats.get(chat_id)
+        message = next((m for m in entry["messages"] if m["id"] == message_id), None) if entry else None
+        if message is None:
+            return graph_error(404, "NotFound", "Message not found")
+        return 200, message, {}
+
+    def message_delta(self, query, body, chat_id):
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            return graph_error(404, "NotFound", "Chat not found")
+        start = int(query.get("$deltatoken", 0))
+        messages = entry["messages"][start:]
+        return 200, {
+            "value": messages,
+            "@odata.deltaLink": f"{self.base_url}/chats/{chat_id}/messages/delta?$deltatoken={start + len(messages)}"
+        }, {}
+
+    def create_subscription(self, query, body):
+        notification_url = body.get("notificationUrl")
+        if not notification_url:
+            return graph_error(400, "InvalidRequest", "notificationUrl is required")
+        if self.validate_subscriptions:
+            # Graph checks that the endpoint echoes a validation token before subscribing
+            token = uuid.uuid4().hex
+            try:
+                response = self._session.post(notification_url, params={"validationToken": token}, timeout=10)
+                valid = response.status_code == 200 and response.text == token
+            except requests.RequestException:
+                valid = False
+            if not valid:
+                return graph_error(400, "InvalidRequest", "Subscription validation request failed")
+        subscription = dict(body, id=str(uuid.uuid4()))
+        subscription.pop("encryptionCertificate", None)
+        with self._lock:
+            self._subscriptions[subscription["id"]] = dict(body, id=subscription["id"])
+        return 201, subscription, {}
+
+    def update_subscription(self, query, body, subscription_id):
+        with self._lock:
+            subscription = self._subscriptions.get(subscription_id)
+            if subscription is None:
+                return graph_error(404, "ResourceNotFound", "Subscription not found")
+            subscription.update({key: value for key, value in body.items() if key == "expirationDateTime"})
+            result = {key: value for key, value in subscription.items() if key != "encryptionCertificate"}
+        return 200, result, {}
+
+    def delete_subscription(self, query, body, subscription_id):
+        with self._lock:
+            subscription = self._subscriptions.pop(subscription_id, None)
+        if subscription is None:
+            return graph_error(404, "ResourceNotFound", "Subscription not found")
+        return 204, None, {}
+
+    # Messages and notifications
+
+    def _add_message(self, chat_id, text, sender, content_type="text"):
+        message = make_chat_message(chat_id, text, sender=sender, message_id=str(next(self._message_ids)))
+        message["createdDateTime"] = message["createdDateTime"].replace("+00:00", "Z")
+        message["body"]["contentType"] = content_type
+        with self._lock:
+            entry = self._chats.get(chat_id)
+            if entry is None:
+                return None
+            entry["messages"].append(message)
+        self._scheduler.call_later(self.notify_delay, self.notify, chat_id, message)
+        return message
+
+    def agent_reply(self, chat_id, text):
+        """Post a message as the support agent; None if the chat is gone"""
+        return self._add_message(chat_id, text, AGENT_NAME)
+
+    def _matching_subscriptions(self, chat_id):
+        with self._lock:
+            subscriptions = list(self._subscriptions.values())
+        for subscription in subscriptions:
+            resource = subscription.get("resource", "")
+            if resource == f"/chats/{chat_id}/messages" or resource.endswith("/chats/getAllMessages"):
+                yield subscription
+
+    def validation_token(self):
+        """Like Graph, reuse one token for a while rather than signing one per notification"""
+        with self._lock:
+            cached = self._validation_token
+            if cached is None or cached[0] != self.app or cached[1] < time.time():
+                tenant, client_id = self.app
+                token = make_validation_token(self.signing_key, self.signing_key_id, client_id, tenant)
+                cached = self._validation_token = (self.app, time.time() + 600, token)
+            return cached[2]
+
+    def notify(self, chat_id, message):
+        for subscription in self._matching_subscriptions(chat_id):
+            cert_pem = None
+            if subscription.get("includeResourceData") and subscription.get("encryptionCertificate"):
+                cert_pem = der_to_pem(subscription["encryptionCertificate"])
+            notification = make_notification(
+                subscription.get("clientState"), chat_id, message, cert_pem,
+                subscription.get("encryptionCertificateId"), subscription["id"]
+            )
+            payload = {"value": [notification]}
+            if cert_pem is not None:
+                payload["validationTokens"] = [self.validation_token()]
+            try:
+                response = self._session.post(subscription["notificationUrl"], json=payload, timeout=10)
+                outcome = "delivered" if response.status_code < 300 else f"rejected_{response.status_code}"
+            except requests.RequestException:
+                outcome = "failed"
+            with self._stats_lock:
+                self.notifications[outcome] += 1
+
+    def stats(self):
+        with self._stats_lock:
+            summary = {
+                "requests": dict(self.requests),
+                "requests_total": sum(self.requests.values()),
+                "throttled": dict(self.throttled),
+                "throttled_total": sum(self.throttled.values()),
+                "notifications": dict(self.notifications),
+            }
+        with self._lock:
+            summary["chats"] = len(self._chats)
+            summary["messages"] = sum(len(entry["messages"]) for entry in self._chats.values())
+            summary["subscriptions"] = len(self._subscriptions)
+        return summary
+
+
+def create_app(graph):
+    app = Flask(__name__)
+
+    def respond(status, body, headers):
+        if body is None:
+            return "", status, headers
+        return jsonify(body), status, headers
+
+    @app.route("/v1.0/<path:path>", methods=["GET", "POST", "PATCH", "DELETE"])
+    def graph_request(path):
+        if graph.base_url is None:
+            graph.base_url = request.host_url.rstrip("/") + "/v1.0"
+        return respond(*graph.handle(request.method, path, request.args.to_dict(),
+                                     request.get_json(silent=True)))
+
+    @app.route("/<tenant>/v2.0/.well-known/openid-configuration")
+    def openid_configuration(tenant):
+        base = f"{request.host_url.rstrip('/')}/{tenant}"
+        return jsonify({
+            "issuer": f"{base}/v2.0",
+            "authorization_endpoint": f"{base}/oauth2/v2.0/authorize",
+            "token_endpoint": f"{base}/oauth2/v2.0/token",
+            "device_authorization_endpoint": f"{base}/oauth2/v2.0/devicecode",
+            "response_types_supported": ["code", "id_token", "token"]
+        })
+
+    @app.route("/<tenant>/oauth2/v2.0/devicecode", methods=["POST"])
+    def device_code(tenant):
+        return jsonify({
+            "device_code": uuid.uuid4().hex,
+            "user_code": "FAKEGRAPH",
+            "verification_uri": f"{request.host_url}devicelogin",
+            "expires_in": 900,
+            "interval": 1,
+            "message": "The fake Graph signs everyone in straight away"
+        })
+
+    @app.route("/<tenant>/discovery/v2.0/keys")
+    def signing_keys(tenant):
+        return jsonify(signing_key_jwks(graph.signing_key, graph.signing_key_id))
+
+    @app.route("/<tenant>/oauth2/v2.0/token", methods=["POST"])
+    def token(tenant):
+        if request.form.get("client_id"):
+            graph.app = (tenant, request.form["client_id"])
+        return jsonify({
+            "token_type": "Bearer",
+            "access_token": f"fake-{uuid.uuid4().hex}",
+            "expires_in": 3600,
+            "ext_expires_in": 3600,
+            "scope": request.form.get("scope", "")
+        })
+
+    @app.route("/_fake/stats")
+    def fake_stats():
+        return jsonify(graph.stats())
+
+    @app.route("/_fake/reply", methods=["POST"])
+    def fake_reply():
+        data = request.get_json(silent=True) or {}
+        message = graph.agent_reply(data.get("chatId"), data.get("text", "Hello from the fake agent"))
+        if message is None:
+            return jsonify({"error": "Chat not found"}), 404
+        return jsonify(message), 201
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local fake Microsoft Graph for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--tls-dir", default="fake_graph_tls")
+    parser.add_argument("--latency", type=float, default=50, help="mean Graph latency in ms")
+    parser.add_argument("--jitter", type=float, default=25, help="+/- ms added to each response")
+    parser.add_argument("--throttle", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds on 429s")
+    parser.add_argument("--reply-delay", type=float, default=1.0,
+                        help="seconds before the agent answers a message (negative: never)")
+    parser.add_argument("--notify-delay", type=float, default=0.05, help="seconds before a notification is sent")
+    parser.add_argument("--no-validation", action="store_true", help="skip subscription validation requests")
+    parser.add_argument("--notify-workers", type=int, default=32)
+    args = parser.parse_args()
+
+    graph = FakeGraph(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        throttle=args.throttle,
+        retry_after=args.retry_after,
+        reply_delay=args.reply_delay,
+        notify_delay=args.notify_delay,
+        validate_subscriptions=not args.no_validation,
+        notify_workers=args.notify_workers
+    )
+    graph.base_url = f"https://{args.host}:{args.port}/v1.0"
+    cert_path, key_path = write_tls_certificate(args.tls_dir, hosts=tuple(dict.fromkeys(("localhost", "127.0.0.1", args.host))))
+
+    from werkzeug.serving import make_server
+    server = make_server(args.host, args.port, create_app(graph), threaded=True, ssl_context=(cert_path, key_path))
+    print(f"Fake Graph on {graph.base_url} (authority https://{args.host}:{args.port}, CA bundle {cert_path})")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+Fake Graph Notifications
+
+Local stand-in for Microsoft Graph when exercising the rich notification
+path: generates a throwaway certificate and builds change notifications
+whose resource data is encrypted exactly the way Graph does it.
+
+    python fake_notifications.py --cert-dir certs          # write a test certificate
+    python fake_notifications.py --cert-dir certs --post \\
+        --request-id <requestId> --chat-id <teams chat id> --text "Hello"
+
+The webhook only trusts encrypted content alongside validationTokens signed
+by a key it can fetch from NOTIFICATION_JWKS_URL; fake_graph.py serves one,
+so --post is only useful against a backend pointed at a running fake Graph.
+make_validation_token() signs them for tests.
+
+Requires the optional 'cryptography' and 'PyJWT' packages.
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import jwt
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, padding, serialization
+from cryptography.hazmat.primitives.asymmetric import padding as asym_padding
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.x509.oid import NameOID
+
+
+def generate_test_certificate(common_name="support-chat-test", days=30):
+    """Return (cert_pem, key_pem) for a self-signed RSA 2048 certificate"""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.now(timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(minutes=5))
+        .not_valid_after(now + timedelta(days=days))
+        .sign(key, hashes.SHA256())
+    )
+    cert_pem = certificate.public_bytes(serialization.Encoding.PEM)
+    key_pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    )
+    return cert_pem, key_pem
+
+
+def write_test_certificate(cert_dir, certificate_id=None):
+    """Write <id>.pem and <id>.key into cert_dir and return the id"""
+    certificate_id = certificate_id or f"test-{uuid.uuid4().hex[:8]}"
+    os.makedirs(cert_dir, exist_ok=True)
+    cert_pem, key_pem = generate_test_certificate()
+    with open(os.path.join(cert_dir, f"{certificate_id}.pem"), "wb") as f:
+        f.write(cert_pem)
+    with open(os.path.join(cert_dir, f"{certificate_id}.key"), "wb") as f:
+        f.write(key_pem)
+    return certificate_id
+
+
+def encrypt_resource(resource, cert_pem, certificate_id):
+    """Encrypt a resource dict into Graph's encryptedContent format"""
+    certificate = x509.load_pem_x509_certificate(cert_pem)
+    symmetric_key = os.urandom(32)
+
+    padder = padding.PKCS7(128).padder()
+    padded = padder.update(json.dumps(resource).encode()) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(symmetric_key), modes.CBC(symmetric_key[:16])).encryptor()
+    data = encryptor.update(padded) + encryptor.finalize()
+
+    data_key = certificate.public_key().encrypt(
+        symmetric_key,
+        asym_padding.OAEP(mgf=asym_padding.MGF1(algorithm=hashes.SHA1()), algorithm=hashes.SHA1(), label=None)
+    )
+    der = certificate.public_bytes(serialization.Encoding.DER)
+    return {
+        "data": base64.b64encode(data).decode(),
+        "dataSignature": base64.b64encode(hmac.new(symmetric_key, data, hashlib.sha256).digest()).decode(),
+        "dataKey": base64.b64encode(data_key).decode(),
+        "encryptionCertificateId": certificate_id,
+        "encryptionCertificateThumbprint": hashlib.sha1(der).hexdigest().upper(),
+    }
+
+
+# App id Graph's change notification publisher signs validation tokens as
+GRAPH_NOTIFICATION_PUBLISHER = "0bf30f3b-4a52-48df-9a82-234910c4a086"
+
+
+def generate_signing_key():
+    """Return (private key, key id) for signing validation tokens"""
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048), uuid.uuid4().hex
+
+
+def signing_key_jwks(signing_key, key_id):
+    """The JWKS document publishing the signing key's public half"""
+    jwk = jwt.algorithms.RSAAlgorithm.to_jwk(signing_key.public_key(), as_dict=True)
+    jwk.update({"kid": key_id, "use": "sig", "alg": "RS256"})
+    return {"keys": [jwk]}
+
+
+def make_validation_token(signing_key, key_id, app_id, tenant_id, lifetime=3600, **claims):
+    """A validationTokens entry as Azure AD issues it for Graph change notifications"""
+    now = int(time.time())
+    payload = {
+        "iss": f"https://sts.windows.net/{tenant_id}/",
+        "aud": app_id,
+        "azp": GRAPH_NOTIFICATION_PUBLISHER,
+        "tid": tenant_id,
+        "iat": now,
+        "nbf": now,
+        "exp": now + lifetime,
+    }
+    payload.update(claims)
+    return jwt.encode(payload, signing_key, algorithm="RS256", headers={"kid": key_id})
+
+
+def make_chat_message(chat_id, text, sender="Test Support Agent", message_id=None):
+    """Build a chatMessage resource like the ones Graph embeds"""
+    message_id = message_id or str(int(datetime.now(timezone.utc).timestamp() * 1000))
+    return {
+        "id": message_id,
+        "chatId": chat_id,
+        "messageType": "message",
+        "createdDateTime": datetime.now(timezone.utc).isoformat(),
+        "from": {"user": {"id": str(uuid.uuid4()), "displayName": sender}},
+        "body": {"contentType": "text", "content": text},
+    }
+
+
+def make_notification(client_state, chat_id, message, cert_pem=None, certificate_id=None, subscription_id=None):
+    """
+    Build a change notification for a new chat message.
+    With cert_pem the message is embedded as encryptedContent, otherwise only
+    the resource id is sent (the basic notification shape).
+    """
+    notification = {
+        "subscriptionId": subscription_id or str(uuid.uuid4()),
+        "changeType": "created",
+        "clientState": client_state,
+        "tenantId": str(uuid.uuid4()),
+        "resource": f"chats('{chat_id}')/messages('{message['id']}')",
+        "resourceData": {
+            "id": message["id"],
+            "@odata.type": "#Microsoft.Graph.chatMessage",
+            "@odata.id": f"chats('{chat_id}')/messages('{message['id']}')",
+        },
+    }
+    if cert_pem is not None:
+        notification["encryptedContent"] = encrypt_resource(message, cert_pem, certificate_id)
+    return notification
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate fake Graph chat message notifications")
+    parser.add_argument("--cert-dir", required=True)
+    parser.add_argument("--cert-id")
+    parser.add_argument("--post", action="store_true", help="POST a notification to the local webhook")
+    parser.add_argument("--url", default="http://localhost:5001/api/notifications")
+    parser.add_argument("--request-id")
+    parser.add_argument("--chat-id")
+    parser.add_argument("--text", default="Hello from the fake Graph notifier")
+    args = parser.parse_args()
+
+    certificate_id = args.cert_id
+    cert_path = os.path.join(args.cert_dir, f"{certificate_id}.pem") if certificate_id else None
+    if not cert_path or not os.path.exists(cert_path):
+        certificate_id = write_test_certificate(args.cert_dir, certificate_id)
+        cert_path = os.path.join(args.cert_dir, f"{certificate_id}.pem")
+        print(f"Wrote test certificate {certificate_id} to {args.cert_dir}")
+
+    if not args.post:
+        return
+
+    import requests
+
+    with open(cert_path, "rb") as f:
+        cert_pem = f.read()
+    message = make_chat_message(args.chat_id, args.text)
+    notification = make_notification(args.request_id, args.chat_id, message, cert_pem, certificate_id)
+    response = requests.post(args.url, json={"value": [notification]}, timeout=10)
+    print(f"Webhook responded {response.status_code}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""
+Graph JSON Batching
+
+Collects Graph requests issued within a short window and sends them as
+JSON $batch requests of up to 20 sub-requests. Callers get a Future that
+resolves to a response object with the same status_code / json() / text
+surface as requests.Response, so existing response handling works as-is.
+Throttled sub-requests are retried on their own after Retry-After.
+
+With AsyncGraphClient the $batch calls are awaited on its event loop;
+otherwise they are sent from a small pool of sender threads.
+"""
+
+import json
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from graph_client import IDEMPOTENT_METHODS, endpoint_name, is_retryable, parse_retry_after
+from token_manager import APP_ONLY
+from structured_log import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Graph rejects batches with more than 20 sub-requests
+MAX_BATCH_SIZE = 20
+
+
+class BatchResponse:
+    """One sub-response of a $batch call, shaped like a requests.Response"""
+
+    def __init__(self, status_code, headers=None, body=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+
+    def json(self):
+        if isinstance(self.body, (dict, list)):
+            return self.body
+        return json.loads(self.body or "null")
+
+    @property
+    def text(self):
+        if isinstance(self.body, str):
+            return self.body
+        return json.dumps(self.body)
+
+
+class _PendingRequest:
+    def __init__(self, method, url, auth, body):
+        self.method = method
+        self.url = url
+        self.auth = auth
+        self.body = body
+        self.future = Future()
+        self.attempts = 0
+
+
+class GraphBatcher:
+    """
+    Coalesce Graph requests into $batch calls.
+    A batch is sent as soon as it holds MAX_BATCH_SIZE requests or when the
+    oldest queued request has waited `window` seconds.
+    """
+
+    def __init__(self, graph_client, window=0.05, max_batch=MAX_BATCH_SIZE, max_attempts=3, senders=4):
+        self.graph_client = graph_client
+        self.window = window
+        self.max_batch = min(max_batch, MAX_BATCH_SIZE)
+        self.max_attempts = max_attempts
+
+        self._pending = {}
+        self._oldest = {}
+        self._cond = threading.Condition()
+        self._senders = ThreadPoolExecutor(max_workers=senders, thread_name_prefix="graph-batch")
+        self._collector = None
+        self.batches_sent = 0
+        self.requests_sent = 0
+
+    def start(self):
+        with self._cond:
+            if self._collector and self._collector.is_alive():
+                return
+            self._collector = threading.Thread(target=self._collect_loop, name="graph-batch-collector", daemon=True)
+            self._collector.start()
+
+    def submit(self, method, url, auth=APP_ONLY, body=None):
+        """
+        Queue a Graph request for the next batch.
+        url is relative to the Graph version root, e.g. '/chats/{id}/messages/{id}'.
+        """
+        self.start()
+        pending = _PendingRequest(method.upper(), "/" + url.lstrip("/"), auth, body)
+        self._enqueue(pending)
+        return pending.future
+
+    def get(self, url, auth=APP_ONLY):
+        return self.submit("GET", url, auth=auth)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'batches_sent': self.batches_sent,
+                'requests_sent': self.requests_sent,
+                'avg_batch_size': round(self.requests_sent / self.batches_sent, 2) if self.batches_sent else None,
+                'queued': sum(len(items) for items in self._pending.values()),
+            }
+
+    def _enqueue(self, pending):
+        with self._cond:
+            items = self._pending.setdefault(pending.auth, [])
+            if not items:
+                self._oldest[pending.auth] = time.monotonic()
+            items.append(pending)
+            self._cond.notify()
+
+    def _take_ready(self):
+        """Pop every batch that is full or whose window has elapsed. Caller holds the lock."""
+        ready = []
+        now = time.monotonic()
+        for auth, items in self._pending.items():
+            while len(items) >= self.max_batch:
+                ready.append((auth, items[:self.max_batch]))
+                del items[:self.max_batch]
+                self._oldest[auth] = now
+            if items and now - self._oldest[auth] >= self.window:
+                ready.append((auth, items[:]))
+                items.clear()
+        return ready
+
+    def _next_deadline(self):
+        waits = [
+            self._oldest[auth] + self.window - time.monotonic()
+            for auth, items in self._pending.items() if items
+        ]
+        return max(0.0, min(waits)) if waits else None
+
+    def _collect_loop(self):
+        while True:
+            with self._cond:
+                ready = self._take_ready()
+                while not ready:
+                    self._cond.wait(timeout=self._next_deadline())
+                    ready = self._take_ready()
+            for auth, items in ready:
+                if hasattr(self.graph_client, 'arequest'):
+                    self.graph_client.run(self._asend(auth, items))
+                else:
+                    self._senders.submit(self._send, auth, items)
+
+    def _batch_body(self, items):
+        batch = {"requests": []}
+        for index, pending in enumerate(items):
+            sub_request = {"id": str(index), "method": pending.method, "url": pending.url}
+            if pending.body is not None:
+                sub_request["body"] = pending.body
+                sub_request["headers"] = {"Content-Type": "application/json"}
+            batch["requests"].append(sub_request)
+        return batch
+
+    def _send(self, auth, items):
+        started = time.monotonic()
+        try:
+            response = self.graph_client.post("/$batch", auth=auth, json=self._batch_body(items))
+        except Exception as e:
+            for pending in items:
+                pending.future.set_exception(e)
+            return
+        self._resolve(items, response, time.monotonic() - started)
+
+    async def _asend(self, auth, items):
+        started = time.monotonic()
+        try:
+            response = await self.graph_client.arequest("POST", "/$batch", auth=auth, json=self._batch_body(items))
+        except Exception as e:
+            for pending in items:
+                pending.future.set_exception(e)
+            return
+        self._resolve(items, response, time.monotonic() - started)
+
+    def _resolve(self, items, response, elapsed):
+        """Hand each caller its sub-response, requeueing the throttled ones"""
+        with self._cond:
+            self.batches_sent += 1
+            self.requests_sent += len(items)
+
+        if response is None:
+            # No token; mirror GraphClient.request() by resolving to None
+            for pending in items:
+                pending.future.set_result(None)
+            return
+
+        if response.status_code != 200:
+            log.error(f"Error sending Graph batch: {response.status_code}", response=response.text)
+            for pending in items:
+                pending.future.set_result(BatchResponse(response.status_code, dict(response.headers), response.text))
+            return
+
+        by_id = {r.get("id"): r for r in response.json().get("responses", [])}
+        for index, pending in enumerate(items):
+            sub_response = by_id.get(str(index))
+            if sub_response is None:
+                pending.future.set_result(BatchResponse(500, body={"error": {"message": "Missing batch response"}}))
+                continue
+
+            status = sub_response.get("status", 500)
+            headers = sub_response.get("headers") or {}
+            self.graph_client.record_latency(endpoint_name(pending.method, pending.url), elapsed, status, pending.attempts)
+
+            idempotent = pending.method in IDEMPOTENT_METHODS
+            if is_retryable(status, headers, idempotent) and pending.attempts + 1 < self.max_attempts:
+                pending.attempts += 1
+                delay = parse_retry_after(headers.get("Retry-After"))
+                if delay is None:
+                    delay = 2 ** pending.attempts
+                timer = threading.Timer(delay, self._enqueue, args=(pending,))
+                timer.daemon = True
+                timer.start()
+                continue
+
+            pending.future.set_result(BatchResponse(status, headers, sub_response.get("body")))
@@ -0,0 +1,365 @@
+"""
+Graph HTTP Client
+
+A single, shared HTTP layer for every Microsoft Graph call made by the backend.
+It keeps a pool of keep-alive connections, applies a timeout to every call,
+retries throttled/transient failures with backoff that honours Retry-After,
+and records latency per endpoint so slow Graph operations are visible.
+Calls tagged with an operation name go through that operation's circuit
+breaker, and every call goes through the 'token' breaker if one is given.
+"""
+
+import random
+import re
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from circuit_breaker import CircuitOpenError
+from metrics import histogram
+from token_manager import APP_ONLY, DELEGATED
+from structured_log import get_logger
+import tracing
+
+
+log = get_logger(__name__)
+
+
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+
+# (connect, read) timeout in seconds applied when the caller doesn't pass one
+DEFAULT_TIMEOUT = (3.05, 15)
+
+# Graph returns these when a request was throttled and not processed
+RETRYABLE_STATUSES = {429}
+# Safe to retry these for idempotent requests as well
+IDEMPOTENT_RETRYABLE_STATUSES = RETRYABLE_STATUSES | {500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+# Path segments whose following segment is an identifier, used to group latency
+_ID_COLLECTIONS = {"chats", "messages", "users", "subscriptions", "members", "replies"}
+
+_SAMPLE_WINDOW = 500
+
+# Breaker guarding token acquisition for every call
+TOKEN_OPERATION = "token"
+
+GRAPH_REQUEST_SECONDS = histogram(
+    "graph_request_duration_seconds", "Graph calls by endpoint, including retries", ["endpoint", "status"]
+)
+# Tagged operations (chat creation, message send, subscriptions), including circuit and token outcomes
+GRAPH_OPERATION_SECONDS = histogram(
+    "graph_operation_duration_seconds", "Graph operations end to end", ["operation", "outcome"]
+)
+TOKEN_SECONDS = histogram(
+    "graph_token_acquisition_seconds", "Time to get an access token from TokenManager", ["auth"]
+)
+
+
+def endpoint_name(method, url):
+    """Collapse a Graph URL into a stable endpoint label, e.g. 'GET /chats/{id}/messages/{id}'"""
+    path = url
+    if path.startswith(GRAPH_BASE_URL):
+        path = path[len(GRAPH_BASE_URL):]
+    elif "://" in path:
+        path = "/" + path.split("://", 1)[1].split("/", 1)[-1]
+        # Another Graph host (national cloud, local fake): drop the version segment too
+        path = re.sub(r"^/(v1\.0|beta)(?=/|$)", "", path)
+    path = path.split("?", 1)[0]
+
+    segments = []
+    previous = None
+    for segment in path.strip("/").split("/"):
+        if previous in _ID_COLLECTIONS:
+            segments.append("{id}")
+        else:
+            segments.append(segment)
+        previous = segment
+    return f"{method.upper()} /" + "/".join(segments)
+
+
+def is_retryable(status_code, headers, idempotent):
+    """
+    True if a request that got this response can be sent again.
+    A 504, or a 503 without Retry-After, doesn't mean Graph skipped the
+    request, so non-idempotent calls (creating a chat, message or
+    subscription) aren't repeated on them; duplicates are left to the
+    idempotency and dedup layers.
+    """
+    if idempotent:
+        return status_code in IDEMPOTENT_RETRYABLE_STATUSES
+    if status_code == 503:
+        return any(name.lower() == "retry-after" for name in (headers or {}))
+    return status_code in RETRYABLE_STATUSES
+
+
+def parse_retry_after(value):
+    """Return the Retry-After header as seconds, or None if missing/invalid"""
+    if not value:
+        return None
+    value = value.strip()
+    if re.fullmatch(r"\d+(\.\d+)?", value):
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class _EndpointStats:
+    """Latency samples and counters for one endpoint"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.samples = deque(maxlen=_SAMPLE_WINDOW)
+        self.status_codes = {}
+
+    def record(self, elapsed, status_code, retries):
+        self.count += 1
+        self.retries += retries
+        self.total_seconds += elapsed
+        self.max_seconds = max(self.max_seconds, elapsed)
+        self.samples.append(elapsed)
+        key = str(status_code) if status_code is not None else "error"
+        self.status_codes[key] = self.status_codes.get(key, 0) + 1
+        if status_code is None or status_code >= 400:
+            self.errors += 1
+
+    def summary(self):
+        ordered = sorted(self.samples)
+
+        def percentile(p):
+            if not ordered:
+                return None
+            index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+            return round(ordered[index] * 1000, 1)
+
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'retries': self.retries,
+            'avg_ms': round(self.total_seconds / self.count * 1000, 1) if self.count else None,
+            'p50_ms': percentile(50),
+            'p95_ms': percentile(95),
+            'p99_ms': percentile(99),
+            'max_ms': round(self.max_seconds * 1000, 1),
+            'status_codes': dict(self.status_codes),
+        }
+
+
+class GraphClient:
+    """
+    Pooled, retrying client for Microsoft Graph.
+    Requests are authenticated through the shared TokenManager; pass
+    auth=DELEGATED for calls that need a signed-in user.
+    """
+
+    def __init__(self, token_manager, base_url=GRAPH_BASE_URL, timeout=DEFAULT_TIMEOUT,
+                 max_retries=3, backoff_factor=0.5, max_backoff=30, pool_size=20, breakers=None):
+        self.token_manager = token_manager
+        # operation name -> CircuitBreaker
+        self.breakers = breakers or {}
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _url(self, path):
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def _token(self, auth):
+        with TOKEN_SECONDS.labels(auth).time(), tracing.span("token", auth=auth):
+            if auth == DELEGATED:
+                return self.token_manager.get_delegated_token()
+            return self.token_manager.get_app_token()
+
+    def _backoff(self, attempt, response=None):
+        retry_after = parse_retry_after(response.headers.get("Retry-After")) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        delay = self.backoff_factor * (2 ** attempt)
+        # Full jitter so a burst of throttled callers doesn't retry in lockstep
+        return min(self.max_backoff, random.uniform(0, delay))
+
+    def record_latency(self, endpoint, elapsed, status_code, retries):
+        GRAPH_REQUEST_SECONDS.labels(endpoint, status_code or "error").observe(elapsed)
+        tracing.add_span(f"graph {endpoint}", elapsed, status=status_code, retries=retries)
+        with self._stats_lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = _EndpointStats()
+            stats.record(elapsed, status_code, retries)
+
+    def breaker_report(self):
+        """State of every circuit breaker"""
+        return {name: breaker.stats() for name, breaker in sorted(self.breakers.items())}
+
+    def latency_report(self):
+        """Per-endpoint latency and error summary"""
+        with self._stats_lock:
+            return {endpoint: stats.summary() for endpoint, stats in sorted(self._stats.items())}
+
+    def request(self, method, path, auth=APP_ONLY, timeout=None, headers=None, operation=None, **kwargs):
+        """
+        Send a Graph request, retrying throttled and transient failures.
+        Returns the final requests.Response, or None if no access token was available.
+        Network errors that survive all retries are raised to the caller, and
+        CircuitOpenError is raised without calling Graph if the operation's
+        (or the token) circuit is open.
+        """
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            breaker, token_breaker = self._admit(operation)
+            try:
+                access_token = self._token(auth)
+            except Exception as e:
+                self._token_failed(breaker, token_breaker, e)
+                raise
+            if not self._token_acquired(breaker, token_breaker, auth, access_token):
+                outcome = "no_token"
+                log.warning(f"Failed to get {auth} token for {path}")
+                return None
+
+            try:
+                response = self._send(method, path, auth, access_token, timeout, headers, **kwargs)
+            except Exception as e:
+                self._record_outcome(breaker, error=e)
+                raise
+            self._record_outcome(breaker, response.status_code)
+            outcome = str(response.status_code)
+            return response
+        except CircuitOpenError:
+            outcome = "circuit_open"
+            raise
+        finally:
+            self.record_operation(operation, started, outcome)
+
+    def record_operation(self, operation, started, outcome):
+        if operation:
+            GRAPH_OPERATION_SECONDS.labels(operation, outcome).observe(time.monotonic() - started)
+
+    def _admit(self, operation):
+        """Breakers for this call; raises CircuitOpenError if either is open"""
+        breaker = self.breakers.get(operation) if operation else None
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(breaker.name)
+        token_breaker = self.breakers.get(TOKEN_OPERATION)
+        if token_breaker is not None and not token_breaker.allow():
+            if breaker is not None:
+                breaker.release()
+            raise CircuitOpenError(token_breaker.name)
+        return breaker, token_breaker
+
+    def _token_acquired(self, breaker, token_breaker, auth, access_token):
+        if token_breaker is not None:
+            if access_token:
+                token_breaker.record_success()
+            else:
+                token_breaker.record_failure(f"no {auth} token")
+        if not access_token and breaker is not None:
+            breaker.release()
+        return bool(access_token)
+
+    def _token_failed(self, breaker, token_breaker, error):
+        """Token acquisition raised (MSAL network or DNS error): count it and hand back the admission"""
+        if token_breaker is not None:
+            token_breaker.record_failure(type(error).__name__)
+        if breaker is not None:
+            breaker.release()
+
+    def _record_outcome(self, breaker, status_code=None, error=None):
+        if breaker is None:
+            return
+        if error is not None:
+            breaker.record_failure(type(error).__name__)
+        elif status_code >= 500 or status_code == 429:
+            breaker.record_failure(f"HTTP {status_code}")
+        else:
+            breaker.record_success()
+
+    def _send(self, method, path, auth, access_token, timeout, headers, **kwargs):
+        method = method.upper()
+        url = self._url(path)
+        endpoint = endpoint_name(method, url)
+        idempotent = method in IDEMPOTENT_METHODS
+
+        request_headers = {"Authorization": f"Bearer {access_token}"}
+        if "json" in kwargs:
+            request_headers["Content-Type"] = "application/json"
+        if headers:
+            request_headers.update(headers)
+
+        started = time.monotonic()
+        attempt = 0
+        refreshed_token = False
+        while True:
+            try:
+                response = self.session.request(
+                    method, url,
+                    headers=request_headers,
+                    timeout=timeout or self.timeout,
+                    **kwargs
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # Only retry non-idempotent calls if the request never reached Graph
+                can_retry = idempotent or isinstance(e, requests.exceptions.ConnectTimeout)
+                if not can_retry or attempt >= self.max_retries:
+                    self.record_latency(endpoint, time.monotonic() - started, None, attempt)
+                    raise
+                delay = self._backoff(attempt)
+                log.warning(f"Graph {endpoint} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            if response.status_code == 401 and not refreshed_token:
+                # Token was revoked or expired early; fetch a new one and try once more
+                refreshed_token = True
+                self.token_manager.invalidate(auth, access_token)
+                access_token = self._token(auth)
+                if access_token:
+                    request_headers["Authorization"] = f"Bearer {access_token}"
+                    continue
+
+            if is_retryable(response.status_code, response.headers, idempotent) and attempt < self.max_retries:
+                delay = self._backoff(attempt, response)
+                log.warning(f"Graph {endpoint} returned {response.status_code}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            self.record_latency(endpoint, time.monotonic() - started, response.status_code, attempt)
+            return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request("PATCH", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
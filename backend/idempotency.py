@@ -0,0 +1,242 @@
+"""
+Idempotency Keys
+
+Lets a client safely repeat a POST (retries, double clicks, proxy replays)
+by sending the same Idempotency-Key. The first request with a key does the
+work; repeats within `ttl` seconds get the original response back, and
+repeats that arrive while the first is still running wait for its result
+instead of starting new work.
+
+    owner, cached = cache.begin(key, fingerprint)
+    if not owner:
+        return cached            # (body, status), or None if we gave up waiting
+    ...do the work...
+    cache.complete(key, body, status)   # or cache.fail(key) to allow a retry
+
+A key reused with a different request (different fingerprint) raises
+IdempotencyConflict.
+
+IdempotencyCache is per process; SQLiteIdempotencyCache shares keys between
+workers through a SQLite table.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+PENDING = 'pending'
+DONE = 'done'
+
+
+class IdempotencyConflict(Exception):
+    """The key was already used for a different request"""
+
+
+class _Entry:
+    __slots__ = ('fingerprint', 'state', 'response', 'expires_at', 'event')
+
+    def __init__(self, fingerprint, expires_at):
+        self.fingerprint = fingerprint
+        self.state = PENDING
+        self.response = None
+        self.expires_at = expires_at
+        self.event = threading.Event()
+
+
+class IdempotencyCache:
+    def __init__(self, ttl=600, pending_timeout=30, max_entries=10000):
+        self.ttl = ttl
+        self.pending_timeout = pending_timeout
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.started = 0
+        self.replayed = 0
+        self.waited = 0
+
+    def _live_entry(self, key, now):
+        """Caller holds the lock."""
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= now:
+            del self._entries[key]
+            entry.event.set()
+            return None
+        return entry
+
+    def _insert(self, key, entry):
+        """Caller holds the lock."""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            _, evicted = self._entries.popitem(last=False)
+            evicted.event.set()
+
+    def begin(self, key, fingerprint=None):
+        """
+        (True, None) if the caller owns the key and should do the work,
+        otherwise (False, (body, status)) with the first request's response,
+        or (False, None) if it was still running after pending_timeout.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._live_entry(key, now)
+            if entry is None:
+                self._insert(key, _Entry(fingerprint, now + self.pending_timeout))
+                self.started += 1
+                return True, None
+            if fingerprint != entry.fingerprint:
+                raise IdempotencyConflict(key)
+            if entry.state == DONE:
+                self.replayed += 1
+                return False, entry.response
+            self.waited += 1
+        entry.event.wait(self.pending_timeout)
+        return False, entry.response if entry.state == DONE else None
+
+    def complete(self, key, body, status):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.state = DONE
+            entry.response = (body, status)
+            entry.expires_at = time.time() + self.ttl
+            entry.event.set()
+
+    def fail(self, key):
+        """Forget the key so a retry does the work again"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry.event.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': len(self._entries),
+                'started': self.started,
+                'replayed': self.replayed,
+                'waited': self.waited,
+            }
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT,
+    state TEXT NOT NULL,
+    response TEXT,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency_keys (expires_at);
+"""
+
+
+class SQLiteIdempotencyCache(IdempotencyCache):
+    """
+    Keys shared by every worker through a SQLite table. Waiting for a
+    request running in another process is done by polling its row.
+    """
+
+    def __init__(self, path, ttl=600, pending_timeout=30, max_entries=10000, poll_interval=0.05):
+        super().__init__(ttl=ttl, pending_timeout=pending_timeout, max_entries=max_entries)
+        self.path = path
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._last_prune = 0.0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._connection()
+        connection.executescript(_SCHEMA)
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _row(self, key):
+        row = self._connection().execute(
+            "SELECT fingerprint, state, response, expires_at FROM idempotency_keys WHERE key = ?", (key,)
+        ).fetchone()
+        self._connection().commit()
+        return row
+
+    def begin(self, key, fingerprint=None):
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            cursor = connection.execute(
+                "INSERT INTO idempotency_keys (key, fingerprint, state, response, expires_at) "
+                "VALUES (?, ?, ?, NULL, ?) "
+                "ON CONFLICT(key) DO UPDATE SET fingerprint = excluded.fingerprint, state = excluded.state, "
+                "response = NULL, expires_at = excluded.expires_at "
+                "WHERE idempotency_keys.expires_at <= ?",
+                (key, fingerprint, PENDING, now + self.pending_timeout, now)
+            )
+            owner = cursor.rowcount == 1
+            if now - self._last_prune > 60:
+                self._last_prune = now
+                connection.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (now,))
+        if owner:
+            with self._lock:
+                self.started += 1
+            return True, None
+
+        deadline = now + self.pending_timeout
+        counted = False
+        while True:
+            row = self._row(key)
+            if row is None:
+                # The first request failed and released the key; give up rather than race it
+                return False, None
+            row_fingerprint, state, response, _ = row
+            if row_fingerprint != fingerprint:
+                raise IdempotencyConflict(key)
+            if state == DONE:
+                body, status = json.loads(response)
+                with self._lock:
+                    if counted:
+                        self.waited += 1
+                    else:
+                        self.replayed += 1
+                return False, (body, status)
+            counted = True
+            if time.time() >= deadline:
+                with self._lock:
+                    self.waited += 1
+                return False, None
+            time.sleep(self.poll_interval)
+
+    def complete(self, key, body, status):
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "UPDATE idempotency_keys SET state = ?, response = ?, expires_at = ? WHERE key = ?",
+                (DONE, json.dumps([body, status]), time.time() + self.ttl, key)
+            )
+
+    def fail(self, key):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM idempotency_keys WHERE key = ?", (key,))
+
+    def stats(self):
+        stats = super().stats()
+        stats['keys'] = self._connection().execute("SELECT COUNT(*) FROM idempotency_keys").fetchone()[0]
+        return stats
+
+
+def create_idempotency_cache(backend, path=None, **options):
+    """Shared (sqlite) cache when conversations are shared, otherwise in-process"""
+    if backend == 'sqlite':
+        return SQLiteIdempotencyCache(path or "conversations.db", **options)
+    return IdempotencyCache(**options)
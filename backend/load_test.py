@@ -0,0 +1,429 @@
+"""
+Load Test
+
+Drives a running backend with concurrent support conversations and extra
+Socket.IO listeners, then reports throughput, latency percentiles and how
+much the server's memory grew. Meant to run against fake_graph.py (see its
+docstring for wiring the backend to it).
+
+Each conversation connects a socket, POSTs /api/support, registers for the
+request's room, waits for the agent's first reply, then sends --messages
+follow-ups through /api/message and waits for their 'message_delivery'
+events. --listeners further sockets register to the conversations' rooms
+and stay connected until the run ends.
+
+    python load_test.py --conversations 500 --rate 20 --listeners 3000 --save-baseline main
+    python load_test.py --conversations 500 --rate 20 --listeners 3000 --compare main
+
+Results are saved as JSON in --baseline-dir; --compare prints the change
+against a saved run and, with --fail-on-regression, exits 1 when a latency
+percentile, the throughput or the memory growth got worse than --tolerance.
+Memory is read from the process_resident_memory_bytes gauge on /metrics, so
+with scale_out.py it reflects whichever worker answers the scrape; pass
+--metrics-token (default: METRICS_TOKEN or ADMIN_TOKEN from the environment).
+
+Needs aiohttp (python-socketio's asyncio client).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+import aiohttp
+import socketio
+
+
+LATENCY_SERIES = ("socket_connect", "support_post", "first_reply", "message_post", "message_delivery")
+
+# Lower is better for these; a higher value than the baseline is a regression
+LATENCY_PERCENTILES = ("p50", "p95", "p99")
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": values[-1],
+    }
+
+
+class Recorder:
+    """Latency samples (seconds) and outcome counts for one run"""
+
+    def __init__(self):
+        self.latencies = {name: [] for name in LATENCY_SERIES}
+        self.counts = Counter()
+
+    def observe(self, name, started):
+        self.latencies[name].append(time.perf_counter() - started)
+
+    def count(self, name, amount=1):
+        self.counts[name] += amount
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.target = args.target.rstrip("/")
+        self.recorder = Recorder()
+        self.request_ids = []
+        self.request_available = asyncio.Event()
+        self.done = asyncio.Event()
+        self.connect_slots = asyncio.Semaphore(args.connect_concurrency)
+        self.memory_samples = []
+        self.session = None
+        self.socket_session = None
+
+    # Server observations
+
+    async def server_memory(self):
+        try:
+            headers = {"Authorization": f"Bearer {self.args.metrics_token}"} if self.args.metrics_token else None
+            async with self.session.get(f"{self.target}/metrics", headers=headers) as response:
+                if response.status != 200:
+                    return None
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+        for line in text.splitlines():
+            if line.startswith("process_resident_memory_bytes "):
+                return float(line.split()[1])
+        return None
+
+    async def sample_memory(self):
+        while not self.done.is_set():
+            value = await self.server_memory()
+            if value is not None:
+                self.memory_samples.append(value)
+            try:
+                await asyncio.wait_for(self.done.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+
+    async def fake_graph_stats(self):
+        if not self.args.fake_graph:
+            return None
+        try:
+            async with self.session.get(f"{self.args.fake_graph.rstrip('/')}/_fake/stats", ssl=False) as response:
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+
+    # Clients
+
+    async def connect(self, client):
+        async with self.connect_slots:
+            started = time.perf_counter()
+            try:
+                await client.connect(self.target, transports=["websocket"], wait_timeout=self.args.timeout)
+            except (socketio.exceptions.ConnectionError, asyncio.TimeoutError):
+                self.recorder.count("socket_connect_failed")
+                return False
+            self.recorder.observe("socket_connect", started)
+            return True
+
+    async def post(self, path, payload, series):
+        started = time.perf_counter()
+        try:
+            async with self.session.post(f"{self.target}{path}", json=payload) as response:
+                body = await response.json(content_type=None)
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            self.recorder.count(f"{series}_error")
+            return None, None
+        self.recorder.observe(series, started)
+        self.recorder.count(f"{series}_{status}")
+        return status, body
+
+    async def conversation(self, index):
+        args = self.args
+        client = socketio.AsyncClient(reconnection=False, http_session=self.socket_session)
+        replies = asyncio.Queue()
+        deliveries = {}
+
+        @client.on("support_response")
+        async def on_response(data):
+            replies.put_nowait(data)
+
+        @client.on("message_delivery")
+        async def on_delivery(data):
+            self.recorder.count(f"message_delivery_{data.get('status')}")
+            for client_message_id in data.get("clientMessageIds", []):
+                waiter = deliveries.pop(client_message_id, None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(data.get("status"))
+
+        if not await self.connect(client):
+            return
+        try:
+            started = time.perf_counter()
+            status, body = await self.post("/api/support", {
+                "message": f"Load test request {index}",
+                "userName": f"Load User {index}",
+                "userEmail": f"load{index}@example.com"
+            }, "support_post")
+            if status != 200:
+                return
+            request_id = body["requestId"]
+            await client.emit("register", {"requestId": request_id})
+            self.request_ids.append(request_id)
+            self.request_available.set()
+
+            try:
+                await asyncio.wait_for(replies.get(), timeout=args.timeout)
+                self.recorder.observe("first_reply", started)
+            except asyncio.TimeoutError:
+                self.recorder.count("first_reply_timeout")
+
+            for number in range(args.messages):
+                await asyncio.sleep(random.uniform(0, 2 * args.think_time))
+                client_message_id = str(uuid.uuid4())
+                delivered = deliveries[client_message_id] = asyncio.get_running_loop().create_future()
+                sent = time.perf_counter()
+                status, _ = await self.post("/api/message", {
+                    "requestId": request_id,
+                    "message": f"Follow-up {number} for request {index}",
+                    "clientMessageId": client_message_id
+                }, "message_post")
+                if status != 202:
+                    deliveries.pop(client_message_id, None)
+                    continue
+                try:
+                    await asyncio.wait_for(delivered, timeout=args.timeout)
+                    self.recorder.observe("message_delivery", sent)
+                except asyncio.TimeoutError:
+                    self.recorder.count("message_delivery_timeout")
+
+            # Give the agent's answers to the follow-ups a moment to arrive
+            await asyncio.sleep(args.linger)
+            self.recorder.count("agent_replies", replies.qsize())
+            if args.end_conversations:
+                await client.emit("unregister", {"requestId": request_id})
+        finally:
+            await client.disconnect()
+
+    async def listener(self):
+        await self.request_available.wait()
+        client = socketio.AsyncClient(reconnection=False, http_session=self.socket_session)
+
+        @client.on("*")
+        async def on_event(event, data):
+            self.recorder.count("listener_events")
+
+        if not await self.connect(client):
+            return
+        try:
+            await client.emit("register", {"requestId": random.choice(self.request_ids)})
+            await self.done.wait()
+        finally:
+            await client.disconnect()
+
+    # Run
+
+    async def run(self):
+        args = self.args
+        connector = aiohttp.TCPConnector(limit=args.http_connections, ssl=False)
+        # Sockets hold their connection for the whole run, so they get their own unlimited pool
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=args.timeout)) as session, \
+                aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as socket_session:
+            self.session = session
+            self.socket_session = socket_session
+            memory_before = await self.server_memory()
+            graph_before = await self.fake_graph_stats()
+            sampler = asyncio.create_task(self.sample_memory())
+            listeners = [asyncio.create_task(self.listener()) for _ in range(args.listeners)]
+
+            started = time.perf_counter()
+            conversations = []
+            for index in range(args.conversations):
+                conversations.append(asyncio.create_task(self.conversation(index)))
+                if args.rate:
+                    await asyncio.sleep(1 / args.rate)
+            await asyncio.gather(*conversations)
+            elapsed = time.perf_counter() - started
+
+            # Release listeners still waiting for a room if no conversation got one
+            self.request_available.set()
+            if not self.request_ids:
+                self.request_ids.append(str(uuid.uuid4()))
+            self.done.set()
+            await asyncio.gather(*listeners, sampler)
+            memory_after = await self.server_memory()
+            graph_after = await self.fake_graph_stats()
+        return self.results(elapsed, memory_before, memory_after, graph_before, graph_after)
+
+    def results(self, elapsed, memory_before, memory_after, graph_before, graph_after):
+        recorder = self.recorder
+        samples = [value for value in self.memory_samples + [memory_before, memory_after] if value is not None]
+        memory = {
+            "start_bytes": memory_before,
+            "end_bytes": memory_after,
+            "peak_bytes": max(samples) if samples else None,
+            "growth_bytes": memory_after - memory_before if memory_before and memory_after else None,
+        }
+        fake_graph = None
+        if graph_after:
+            fake_graph = {
+                "requests": graph_after["requests_total"] - (graph_before or {}).get("requests_total", 0),
+                "throttled": graph_after["throttled_total"] - (graph_before or {}).get("throttled_total", 0),
+                "notifications": graph_after.get("notifications"),
+            }
+        return {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "config": {key: value for key, value in vars(self.args).items()
+                       if key not in ("save_baseline", "compare", "baseline_dir", "fail_on_regression")},
+            "elapsed_s": elapsed,
+            "throughput": {
+                "support_per_s": len(recorder.latencies["support_post"]) / elapsed if elapsed else 0,
+                "messages_per_s": len(recorder.latencies["message_post"]) / elapsed if elapsed else 0,
+            },
+            "latency": {name: summarize(values) for name, values in recorder.latencies.items()},
+            "counts": dict(sorted(recorder.counts.items())),
+            "memory": memory,
+            "fake_graph": fake_graph,
+        }
+
+
+def format_ms(value):
+    return "-" if value is None else f"{value * 1000:.1f}"
+
+
+def format_mb(value):
+    return "-" if value is None else f"{value / (1024 * 1024):.1f} MB"
+
+
+def print_report(results):
+    config = results["config"]
+    print(f"\n{config['conversations']} conversations, {config['listeners']} listeners, "
+          f"{config['messages']} follow-ups each, {results['elapsed_s']:.1f}s")
+    throughput = results["throughput"]
+    print(f"Throughput: {throughput['support_per_s']:.1f} support requests/s, "
+          f"{throughput['messages_per_s']:.1f} messages/s")
+    print(f"\n{'latency (ms)':<18}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for name, summary in results["latency"].items():
+        print(f"{name:<18}{summary['count']:>8}" + "".join(
+            f"{format_ms(summary.get(key)):>10}" for key in ("p50", "p95", "p99", "max")
+        ))
+    print("\nOutcomes: " + ", ".join(f"{name}={count}" for name, count in results["counts"].items()))
+    memory = results["memory"]
+    growth = memory["growth_bytes"]
+    print(f"Server memory: start {format_mb(memory['start_bytes'])}, end {format_mb(memory['end_bytes'])}, "
+          f"peak {format_mb(memory['peak_bytes'])}, growth "
+          f"{'-' if growth is None else ('+' if growth >= 0 else '') + format_mb(growth)}")
+    if results["fake_graph"]:
+        graph = results["fake_graph"]
+        print(f"Fake Graph: {graph['requests']} requests, {graph['throttled']} throttled, "
+              f"notifications {graph['notifications']}")
+
+
+def format_scaled(value, scale):
+    return "-" if value is None else f"{value * scale:.1f}"
+
+
+def relative_change(current, baseline):
+    if current is None or not baseline:
+        return None
+    return (current - baseline) / baseline
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against a baseline; returns the list of regressions"""
+    rows = []
+    for name, summary in results["latency"].items():
+        base = baseline["latency"].get(name, {})
+        for key in LATENCY_PERCENTILES:
+            rows.append((f"{name} {key} (ms)", summary.get(key), base.get(key), True, 1000))
+    for key, value in results["throughput"].items():
+        rows.append((key, value, baseline["throughput"].get(key), False, 1))
+    rows.append(("memory growth (MB)", results["memory"]["growth_bytes"],
+                 baseline["memory"].get("growth_bytes"), True, 1 / (1024 * 1024)))
+
+    regressions = []
+    print(f"\nCompared with baseline from {baseline['created']}:")
+    different = sorted(key for key, value in results["config"].items()
+                       if key != "tolerance" and baseline["config"].get(key) != value)
+    if different:
+        print(f"  (scenario differs from the baseline in: {', '.join(different)})")
+    for label, current, base, lower_is_better, scale in rows:
+        change = relative_change(current, base)
+        regressed = change is not None and (change > tolerance if lower_is_better else change < -tolerance)
+        if regressed:
+            regressions.append(label)
+        print(f"  {label:<34}{format_scaled(base, scale):>10} -> {format_scaled(current, scale):>10}"
+              f"{'' if change is None else f'  {change:+.0%}'}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def baseline_path(baseline_dir, name):
+    return os.path.join(baseline_dir, f"{name}.json")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the support chat backend")
+    parser.add_argument("--target", default="http://127.0.0.1:5001")
+    parser.add_argument("--metrics-token", default=os.environ.get("METRICS_TOKEN") or os.environ.get("ADMIN_TOKEN"),
+                        help="bearer token for /metrics")
+    parser.add_argument("--fake-graph", default="https://127.0.0.1:8443", help="fake_graph.py URL for its stats")
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=10, help="new conversations per second (0: all at once)")
+    parser.add_argument("--messages", type=int, default=2, help="follow-ups per conversation")
+    parser.add_argument("--think-time", type=float, default=0.5, help="mean seconds between follow-ups")
+    parser.add_argument("--listeners", type=int, default=0, help="extra sockets registered to conversation rooms")
+    parser.add_argument("--linger", type=float, default=2, help="seconds a conversation waits for late replies")
+    parser.add_argument("--end-conversations", action="store_true", help="unregister when a conversation is done")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--http-connections", type=int, default=200)
+    parser.add_argument("--baseline-dir", default="load_baselines")
+    parser.add_argument("--save-baseline", metavar="NAME")
+    parser.add_argument("--compare", metavar="NAME")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change counted as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(baseline_path(args.baseline_dir, args.compare)) as f:
+            baseline = json.load(f)
+
+    results = asyncio.run(LoadTest(args).run())
+    print_report(results)
+
+    if args.save_baseline:
+        os.makedirs(args.baseline_dir, exist_ok=True)
+        path = baseline_path(args.baseline_dir, args.save_baseline)
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved baseline to {path}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions and args.fail_on_regression:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
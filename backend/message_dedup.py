@@ -0,0 +1,223 @@
+"""
+Teams Message Deduplication
+
+Graph can deliver the same change notification more than once, and the
+webhook, rich notification and delta polling paths can all see the same
+message. Before a message is fetched or forwarded it must be claimed here:
+
+- the first claim wins and the caller processes the message
+- claims made while it's in flight or after it was processed are refused,
+  so duplicate notifications cost one Graph fetch and one emit
+- complete() keeps the message marked as done for `ttl` seconds;
+  release() (after a failure) lets a redelivery try again
+- is_in_flight() tells a refused claim for a message still being handled
+  from one already done: the webhook asks Graph to redeliver the former,
+  since the attempt in flight may yet fail and release its claim
+- an in-flight claim that is never completed expires after claim_timeout
+
+MessageDeduplicator keeps entries in a bounded in-process LRU.
+SQLiteMessageDeduplicator additionally records claims in a SQLite table so
+that several worker processes coalesce on the same message.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+INFLIGHT = 'inflight'
+DONE = 'done'
+
+
+def dedup_key(request_id, message_id):
+    """Teams message IDs are only unique within a chat, so key on the request too"""
+    return f"{request_id}:{message_id}"
+
+
+class MessageDeduplicator:
+    """In-process dedup with a TTL and a cap on the number of remembered messages"""
+
+    def __init__(self, ttl=24 * 3600, claim_timeout=120, max_entries=100000):
+        self.ttl = ttl
+        self.claim_timeout = claim_timeout
+        self.max_entries = max_entries
+        # key -> (state, expires_at), oldest first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.claimed = 0
+        self.duplicates = 0
+        self.evicted = 0
+
+    def _live_state(self, key, now):
+        """State of key if it hasn't expired. Caller holds the lock."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            del self._entries[key]
+            return None
+        return entry[0]
+
+    def _set(self, key, state, expires_at):
+        """Caller holds the lock."""
+        self._entries[key] = (state, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evicted += 1
+
+    def claim(self, key):
+        """True if the caller should process this message, False if it's a duplicate"""
+        now = time.time()
+        with self._lock:
+            if self._live_state(key, now) is not None:
+                self.duplicates += 1
+                return False
+            self._set(key, INFLIGHT, now + self.claim_timeout)
+            self.claimed += 1
+            return True
+
+    def complete(self, key):
+        with self._lock:
+            self._set(key, DONE, time.time() + self.ttl)
+
+    def release(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def is_done(self, key):
+        with self._lock:
+            return self._live_state(key, time.time()) == DONE
+
+    def is_in_flight(self, key):
+        with self._lock:
+            return self._live_state(key, time.time()) == INFLIGHT
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'claimed': self.claimed,
+                'duplicates': self.duplicates,
+                'evicted': self.evicted,
+            }
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS message_dedup (
+    key TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_message_dedup_expires ON message_dedup (expires_at);
+"""
+
+
+class SQLiteMessageDeduplicator(MessageDeduplicator):
+    """
+    Dedup shared by every worker on the host through a SQLite table.
+    The in-process LRU answers repeat lookups for messages this worker
+    already finished without touching the database.
+    """
+
+    def __init__(self, path, ttl=24 * 3600, claim_timeout=120, max_entries=100000, prune_interval=60):
+        super().__init__(ttl=ttl, claim_timeout=claim_timeout, max_entries=max_entries)
+        self.path = path
+        self.prune_interval = prune_interval
+        self._local = threading.local()
+        self._last_prune = 0.0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._connection()
+        connection.executescript(_SCHEMA)
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def claim(self, key):
+        if super().is_done(key):
+            with self._lock:
+                self.duplicates += 1
+            return False
+
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            # Insert, or take over an expired claim; no row changes means someone holds it
+            cursor = connection.execute(
+                "INSERT INTO message_dedup (key, state, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at "
+                "WHERE message_dedup.expires_at <= ?",
+                (key, INFLIGHT, now + self.claim_timeout, now)
+            )
+            won = cursor.rowcount == 1
+        self._maybe_prune(now)
+
+        with self._lock:
+            if won:
+                self.claimed += 1
+                self._set(key, INFLIGHT, now + self.claim_timeout)
+            else:
+                self.duplicates += 1
+        return won
+
+    def complete(self, key):
+        super().complete(key)
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "UPDATE message_dedup SET state = ?, expires_at = ? WHERE key = ?",
+                (DONE, time.time() + self.ttl, key)
+            )
+
+    def release(self, key):
+        super().release(key)
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM message_dedup WHERE key = ?", (key,))
+
+    def is_in_flight(self, key):
+        # Another worker may hold the claim, so ask the shared table
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT state FROM message_dedup WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        connection.commit()
+        return row is not None and row[0] == INFLIGHT
+
+    def _maybe_prune(self, now):
+        if now - self._last_prune < self.prune_interval:
+            return
+        self._last_prune = now
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM message_dedup WHERE expires_at <= ?", (now,))
+            # Enforce the size cap by dropping the entries closest to expiry
+            connection.execute(
+                "DELETE FROM message_dedup WHERE key IN ("
+                "SELECT key FROM message_dedup ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def stats(self):
+        stats = super().stats()
+        row = self._connection().execute("SELECT COUNT(*) FROM message_dedup").fetchone()
+        stats['shared_entries'] = row[0]
+        return stats
+
+
+def create_message_deduplicator(backend, path=None, **options):
+    """Shared (sqlite) dedup when conversations are shared, otherwise in-process"""
+    if backend == 'sqlite':
+        return SQLiteMessageDeduplicator(path or "conversations.db", **options)
+    return MessageDeduplicator(**options)
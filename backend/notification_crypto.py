@@ -0,0 +1,312 @@
+"""
+Rich Notification Decryption
+
+Graph change notifications created with includeResourceData carry the
+changed resource inline, encrypted for a certificate we supply:
+
+- dataKey: a random symmetric key, RSA-OAEP encrypted with our public key
+- dataSignature: HMAC-SHA256 of the encrypted data, keyed with that symmetric key
+- data: the resource JSON, AES-CBC encrypted (PKCS7 padding, IV = first 16 key bytes)
+
+Certificates live in NOTIFICATION_CERT_DIR as <certificate id>.pem /
+<certificate id>.key pairs. Several pairs may be present at once so that a
+new certificate can be rolled out while notifications for subscriptions
+created with the previous one are still arriving. An unknown certificate id
+rereads the directory at most once per reload_interval.
+
+Anyone who can reach the webhook and knows a clientState can encrypt a
+notification for our public certificate, so the decrypted content is only
+trusted once the payload's validationTokens check out: JWTs issued by Azure
+AD for our tenant, with our app id as audience, for the Graph change
+notification publisher, signed by a key from the identity platform's JWKS.
+
+Requires the optional 'cryptography' and 'PyJWT' packages (both come with msal).
+"""
+
+import base64
+import glob
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+import requests
+
+from structured_log import get_logger
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, padding, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding as asym_padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:  # pragma: no cover - optional dependency
+    x509 = None
+
+try:
+    import jwt
+except ImportError:  # pragma: no cover - optional dependency
+    jwt = None
+
+
+log = get_logger(__name__)
+
+
+class NotificationDecryptionError(Exception):
+    """Raised when an encrypted notification can't be verified or decrypted"""
+
+
+class NotificationValidationError(Exception):
+    """Raised when a notification's validationTokens don't prove it came from Graph"""
+
+
+class ValidationKeysUnavailable(NotificationValidationError):
+    """Raised when the signing keys can't be fetched, so the tokens can't be checked either way"""
+
+
+def crypto_available():
+    return x509 is not None
+
+
+class _Certificate:
+    def __init__(self, certificate_id, cert_pem, key_pem):
+        self.certificate_id = certificate_id
+        self.certificate = x509.load_pem_x509_certificate(cert_pem)
+        self.private_key = serialization.load_pem_private_key(key_pem, password=None)
+        der = self.certificate.public_bytes(serialization.Encoding.DER)
+        # Graph wants the base64 DER certificate and reports a SHA-1 thumbprint
+        self.encoded = base64.b64encode(der).decode()
+        self.thumbprint = hashlib.sha1(der).hexdigest().upper()
+        self.not_valid_after = self.certificate.not_valid_after_utc
+
+
+class EncryptionKeyRing:
+    """
+    The certificates we can decrypt notifications with.
+    current() is the certificate new subscriptions should be created with;
+    older certificates stay available for decryption until removed from disk.
+    """
+
+    def __init__(self, cert_dir=None, current_id=None, reload_interval=60):
+        self.cert_dir = cert_dir
+        self.current_id = current_id
+        self.reload_interval = reload_interval
+        self._certificates = {}
+        self._lock = threading.Lock()
+        self._last_reload = None
+        if cert_dir:
+            self.reload()
+
+    def add(self, certificate_id, cert_pem, key_pem, make_current=True):
+        """Register a certificate/private key pair (PEM bytes)"""
+        if not crypto_available():
+            raise NotificationDecryptionError("The 'cryptography' package is required for rich notifications")
+        certificate = _Certificate(certificate_id, cert_pem, key_pem)
+        with self._lock:
+            self._certificates[certificate_id] = certificate
+            if make_current or self.current_id not in self._certificates:
+                self.current_id = certificate_id
+        return certificate
+
+    def reload(self):
+        """Pick up certificates added to or removed from cert_dir"""
+        if not self.cert_dir or not crypto_available():
+            return
+        self._last_reload = time.monotonic()
+        loaded = {}
+        newest = None
+        for cert_path in glob.glob(os.path.join(self.cert_dir, "*.pem")):
+            certificate_id = os.path.splitext(os.path.basename(cert_path))[0]
+            key_path = os.path.join(self.cert_dir, f"{certificate_id}.key")
+            if not os.path.exists(key_path):
+                continue
+            try:
+                with open(cert_path, "rb") as f:
+                    cert_pem = f.read()
+                with open(key_path, "rb") as f:
+                    key_pem = f.read()
+                loaded[certificate_id] = _Certificate(certificate_id, cert_pem, key_pem)
+            except Exception as e:
+                log.error(f"Error loading notification certificate {certificate_id}: {str(e)}")
+                continue
+            mtime = os.path.getmtime(cert_path)
+            if newest is None or mtime > newest[0]:
+                newest = (mtime, certificate_id)
+
+        with self._lock:
+            self._certificates = loaded
+            # An explicitly configured id wins; otherwise the most recently added file
+            if self.current_id not in loaded:
+                self.current_id = newest[1] if newest else None
+        log.info(f"Loaded notification certificates: {sorted(loaded)} (current: {self.current_id})")
+
+    def current(self):
+        with self._lock:
+            return self._certificates.get(self.current_id)
+
+    def get(self, certificate_id):
+        with self._lock:
+            certificate = self._certificates.get(certificate_id)
+        if certificate is None and self._reload_due():
+            # The certificate may have been rotated in since we last looked
+            self.reload()
+            with self._lock:
+                certificate = self._certificates.get(certificate_id)
+        return certificate
+
+    def _reload_due(self):
+        """Rereading the directory for every bogus certificate id would let any caller make us hit the disk"""
+        if not self.cert_dir:
+            return False
+        with self._lock:
+            if self._last_reload is not None and time.monotonic() - self._last_reload < self.reload_interval:
+                return False
+            self._last_reload = time.monotonic()
+            return True
+
+    def subscription_fields(self):
+        """Extra subscription properties needed to receive resource data"""
+        certificate = self.current()
+        if certificate is None:
+            return None
+        return {
+            "includeResourceData": True,
+            "encryptionCertificate": certificate.encoded,
+            "encryptionCertificateId": certificate.certificate_id,
+        }
+
+
+def decrypt_notification_content(key_ring, encrypted_content):
+    """
+    Verify and decrypt a notification's encryptedContent.
+    Returns the embedded resource as a dict.
+    """
+    if not crypto_available():
+        raise NotificationDecryptionError("The 'cryptography' package is not installed")
+
+    certificate_id = encrypted_content.get("encryptionCertificateId")
+    certificate = key_ring.get(certificate_id)
+    if certificate is None:
+        raise NotificationDecryptionError(f"Unknown encryption certificate: {certificate_id}")
+
+    thumbprint = encrypted_content.get("encryptionCertificateThumbprint")
+    if thumbprint and thumbprint.upper() != certificate.thumbprint:
+        raise NotificationDecryptionError(f"Certificate thumbprint mismatch for {certificate_id}")
+
+    try:
+        data = base64.b64decode(encrypted_content["data"])
+        signature = base64.b64decode(encrypted_content["dataSignature"])
+        symmetric_key = certificate.private_key.decrypt(
+            base64.b64decode(encrypted_content["dataKey"]),
+            asym_padding.OAEP(mgf=asym_padding.MGF1(algorithm=hashes.SHA1()), algorithm=hashes.SHA1(), label=None)
+        )
+    except (KeyError, ValueError) as e:
+        raise NotificationDecryptionError(f"Malformed encrypted content: {str(e)}")
+
+    expected_signature = hmac.new(symmetric_key, data, hashlib.sha256).digest()
+    if not hmac.compare_digest(expected_signature, signature):
+        raise NotificationDecryptionError("Notification data signature does not match")
+
+    try:
+        decryptor = Cipher(algorithms.AES(symmetric_key), modes.CBC(symmetric_key[:16])).decryptor()
+        padded = decryptor.update(data) + decryptor.finalize()
+        unpadder = padding.PKCS7(128).unpadder()
+        plaintext = unpadder.update(padded) + unpadder.finalize()
+        return json.loads(plaintext)
+    except ValueError as e:
+        raise NotificationDecryptionError(f"Could not decrypt notification data: {str(e)}")
+
+
+# App id Graph's change notification service signs validation tokens as
+GRAPH_NOTIFICATION_PUBLISHER = "0bf30f3b-4a52-48df-9a82-234910c4a086"
+
+
+class ValidationTokenValidator:
+    """
+    Checks the validationTokens Graph sends with rich notifications.
+    Signing keys come from jwks_url and are refetched at most once per
+    refresh_interval when a token names an unknown key id; tokens that
+    passed are remembered until they expire, since Graph reuses them
+    across a burst of notifications.
+    """
+
+    def __init__(self, app_id, tenant_id, jwks_url, authority_host="https://login.microsoftonline.com",
+                 refresh_interval=300, max_cached=1000):
+        self.app_id = app_id
+        self.issuers = [f"https://sts.windows.net/{tenant_id}/", f"{authority_host}/{tenant_id}/v2.0"]
+        self.jwks_url = jwks_url
+        self.refresh_interval = refresh_interval
+        self.max_cached = max_cached
+        self._keys = {}
+        self._keys_fetched = None
+        self._valid = {}
+        self._lock = threading.Lock()
+
+    def validate(self, tokens):
+        """
+        Raise NotificationValidationError unless there is at least one token
+        and every one of them is valid.
+        """
+        if jwt is None or not crypto_available():
+            raise ValidationKeysUnavailable("The 'PyJWT' and 'cryptography' packages are required")
+        if not tokens or not isinstance(tokens, list):
+            raise NotificationValidationError("Notification has no validationTokens")
+        for token in tokens:
+            self._validate_token(token)
+
+    def _validate_token(self, token):
+        now = time.time()
+        with self._lock:
+            expires = self._valid.get(token)
+        if expires is not None and expires > now:
+            return
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+        except jwt.PyJWTError as e:
+            raise NotificationValidationError(f"Malformed validation token: {str(e)}")
+        try:
+            claims = jwt.decode(
+                token, self._signing_key(kid), algorithms=["RS256"], audience=self.app_id,
+                issuer=self.issuers, options={"require": ["exp", "iss", "aud"]}
+            )
+        except jwt.PyJWTError as e:
+            raise NotificationValidationError(f"Invalid validation token: {str(e)}")
+        if claims.get("azp", claims.get("appid")) != GRAPH_NOTIFICATION_PUBLISHER:
+            raise NotificationValidationError("Validation token was not issued to Graph change notifications")
+        with self._lock:
+            if len(self._valid) >= self.max_cached:
+                self._valid = {cached: expiry for cached, expiry in self._valid.items() if expiry > now}
+            if len(self._valid) < self.max_cached:
+                self._valid[token] = claims["exp"]
+
+    def _signing_key(self, kid):
+        with self._lock:
+            key = self._keys.get(kid)
+            due = self._keys_fetched is None or time.monotonic() - self._keys_fetched >= self.refresh_interval
+            if key is None and due:
+                # Claim the refresh before fetching so a flood of unknown key ids causes one fetch
+                self._keys_fetched = time.monotonic()
+        if key is not None:
+            return key
+        if not due:
+            # Can't tell a forged key id from a key rotated in since the last fetch
+            raise ValidationKeysUnavailable(f"Validation token signing key {kid} not loaded")
+        self._refresh_keys()
+        with self._lock:
+            key = self._keys.get(kid)
+        if key is None:
+            raise NotificationValidationError(f"Unknown validation token signing key: {kid}")
+        return key
+
+    def _refresh_keys(self):
+        try:
+            response = requests.get(self.jwks_url, timeout=10)
+            response.raise_for_status()
+            key_set = jwt.PyJWKSet.from_dict(response.json())
+        except (requests.RequestException, ValueError, jwt.PyJWTError) as e:
+            raise ValidationKeysUnavailable(f"Could not fetch validation token signing keys: {str(e)}")
+        keys = {key.key_id: key.key for key in key_set.keys}
+        with self._lock:
+            self._keys = keys
+        log.info(f"Loaded {len(keys)} validation token signing keys from {self.jwks_url}")
@@ -0,0 +1,257 @@
+"""
+Outbound Message Queue
+
+Customer follow-up messages are queued per chat instead of being posted to
+Teams from the HTTP request:
+
+- messages that arrive within coalesce_window of each other are merged
+  into one Teams message, in the order they were sent
+- each chat has its own token bucket, and one bucket is shared by the
+  whole app, matching Teams' per-chat and per-app write limits, so bursts
+  are smoothed out instead of turning into 429s
+- a chat never has more than one send in flight, which keeps ordering
+- on_result(key, items, result) is called after every send; result is
+  whatever send() returned (None on failure)
+- sends run on the queue's own workers, or are handed to submit(fn, *args)
+  (which returns False when it can't take them) to share a pool
+- send may be a coroutine function if submit runs coroutine tasks (a
+  WorkerPool after use_event_loop); on_result then runs on a thread
+
+The per-app bucket is per process; with several workers, divide the app
+rate between them.
+"""
+
+import asyncio
+import heapq
+import inspect
+import itertools
+import threading
+import time
+from collections import deque
+
+from worker_pool import WorkerPool
+from structured_log import get_logger
+
+
+log = get_logger(__name__)
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+
+    def wait_time(self, now=None):
+        """Seconds until a token is available (0 if one is available now)"""
+        now = time.monotonic() if now is None else now
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def take(self):
+        self._tokens -= 1
+
+
+class _ChatState:
+    __slots__ = ('key', 'chat_id', 'pending', 'bucket', 'in_flight', 'due', 'last_active')
+
+    def __init__(self, key, chat_id, bucket):
+        self.key = key
+        self.chat_id = chat_id
+        self.pending = deque()
+        self.bucket = bucket
+        self.in_flight = False
+        self.due = None
+        self.last_active = time.monotonic()
+
+
+class OutboundMessageQueue:
+    """
+    send(chat_id, items) posts one Teams message built from the queued items
+    and returns the created message (or None on failure).
+    """
+
+    def __init__(self, send, on_result, coalesce_window=0.3, max_batch=10, max_pending=50,
+                 chat_rate=1.0, chat_burst=3, app_rate=20.0, app_burst=40, workers=4, idle_timeout=600,
+                 submit=None):
+        self.send = send
+        self.on_result = on_result
+        self.coalesce_window = coalesce_window
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.idle_timeout = idle_timeout
+
+        self._app_bucket = TokenBucket(app_rate, app_burst)
+        self._chats = {}
+        # (due, seq, key); stale entries are skipped by comparing with state.due
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._dispatcher = None
+        self._senders = None if submit else WorkerPool("outbound", workers=workers, max_queue=workers * 4)
+        self._submit = submit or self._senders.submit
+        self._last_sweep = time.monotonic()
+
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.rate_limited = 0
+
+    def start(self):
+        with self._lock:
+            if self._dispatcher and self._dispatcher.is_alive():
+                return
+            self._dispatcher = threading.Thread(target=self._run, name="outbound-dispatcher", daemon=True)
+            self._dispatcher.start()
+
+    def enqueue(self, key, chat_id, item):
+        """Queue an item for the chat; returns False if the chat's queue is full"""
+        self.start()
+        now = time.monotonic()
+        with self._lock:
+            state = self._chats.get(key)
+            if state is None:
+                state = _ChatState(key, chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+                self._chats[key] = state
+            if len(state.pending) >= self.max_pending:
+                self.rejected += 1
+                return False
+            state.chat_id = chat_id
+            state.pending.append(item)
+            state.last_active = now
+            self.enqueued += 1
+            if not state.in_flight:
+                # Give the rest of a burst a moment to arrive, unless a full batch is already waiting
+                due = now if len(state.pending) >= self.max_batch else now + self.coalesce_window
+                if state.due is None or due < state.due:
+                    self._schedule(state, due)
+        return True
+
+    def forget(self, key):
+        """Drop a chat's state and anything still queued for it"""
+        with self._lock:
+            state = self._chats.pop(key, None)
+            if state is not None:
+                state.pending.clear()
+                state.due = None
+
+    def depth(self, key=None):
+        with self._lock:
+            if key is not None:
+                state = self._chats.get(key)
+                return len(state.pending) if state else 0
+            return sum(len(state.pending) for state in self._chats.values())
+
+    def _schedule(self, state, due):
+        """Caller holds the lock."""
+        state.due = due
+        heapq.heappush(self._heap, (due, next(self._seq), state.key))
+        self._wakeup.set()
+
+    def _run(self):
+        deliver = self._adeliver if inspect.iscoroutinefunction(self.send) else self._deliver
+        while True:
+            ready, delay = self._pop_ready()
+            for state, batch in ready:
+                if not self._submit(deliver, state, batch):
+                    with self._lock:
+                        state.pending.extendleft(reversed(batch))
+                        state.in_flight = False
+                        self._schedule(state, time.monotonic() + 0.1)
+            self._wakeup.wait(timeout=delay)
+            self._wakeup.clear()
+
+    def _pop_ready(self):
+        """Batches that may be sent now, and how long to sleep before the next check"""
+        ready = []
+        now = time.monotonic()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due, _, key = heapq.heappop(self._heap)
+                state = self._chats.get(key)
+                if state is None or state.due != due or state.in_flight or not state.pending:
+                    continue
+                wait = max(state.bucket.wait_time(now), self._app_bucket.wait_time(now))
+                if wait > 0:
+                    self.rate_limited += 1
+                    self._schedule(state, now + wait)
+                    continue
+                state.bucket.take()
+                self._app_bucket.take()
+                batch = [state.pending.popleft() for _ in range(min(self.max_batch, len(state.pending)))]
+                self.coalesced += len(batch) - 1
+                state.in_flight = True
+                state.due = None
+                ready.append((state, batch))
+
+            if now - self._last_sweep > 60:
+                self._last_sweep = now
+                for key, state in list(self._chats.items()):
+                    if not state.pending and not state.in_flight and now - state.last_active > self.idle_timeout:
+                        del self._chats[key]
+
+            delay = self._heap[0][0] - now if self._heap else 60
+        return ready, max(delay, 0.005)
+
+    def _deliver(self, state, batch):
+        try:
+            result = self.send(state.chat_id, batch)
+        except Exception as e:
+            log.error(f"Exception sending queued messages for {state.key}: {str(e)}")
+            result = None
+        try:
+            self.on_result(state.key, batch, result)
+        except Exception as e:
+            log.error(f"Exception reporting delivery for {state.key}: {str(e)}")
+        self._delivered(state, batch, result)
+
+    async def _adeliver(self, state, batch):
+        try:
+            result = await self.send(state.chat_id, batch)
+        except Exception as e:
+            log.error(f"Exception sending queued messages for {state.key}: {str(e)}")
+            result = None
+        try:
+            await asyncio.to_thread(self.on_result, state.key, batch, result)
+        except Exception as e:
+            log.error(f"Exception reporting delivery for {state.key}: {str(e)}")
+        self._delivered(state, batch, result)
+
+    def _delivered(self, state, batch, result):
+        with self._lock:
+            if result is None:
+                self.failed += len(batch)
+            else:
+                self.sent += len(batch)
+            state.in_flight = False
+            state.last_active = time.monotonic()
+            if state.pending and self._chats.get(state.key) is state:
+                # Whatever arrived during the send has already been coalescing
+                self._schedule(state, time.monotonic())
+
+    def stats(self):
+        with self._lock:
+            chats = len(self._chats)
+            queued = sum(len(state.pending) for state in self._chats.values())
+        return {
+            'chats': chats,
+            'queued': queued,
+            'enqueued': self.enqueued,
+            'sent': self.sent,
+            'failed': self.failed,
+            'coalesced': self.coalesced,
+            'rejected': self.rejected,
+            'rate_limited': self.rate_limited,
+            'senders': self._senders.stats() if self._senders else None,
+        }
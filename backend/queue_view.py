@@ -0,0 +1,362 @@
+"""
+Queue View
+
+What supervisors see of the support queue: every open conversation with
+its status, indexed by status and by age so a dashboard never scans all of
+them.
+
+    delta = queue_view.upsert(request_id, status='responded')   # None if nothing changed
+    page = queue_view.snapshot(status='pending', limit=50)
+    changes, complete = queue_view.changes_since(page['version'])
+
+Each change bumps a version number and is kept in a short history, so a
+dashboard loads one snapshot and then applies deltas (live, or after a
+reconnect via changes_since) instead of reloading the queue. `complete` is
+False when the history no longer reaches back to that version; the client
+should take a new snapshot.
+
+Pages are ordered oldest first and continue from an opaque cursor, so a
+page costs O(log n + limit) whatever the size of the queue.
+
+QueueView is per process; SQLiteQueueView shares the view and its version
+numbers between workers.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_right, insort
+from collections import deque
+from datetime import datetime
+
+
+# Fields a queue entry may have, besides requestId
+ENTRY_FIELDS = ('status', 'provisioning', 'userName', 'userEmail', 'createdAt')
+
+
+def _created_time(entry):
+    """Sort key for the age index: createdAt (ISO) as epoch seconds"""
+    try:
+        return datetime.fromisoformat(entry['createdAt']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return time.time()
+
+
+def _cursor(key):
+    created, request_id = key
+    return f"{created!r}|{request_id}"
+
+
+def _discard(keys, key):
+    """Remove key from a sorted list"""
+    index = bisect_right(keys, key) - 1
+    if index >= 0 and keys[index] == key:
+        del keys[index]
+
+
+def _parse_cursor(cursor):
+    """(created, request_id) to continue after, or None to start at the oldest"""
+    if not cursor:
+        return None
+    try:
+        created, request_id = cursor.split('|', 1)
+        return float(created), request_id
+    except ValueError:
+        return None
+
+
+class QueueView:
+    """In-process queue view"""
+
+    def __init__(self, history=1000):
+        # request_id -> (sort key, entry)
+        self._entries = {}
+        # Age indexes: [(created, request_id), ...] oldest first, of every entry and per status
+        self._all = []
+        self._by_age = {}
+        self._changes = deque(maxlen=history)
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def upsert(self, request_id, **fields):
+        """
+        Add or change an entry. Returns the delta to stream to dashboards,
+        or None if nothing changed.
+        """
+        fields = {field: value for field, value in fields.items() if field in ENTRY_FIELDS}
+        with self._lock:
+            current = self._entries.get(request_id)
+            if current is None:
+                entry = {'requestId': request_id, 'createdAt': datetime.now().isoformat()}
+                entry.update(fields)
+                key = (_created_time(entry), request_id)
+                previous_status = None
+                insort(self._all, key)
+                self._index(entry.get('status'), key)
+            else:
+                key, old = current
+                if all(old.get(field) == value for field, value in fields.items()):
+                    return None
+                entry = dict(old, **fields)
+                previous_status = old.get('status')
+                if previous_status != entry.get('status'):
+                    self._unindex(previous_status, key)
+                    self._index(entry.get('status'), key)
+            entry['updatedAt'] = datetime.now().isoformat()
+            self._entries[request_id] = (key, entry)
+            return self._record({'op': 'upsert', 'requestId': request_id, 'entry': entry,
+                                 'previousStatus': previous_status})
+
+    def remove(self, request_id):
+        """Drop an entry; returns the delta, or None if it wasn't there"""
+        with self._lock:
+            current = self._entries.pop(request_id, None)
+            if current is None:
+                return None
+            key, entry = current
+            self._unindex(entry.get('status'), key)
+            _discard(self._all, key)
+            return self._record({'op': 'remove', 'requestId': request_id,
+                                 'previousStatus': entry.get('status')})
+
+    def _index(self, status, key):
+        if status is not None:
+            insort(self._by_age.setdefault(status, []), key)
+
+    def _unindex(self, status, key):
+        keys = self._by_age.get(status)
+        if keys is not None:
+            _discard(keys, key)
+            if not keys:
+                del self._by_age[status]
+
+    def _record(self, delta):
+        self.version += 1
+        delta['version'] = self.version
+        self._changes.append(delta)
+        return delta
+
+    def snapshot(self, status=None, limit=50, cursor=None):
+        """
+        One page of entries, oldest first, with the per-status counts and
+        the version the page is consistent with.
+        """
+        after = _parse_cursor(cursor)
+        with self._lock:
+            keys = self._all if status is None else self._by_age.get(status, [])
+            start = bisect_right(keys, after) if after else 0
+            page = keys[start:start + limit]
+            items = [dict(self._entries[request_id][1]) for _, request_id in page]
+            more = start + limit < len(keys)
+            return {
+                'version': self.version,
+                'counts': self._counts(),
+                'oldest': self._oldest(),
+                'items': items,
+                'nextCursor': _cursor(page[-1]) if more and page else None,
+            }
+
+    def _counts(self):
+        return {status: len(keys) for status, keys in self._by_age.items()}
+
+    def _oldest(self):
+        return {status: self._entries[keys[0][1]][1].get('createdAt') for status, keys in self._by_age.items()}
+
+    def changes_since(self, version):
+        """(deltas after version, oldest first; whether none are missing)"""
+        with self._lock:
+            if version > self.version:
+                return [], False
+            changes = [delta for delta in self._changes if delta['version'] > version]
+            oldest = changes[0]['version'] if changes else self.version + 1
+            return changes, oldest == version + 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'counts': self._counts(),
+                'version': self.version,
+                'history': len(self._changes),
+            }
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue_entries (
+    request_id TEXT PRIMARY KEY,
+    status TEXT,
+    created REAL NOT NULL,
+    entry TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_queue_status_age ON queue_entries (status, created, request_id);
+CREATE INDEX IF NOT EXISTS idx_queue_age ON queue_entries (created, request_id);
+CREATE TABLE IF NOT EXISTS queue_changes (
+    version INTEGER PRIMARY KEY,
+    delta TEXT NOT NULL
+);
+"""
+
+
+class SQLiteQueueView(QueueView):
+    """
+    Queue view shared by every worker. Each change takes the next version
+    number in the same IMMEDIATE transaction that writes it, so versions are
+    unique and in order across workers.
+    """
+
+    def __init__(self, path, history=1000):
+        super().__init__(history=history)
+        self.path = path
+        self.history = history
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._connection()
+        connection.executescript(_SCHEMA)
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def upsert(self, request_id, **fields):
+        fields = {field: value for field, value in fields.items() if field in ENTRY_FIELDS}
+        connection = self._connection()
+        with connection:
+            # Take the write lock before reading, so two workers can't both apply a change to the same entry
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT entry FROM queue_entries WHERE request_id = ?", (request_id,)
+            ).fetchone()
+            if row is None:
+                entry = {'requestId': request_id, 'createdAt': datetime.now().isoformat()}
+                entry.update(fields)
+                previous_status = None
+            else:
+                old = json.loads(row[0])
+                if all(old.get(field) == value for field, value in fields.items()):
+                    return None
+                entry = dict(old, **fields)
+                previous_status = old.get('status')
+            entry['updatedAt'] = datetime.now().isoformat()
+            if row is None:
+                connection.execute(
+                    "INSERT INTO queue_entries (request_id, status, created, entry) VALUES (?, ?, ?, ?)",
+                    (request_id, entry.get('status'), _created_time(entry), json.dumps(entry))
+                )
+            else:
+                connection.execute(
+                    "UPDATE queue_entries SET status = ?, entry = ? WHERE request_id = ?",
+                    (entry.get('status'), json.dumps(entry), request_id)
+                )
+            return self._record_row(connection, {'op': 'upsert', 'requestId': request_id, 'entry': entry,
+                                                 'previousStatus': previous_status})
+
+    def remove(self, request_id):
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT status FROM queue_entries WHERE request_id = ?", (request_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute("DELETE FROM queue_entries WHERE request_id = ?", (request_id,))
+            return self._record_row(connection, {'op': 'remove', 'requestId': request_id,
+                                                 'previousStatus': row[0]})
+
+    def _record_row(self, connection, delta):
+        # Trimming keeps the newest changes, so the highest version is never reused
+        delta['version'] = self._version(connection) + 1
+        connection.execute(
+            "INSERT INTO queue_changes (version, delta) VALUES (?, ?)", (delta['version'], json.dumps(delta))
+        )
+        connection.execute("DELETE FROM queue_changes WHERE version <= ?", (delta['version'] - self.history,))
+        return delta
+
+    def _version(self, connection):
+        return connection.execute("SELECT COALESCE(MAX(version), 0) FROM queue_changes").fetchone()[0]
+
+    def snapshot(self, status=None, limit=50, cursor=None):
+        after = _parse_cursor(cursor)
+        connection = self._connection()
+        where, params = [], []
+        if status is not None:
+            where.append("status = ?")
+            params.append(status)
+        if after:
+            where.append("(created, request_id) > (?, ?)")
+            params.extend(after)
+        sql = "SELECT created, request_id, entry FROM queue_entries"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created, request_id LIMIT ?"
+        # One read transaction, so the page, counts and version agree
+        connection.execute("BEGIN")
+        try:
+            rows = connection.execute(sql, params + [limit + 1]).fetchall()
+            counts = dict(connection.execute(
+                "SELECT status, COUNT(*) FROM queue_entries WHERE status IS NOT NULL GROUP BY status"
+            ).fetchall())
+            oldest = {}
+            for status_name in counts:
+                row = connection.execute(
+                    "SELECT entry FROM queue_entries WHERE status = ? ORDER BY created, request_id LIMIT 1",
+                    (status_name,)
+                ).fetchone()
+                oldest[status_name] = json.loads(row[0]).get('createdAt')
+            version = self._version(connection)
+        finally:
+            connection.commit()
+        page = rows[:limit]
+        return {
+            'version': version,
+            'counts': counts,
+            'oldest': oldest,
+            'items': [json.loads(row[2]) for row in page],
+            'nextCursor': _cursor((page[-1][0], page[-1][1])) if len(rows) > limit else None,
+        }
+
+    def changes_since(self, version):
+        connection = self._connection()
+        connection.execute("BEGIN")
+        try:
+            current = self._version(connection)
+            rows = connection.execute(
+                "SELECT version, delta FROM queue_changes WHERE version > ? ORDER BY version", (version,)
+            ).fetchall()
+        finally:
+            connection.commit()
+        if version > current:
+            return [], False
+        changes = [json.loads(delta) for _, delta in rows]
+        oldest = rows[0][0] if rows else current + 1
+        return changes, oldest == version + 1
+
+    def stats(self):
+        connection = self._connection()
+        counts = dict(connection.execute(
+            "SELECT status, COUNT(*) FROM queue_entries WHERE status IS NOT NULL GROUP BY status"
+        ).fetchall())
+        stats = {
+            'entries': connection.execute("SELECT COUNT(*) FROM queue_entries").fetchone()[0],
+            'counts': counts,
+            'version': self._version(connection),
+            'history': connection.execute("SELECT COUNT(*) FROM queue_changes").fetchone()[0],
+        }
+        connection.commit()
+        return stats
+
+
+def create_queue_view(backend, path=None, history=1000):
+    """Shared (sqlite) view when conversations are shared, otherwise in-process"""
+    if backend == 'sqlite':
+        return SQLiteQueueView(path or "conversations.db", history=history)
+    return QueueView(history=history)
@@ -0,0 +1,87 @@
+"""
+Scale-Out Launcher
+
+Runs N copies of the backend behind one port. The parent binds the
+listening socket and starts each worker as a separate `python app.py`
+process that accepts connections on the inherited socket, so the kernel
+spreads new connections across workers.
+
+Workers share state through the SQLite conversation store and fan Socket.IO
+emits out through the message queue (see socketio_queue.py), so a webhook
+and the customer's socket can land on different workers.
+
+Because consecutive HTTP long-polling requests could reach different
+workers, clients must use the websocket transport in this mode.
+
+    python scale_out.py --workers 4 --port 5001
+
+With SERVER_MODE=async each worker runs async_server.py instead.
+"""
+
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several backend workers on one port")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WORKERS", 4)))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 5001)))
+    args = parser.parse_args()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.host, args.port))
+    listener.listen(1024)
+    listener.set_inheritable(True)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env["SCALE_OUT_FD"] = str(listener.fileno())
+    # Workers must share conversation state and Socket.IO rooms
+    env.setdefault("CONVERSATION_STORE", "sqlite")
+    env.setdefault("CONVERSATION_DB", os.path.join(here, "conversations.db"))
+    env.setdefault("SOCKETIO_MESSAGE_QUEUE", "sqlite:///" + os.path.join(here, "socketio_queue.db"))
+    entry_point = "async_server.py" if env.get("SERVER_MODE") == "async" else "app.py"
+
+    def spawn(index):
+        worker_env = dict(env, WORKER_INDEX=str(index))
+        return subprocess.Popen(
+            [sys.executable, os.path.join(here, entry_point)],
+            env=worker_env,
+            pass_fds=(listener.fileno(),)
+        )
+
+    workers = {index: spawn(index) for index in range(args.workers)}
+    print(f"Started {args.workers} workers on {args.host}:{args.port}")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in workers.values():
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Restart workers that die until we're asked to stop
+    while not stopping:
+        for index, process in list(workers.items()):
+            if process.poll() is not None and not stopping:
+                print(f"Worker {index} exited with {process.returncode}, restarting")
+                workers[index] = spawn(index)
+        time.sleep(1)
+
+    for process in workers.values():
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
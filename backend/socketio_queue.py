@@ -0,0 +1,168 @@
+"""
+Socket.IO Message Queue
+
+Lets several worker processes act as one Socket.IO server. Every emit (and
+room join/leave for sockets owned by another worker) is published to a
+queue that all workers read, so a webhook handled by worker A still reaches
+a customer whose socket is connected to worker B.
+
+SOCKETIO_MESSAGE_QUEUE selects the queue:
+- redis://..., amqp://..., kafka://..., zmq+tcp://... use python-socketio's
+  built-in managers (the matching client library must be installed)
+- sqlite:///path/to/queue.db uses SQLiteQueueManager below, a file-based
+  stand-in for running several workers on one machine without extra services
+
+The async server (async_server.py) supports sqlite:/// and redis:// URLs.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS socketio_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    payload TEXT NOT NULL
+);
+"""
+
+
+class _SQLiteQueue:
+    """The shared table behind both queue managers"""
+
+    def __init__(self, path, channel, poll_interval, retention):
+        self.path = path
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._local = threading.local()
+        self._last_prune = 0.0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.executescript(_SCHEMA)
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def publish(self, data):
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT INTO socketio_messages (channel, created_at, payload) VALUES (?, ?, ?)",
+                (self.channel, now, json.dumps(data))
+            )
+            if now - self._last_prune > self.retention:
+                self._last_prune = now
+                connection.execute("DELETE FROM socketio_messages WHERE created_at < ?", (now - self.retention,))
+
+    def last_id(self):
+        row = self._connection().execute("SELECT COALESCE(MAX(id), 0) FROM socketio_messages").fetchone()
+        return row[0]
+
+    def read_after(self, last_id):
+        connection = self._connection()
+        rows = connection.execute(
+            "SELECT id, payload FROM socketio_messages WHERE id > ? AND channel = ? ORDER BY id",
+            (last_id, self.channel)
+        ).fetchall()
+        # Close the read transaction so the WAL can be checkpointed
+        connection.commit()
+        return rows
+
+
+class SQLiteQueueManager(socketio.PubSubManager):
+    """
+    Pub/sub over a shared SQLite file.
+    Publishers append rows; each worker tails the table from the newest row
+    it has seen. Rows older than `retention` seconds are pruned.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path, channel='flask-socketio', write_only=False, logger=None,
+                 poll_interval=0.02, retention=30):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.queue = _SQLiteQueue(path, channel, poll_interval, retention)
+
+    def _publish(self, data):
+        self.queue.publish(data)
+
+    def _listen(self):
+        last_id = self.queue.last_id()
+        while True:
+            rows = self.queue.read_after(last_id)
+            for message_id, payload in rows:
+                last_id = message_id
+                yield payload
+            if not rows:
+                time.sleep(self.queue.poll_interval)
+
+
+class AsyncSQLiteQueueManager(AsyncPubSubManager):
+    """
+    SQLiteQueueManager for the asyncio server (async_server.py). Uses the
+    same table and channel, so threaded and async workers can be mixed.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path, channel='flask-socketio', write_only=False, logger=None,
+                 poll_interval=0.02, retention=30):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.queue = _SQLiteQueue(path, channel, poll_interval, retention)
+
+    async def _publish(self, data):
+        await asyncio.to_thread(self.queue.publish, data)
+
+    async def _listen(self):
+        last_id = await asyncio.to_thread(self.queue.last_id)
+        while True:
+            rows = await asyncio.to_thread(self.queue.read_after, last_id)
+            for message_id, payload in rows:
+                last_id = message_id
+                yield payload
+            if not rows:
+                await asyncio.sleep(self.queue.poll_interval)
+
+
+def create_client_manager(url, channel='flask-socketio'):
+    """
+    Client manager for the configured queue URL, or None to let Flask-SocketIO
+    build one itself (non-sqlite URLs) or run single-process (no URL).
+    """
+    if url and url.startswith('sqlite:///'):
+        return SQLiteQueueManager(url[len('sqlite:///'):], channel=channel)
+    return None
+
+
+def create_async_client_manager(url, channel='flask-socketio'):
+    """
+    Client manager for async_server.py: AsyncSQLiteQueueManager for sqlite,
+    AsyncRedisManager for redis, or None to run single-process.
+    """
+    if not url:
+        return None
+    if url.startswith('sqlite:///'):
+        return AsyncSQLiteQueueManager(url[len('sqlite:///'):], channel=channel)
+    if url.startswith(('redis://', 'rediss://')):
+        return socketio.AsyncRedisManager(url, channel=channel)
+    raise ValueError(f"SOCKETIO_MESSAGE_QUEUE {url!r} is not supported by the async server")
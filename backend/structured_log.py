@@ -0,0 +1,164 @@
+"""
+Structured Logging
+
+Log calls only format a record and put it on a bounded in-memory queue; one
+background thread does the actual writing, so a slow stdout or disk never
+stalls a request or a worker. If the queue is full, records are dropped and
+counted instead of blocking.
+
+    log = get_logger(__name__)
+    log.info("Created chat", request_id=request_id, chat_id=chat_id)
+    log.exception("Provisioning failed", request_id=request_id)
+
+Keyword arguments become fields of the record. LOG_FORMAT=json writes one
+JSON object per line; the default text format appends them as key=value.
+LOG_LEVEL sets the threshold (default INFO).
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+
+_TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(_TEXT_FORMAT)
+
+    def format(self, record):
+        record.message = record.getMessage()
+        record.asctime = self.formatTime(record)
+        line = self.formatMessage(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Format the message now (arguments may change later) but leave the
+        # output formatting to the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class StructuredLogger:
+    """Thin wrapper over logging.Logger that takes fields as keyword arguments"""
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def _log(self, level, msg, exc_info=False, fields=None):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, msg, exc_info=exc_info, extra={'fields': fields}, stacklevel=3)
+
+    def is_enabled(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def debug(self, msg, **fields):
+        self._log(logging.DEBUG, msg, fields=fields)
+
+    def info(self, msg, **fields):
+        self._log(logging.INFO, msg, fields=fields)
+
+    def warning(self, msg, **fields):
+        self._log(logging.WARNING, msg, fields=fields)
+
+    def error(self, msg, **fields):
+        self._log(logging.ERROR, msg, fields=fields)
+
+    def exception(self, msg, **fields):
+        """Error with the current exception's traceback"""
+        self._log(logging.ERROR, msg, exc_info=True, fields=fields)
+
+
+def get_logger(name):
+    return StructuredLogger(logging.getLogger(name))
+
+
+_handler = None
+_listener = None
+
+
+def configure_logging(level=None, fmt=None, max_queue=10000, stream=None):
+    """
+    Route all logging through the background writer. Safe to call more than
+    once; later calls only change the level and format.
+    """
+    global _handler, _listener
+    level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+    fmt = fmt or os.getenv("LOG_FORMAT", "text")
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    # httpx logs every request at INFO; Graph calls already have metrics
+    logging.getLogger("httpx").setLevel(max(root.level, logging.WARNING))
+    formatter = JsonFormatter() if fmt == 'json' else TextFormatter()
+    if _listener is not None:
+        for handler in _listener.handlers:
+            handler.setFormatter(formatter)
+        return _handler
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(formatter)
+    _handler = DroppingQueueHandler(queue.Queue(maxsize=max_queue))
+    _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=False)
+    _listener.start()
+    root.handlers = [_handler]
+    # Flush what's queued on shutdown
+    atexit.register(_listener.stop)
+    return _handler
+
+
+def logging_stats():
+    if _handler is None:
+        return None
+    return {
+        'queued': _handler.queue.qsize(),
+        'dropped': _handler.dropped,
+    }
@@ -0,0 +1,203 @@
+"""
+Subscription Renewal Scheduler
+
+Graph chat message subscriptions expire after at most an hour. The scheduler
+keeps every subscription we created in a heap ordered by when it's next due
+for renewal, which is shortly before it lapses. Renewals go out through the
+GraphBatcher so that many subscriptions due together cost a few $batch calls,
+and each new expiry gets some random jitter so renewals drift apart instead
+of all coming due at the same moment again. A failed renewal is retried
+every retry_interval until the subscription expires.
+"""
+
+import heapq
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from structured_log import get_logger
+
+
+log = get_logger(__name__)
+
+
+def parse_graph_datetime(value):
+    """Parse a Graph timestamp like '2024-01-01T12:00:00.1234567Z' into an aware datetime"""
+    if not value:
+        return None
+    value = value.replace("Z", "+00:00")
+    # Graph sends up to 7 fractional digits; fromisoformat accepts at most 6
+    if "." in value:
+        head, rest = value.split(".", 1)
+        digits = len(rest) - len(rest.lstrip("0123456789"))
+        value = f"{head}.{rest[:min(digits, 6)]}{rest[digits:]}"
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+class SubscriptionScheduler:
+    """
+    Renews tracked Graph subscriptions before they expire.
+    on_lost(subscription_id) is called when Graph reports a subscription no
+    longer exists so the owner can create a replacement.
+    """
+
+    def __init__(self, graph_batcher, lifetime=timedelta(minutes=50), renew_before=timedelta(minutes=10),
+                 jitter=timedelta(minutes=5), retry_interval=timedelta(minutes=1), max_renewals_per_tick=100,
+                 on_lost=None):
+        self.graph_batcher = graph_batcher
+        self.lifetime = lifetime
+        self.renew_before = renew_before
+        self.jitter = jitter
+        self.retry_interval = retry_interval
+        self.max_renewals_per_tick = max_renewals_per_tick
+        self.on_lost = on_lost
+
+        # Heap of (renew_at timestamp, subscription_id); entries that no longer
+        # match _renew_at (re-tracked, retried or untracked) are skipped
+        self._heap = []
+        self._expiry = {}
+        self._renew_at = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self.renewed = 0
+        self.failed = 0
+
+    def start(self):
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="subscription-renewer", daemon=True)
+            self._thread.start()
+
+    def next_expiration(self):
+        """ISO expiry for a new or renewed subscription, with jitter to spread renewals"""
+        jitter = random.uniform(0, self.jitter.total_seconds())
+        expires = datetime.now(timezone.utc) + self.lifetime - timedelta(seconds=jitter)
+        return expires.isoformat()
+
+    def track(self, subscription_id, expiration):
+        """Start (or keep) renewing a subscription; expiration is a Graph timestamp or datetime"""
+        if isinstance(expiration, str):
+            expiration = parse_graph_datetime(expiration)
+        expires_at = expiration.timestamp() if expiration else time.time() + self.lifetime.total_seconds()
+        with self._cond:
+            self._expiry[subscription_id] = expires_at
+            self._schedule(subscription_id, expires_at - self.renew_before.total_seconds())
+        self.start()
+
+    def untrack(self, subscription_id):
+        with self._cond:
+            self._expiry.pop(subscription_id, None)
+            self._renew_at.pop(subscription_id, None)
+
+    def is_tracked(self, subscription_id):
+        with self._cond:
+            return subscription_id in self._expiry
+
+    def renew_now(self, subscription_id):
+        """Renew on the next tick (e.g. after a reauthorizationRequired lifecycle event)"""
+        with self._cond:
+            if subscription_id not in self._expiry:
+                return False
+            self._schedule(subscription_id, time.time())
+        return True
+
+    def delete(self, subscription_id):
+        """Stop renewing and delete the subscription in Graph (fire and forget)"""
+        self.untrack(subscription_id)
+        return self.graph_batcher.submit("DELETE", f"/subscriptions/{subscription_id}")
+
+    def stats(self):
+        with self._cond:
+            next_due = min(self._expiry.values()) if self._expiry else None
+            return {
+                'tracked': len(self._expiry),
+                'renewed': self.renewed,
+                'failed': self.failed,
+                'next_expiry_in_s': round(next_due - time.time(), 1) if next_due else None,
+            }
+
+    def _schedule(self, subscription_id, renew_at):
+        """Set when a tracked subscription is next renewed. Caller holds the lock."""
+        self._renew_at[subscription_id] = renew_at
+        heapq.heappush(self._heap, (renew_at, subscription_id))
+        self._cond.notify()
+
+    def _pop_due(self):
+        """Pop subscriptions whose renewal is due. Caller holds the lock."""
+        due = []
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now and len(due) < self.max_renewals_per_tick:
+            renew_at, subscription_id = heapq.heappop(self._heap)
+            # Skip entries superseded by a later track()/renew_now()/retry or untrack()
+            if self._renew_at.get(subscription_id) != renew_at:
+                continue
+            # In flight: nothing is due until the renewal reschedules it
+            del self._renew_at[subscription_id]
+            due.append(subscription_id)
+        return due
+
+    def _seconds_until_next(self):
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.time())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._pop_due()
+                while not due:
+                    self._cond.wait(timeout=self._seconds_until_next())
+                    due = self._pop_due()
+            self._renew(due)
+
+    def _renew(self, subscription_ids):
+        pending = []
+        for subscription_id in subscription_ids:
+            body = {"expirationDateTime": self.next_expiration()}
+            pending.append((subscription_id, self.graph_batcher.submit(
+                "PATCH", f"/subscriptions/{subscription_id}", body=body
+            )))
+
+        for subscription_id, future in pending:
+            try:
+                response = future.result(timeout=120)
+            except Exception as e:
+                log.error(f"Exception renewing subscription {subscription_id}: {str(e)}")
+                response = None
+
+            if response is not None and response.status_code == 200:
+                self.renewed += 1
+                if self.is_tracked(subscription_id):
+                    self.track(subscription_id, response.json().get("expirationDateTime"))
+                continue
+
+            self.failed += 1
+            if response is not None and response.status_code == 404:
+                log.info(f"Subscription {subscription_id} no longer exists")
+                self.untrack(subscription_id)
+                if self.on_lost:
+                    self.on_lost(subscription_id)
+                continue
+
+            status = response.status_code if response is not None else 'no response'
+            log.warning(f"Error renewing subscription {subscription_id}: {status}")
+            # Try again after retry_interval, as long as it hasn't expired yet
+            with self._cond:
+                expires_at = self._expiry.get(subscription_id)
+                now = time.time()
+                expired = bool(expires_at) and expires_at <= now
+                if expired:
+                    self._expiry.pop(subscription_id, None)
+                    self._renew_at.pop(subscription_id, None)
+                elif expires_at and subscription_id not in self._renew_at:
+                    self._schedule(subscription_id, min(expires_at, now + self.retry_interval.total_seconds()))
+            if expired and self.on_lost:
+                self.on_lost(subscription_id)
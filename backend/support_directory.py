@@ -0,0 +1,147 @@
+"""
+Support Team Directory
+
+Azure AD user IDs of the support team, resolved from their emails in the
+background instead of at import time. Resolved IDs are written to a local
+cache file so a restart can use them straight away, and refreshed every
+`ttl` seconds. While a refresh is running (or if it fails) callers keep
+getting the last known-good IDs.
+"""
+
+import json
+import os
+import threading
+import time
+
+from structured_log import get_logger
+
+
+log = get_logger(__name__)
+
+
+class SupportDirectory:
+    """
+    resolve(emails) returns the user IDs for the emails in the same order,
+    with None for lookups that failed.
+    """
+
+    def __init__(self, resolve, emails, cache_file=None, ttl=3600, retry_interval=60):
+        self.resolve = resolve
+        self.emails = list(emails)
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+
+        # email -> user id
+        self._user_ids = {}
+        self._resolved_at = 0.0
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._refresher = None
+        self.refreshes = 0
+        self.failures = 0
+
+        self._load_cache()
+
+    def _load_cache(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file) as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring unreadable support team cache: {str(e)}")
+            return
+        user_ids = {email: user_id for email, user_id in cached.get('user_ids', {}).items()
+                    if email in self.emails and user_id}
+        if user_ids:
+            self._user_ids = user_ids
+            self._resolved_at = cached.get('resolved_at', 0.0)
+            self._ready.set()
+
+    def _persist_cache(self):
+        if not self.cache_file:
+            return
+        with self._lock:
+            cached = {'resolved_at': self._resolved_at, 'user_ids': dict(self._user_ids)}
+        tmp_file = f"{self.cache_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(cached, f)
+        os.replace(tmp_file, self.cache_file)
+
+    def members(self, timeout=None):
+        """
+        User IDs of the support team, in configured order.
+        With nothing resolved yet, waits up to timeout seconds for the first refresh.
+        """
+        if timeout and not self._ready.is_set():
+            self._ready.wait(timeout)
+        with self._lock:
+            return [self._user_ids[email] for email in self.emails if email in self._user_ids]
+
+    def is_stale(self):
+        return time.time() - self._resolved_at >= self.ttl
+
+    def refresh(self):
+        """Resolve every email now; keeps the previous ID for lookups that fail"""
+        try:
+            user_ids = self.resolve(self.emails)
+        except Exception as e:
+            log.error(f"Exception resolving support team: {str(e)}")
+            user_ids = [None] * len(self.emails)
+
+        resolved = {email: user_id for email, user_id in zip(self.emails, user_ids) if user_id}
+        complete = len(resolved) == len(self.emails)
+        with self._lock:
+            self._user_ids.update(resolved)
+            if complete:
+                self._resolved_at = time.time()
+            self.refreshes += 1
+            if not complete:
+                self.failures += 1
+        if resolved:
+            self._ready.set()
+            self._persist_cache()
+        log.info(f"Resolved {len(resolved)}/{len(self.emails)} support team members")
+        return complete
+
+    def refresh_soon(self):
+        """Ask the background thread to refresh without waiting for the TTL"""
+        self._wakeup.set()
+
+    def start(self):
+        """Start the background thread; refreshes right away if the cache is missing or stale"""
+        if self._refresher and self._refresher.is_alive():
+            return
+        self._stop.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop, name="support-directory", daemon=True)
+        self._refresher.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            if self.is_stale():
+                complete = self.refresh()
+                delay = self.ttl if complete else self.retry_interval
+            else:
+                delay = self._resolved_at + self.ttl - time.time()
+            self._wakeup.wait(timeout=max(delay, 1))
+            if self._wakeup.is_set():
+                self._wakeup.clear()
+                # An explicit request always refreshes
+                self._resolved_at = 0.0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'configured': len(self.emails),
+                'resolved': len(self._user_ids),
+                'age': round(time.time() - self._resolved_at, 1) if self._resolved_at else None,
+                'refreshes': self.refreshes,
+                'failures': self.failures,
+            }
@@ -0,0 +1,62 @@
+"""
+Tests for the warm chat pools' bookkeeping, in memory and in SQLite, with
+the Graph callbacks replaced by stand-ins.
+
+    python -m pytest test_chat_pool.py
+"""
+
+import os
+import tempfile
+import time
+import unittest
+
+from chat_pool import SQLiteWarmChatPool, WarmChatPool
+
+
+def make_spare(number):
+    return {'request_id': f"request-{number}", 'chat_id': f"chat-{number}",
+            'subscription_id': f"sub-{number}", 'created_at': time.time() + number}
+
+
+class WarmChatPoolTest(unittest.TestCase):
+
+    def make_pool(self):
+        return WarmChatPool(lambda: None, self.retired.append, target=0, max_size=5)
+
+    def setUp(self):
+        self.retired = []
+        self.pool = self.make_pool()
+        for number in (1, 2):
+            self.pool._add(make_spare(number))
+
+    def test_find_by_subscription(self):
+        self.assertEqual(self.pool.find_by_subscription("sub-2")['request_id'], "request-2")
+        self.assertIsNone(self.pool.find_by_subscription("sub-9"))
+
+    def test_claimed_spare_is_no_longer_found(self):
+        self.assertEqual(self.pool.claim()['subscription_id'], "sub-1")
+        self.assertIsNone(self.pool.find_by_subscription("sub-1"))
+
+    def test_discard_subscription_retires_the_spare(self):
+        self.assertTrue(self.pool.discard_subscription("sub-1"))
+        self.assertEqual([spare['chat_id'] for spare in self.retired], ["chat-1"])
+        self.assertEqual(self.pool.size(), 1)
+        self.assertFalse(self.pool.discard_subscription("sub-1"))
+
+    def test_returned_spare_is_claimed_first(self):
+        spare = self.pool.claim()
+        self.pool.return_spare(spare)
+        self.assertEqual(self.pool.claim()['request_id'], spare['request_id'])
+
+
+class SQLiteWarmChatPoolTest(WarmChatPoolTest):
+
+    def make_pool(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return SQLiteWarmChatPool(os.path.join(directory.name, "pool.db"), lambda: None, self.retired.append,
+                                  target=0, max_size=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
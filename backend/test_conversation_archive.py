@@ -0,0 +1,91 @@
+"""
+Tests for ConversationArchive's on-disk index: appends, lookups across
+processes (separate archive instances on one directory), indexing frames
+written without it, and pruning.
+
+    python -m pytest test_conversation_archive.py
+"""
+
+import os
+import tempfile
+import time
+import unittest
+
+from conversation_archive import ConversationArchive
+
+
+class ConversationArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def archive(self, **options):
+        options.setdefault('refresh_interval', 0)
+        return ConversationArchive(self.directory, **options)
+
+    def test_appended_record_is_loaded(self):
+        archive = self.archive()
+        archive.append("request-1", {'status': 'aborted'})
+        self.assertIn("request-1", archive)
+        self.assertEqual(archive.load("request-1"), {'status': 'aborted'})
+        self.assertIsNone(archive.load("unknown"))
+
+    def test_latest_record_wins(self):
+        archive = self.archive()
+        archive.append("request-1", {'version': 1})
+        archive.append("request-1", {'version': 2})
+        self.assertEqual(archive.load("request-1"), {'version': 2})
+        self.assertEqual(archive.stats()['indexed'], 1)
+
+    def test_other_process_sees_appends_without_rescanning(self):
+        writer = self.archive()
+        reader = self.archive(refresh_interval=3600)
+        writer.append("request-1", {'status': 'done'})
+        self.assertEqual(reader.load("request-1"), {'status': 'done'})
+        self.assertEqual(reader.catch_ups, 1)
+
+    def test_unindexed_frames_are_found_by_scanning(self):
+        self.archive().append("request-1", {'status': 'done'})
+        os.remove(os.path.join(self.directory, "index.db"))
+        archive = self.archive()
+        self.assertEqual(archive.load("request-1"), {'status': 'done'})
+
+    def test_interleaved_appends_are_all_indexed(self):
+        first = self.archive()
+        second = self.archive()
+        first.append("request-1", {'writer': 1})
+        # Appends to the segment first is writing, after first's last scan
+        second._current = first._current
+        second.append("request-2", {'writer': 2})
+        first.append("request-3", {'writer': 1})
+        fresh = self.archive()
+        for number, writer in ((1, 1), (2, 2), (3, 1)):
+            self.assertEqual(fresh.load(f"request-{number}"), {'writer': writer})
+
+    def test_segments_roll_over(self):
+        archive = self.archive(segment_bytes=1)
+        archive.append("request-1", {'n': 1})
+        time.sleep(0.002)
+        archive.append("request-2", {'n': 2})
+        self.assertEqual(archive.stats()['segments'], 2)
+        self.assertEqual(archive.load("request-1"), {'n': 1})
+        self.assertEqual(archive.load("request-2"), {'n': 2})
+
+    def test_prune_drops_old_segments_and_their_entries(self):
+        archive = self.archive(segment_bytes=1, retention_days=1)
+        archive.append("request-1", {'n': 1})
+        old_segment = archive._current
+        time.sleep(0.002)
+        archive.append("request-2", {'n': 2})
+        past = time.time() - 2 * 86400
+        os.utime(os.path.join(self.directory, old_segment), (past, past))
+        self.assertEqual(archive.prune(), 1)
+        self.assertNotIn("request-1", archive)
+        self.assertEqual(archive.load("request-2"), {'n': 2})
+        self.assertEqual(archive.stats()['indexed'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+Tests for EventLog and SQLiteEventLog replays: what a reconnecting client
+is sent, and when the replay is flagged as having gaps.
+
+    python -m pytest test_event_log.py
+"""
+
+import os
+import tempfile
+import threading
+import unittest
+
+from event_log import EventLog, SQLiteEventLog
+
+
+class EventLogTest(unittest.TestCase):
+
+    def make_log(self, **options):
+        return EventLog(**options)
+
+    def setUp(self):
+        self.log = self.make_log(capacity=5)
+
+    def record(self, count, request_id="request-1"):
+        return [self.log.record(request_id, 'support_response', {'message': str(i)}) for i in range(count)]
+
+    def test_events_are_numbered_per_conversation(self):
+        self.assertEqual([payload['seq'] for payload in self.record(3)], [1, 2, 3])
+        self.assertEqual(self.log.record("request-2", 'support_status', {})['seq'], 1)
+        self.assertEqual(self.log.last_seq("request-1"), 3)
+
+    def test_replay_from_the_start(self):
+        self.record(3)
+        events, complete = self.log.since("request-1", 0)
+        self.assertEqual([event['seq'] for event in events], [1, 2, 3])
+        self.assertEqual(events[0], {'seq': 1, 'event': 'support_response', 'data': {'message': '0', 'seq': 1}})
+        self.assertTrue(complete)
+
+    def test_replay_sends_only_missed_events(self):
+        self.record(4)
+        events, complete = self.log.since("request-1", 2)
+        self.assertEqual([event['seq'] for event in events], [3, 4])
+        self.assertTrue(complete)
+
+    def test_client_that_is_up_to_date_gets_nothing(self):
+        self.record(3)
+        self.assertEqual(self.log.since("request-1", 3), ([], True))
+
+    def test_events_past_capacity_make_the_replay_incomplete(self):
+        self.record(8)
+        events, complete = self.log.since("request-1", 1)
+        self.assertEqual([event['seq'] for event in events], [4, 5, 6, 7, 8])
+        self.assertFalse(complete)
+        # A client that missed only what's still buffered has no gap
+        self.assertTrue(self.log.since("request-1", 3)[1])
+
+    def test_reset_log_sends_everything_flagged_incomplete(self):
+        self.record(4)
+        self.log.forget("request-1")
+        self.record(2)
+        events, complete = self.log.since("request-1", 4)
+        self.assertEqual([event['seq'] for event in events], [1, 2])
+        self.assertFalse(complete)
+
+    def test_unknown_conversation(self):
+        self.assertEqual(self.log.since("unknown", 0), ([], True))
+        self.assertEqual(self.log.since("unknown", 3), ([], False))
+
+
+class InProcessEventLogTest(unittest.TestCase):
+
+    def test_least_recently_active_conversations_are_dropped(self):
+        log = EventLog(max_conversations=2)
+        for request_id in ("a", "b", "a", "c"):
+            log.record(request_id, 'support_status', {})
+        self.assertEqual(log.last_seq("b"), 0)
+        self.assertEqual(log.last_seq("a"), 2)
+
+
+class SQLiteEventLogTest(EventLogTest):
+
+    def make_log(self, **options):
+        if not hasattr(self, 'path'):
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            self.path = os.path.join(directory.name, "events.db")
+        return SQLiteEventLog(self.path, **options)
+
+    def test_workers_never_share_a_sequence_number(self):
+        logs = [self.make_log(capacity=100) for _ in range(2)]
+        seqs = []
+
+        def emit(log):
+            for _ in range(20):
+                seqs.append(log.record("request-1", 'support_response', {})['seq'])
+
+        threads = [threading.Thread(target=emit, args=(log,)) for log in logs for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(seqs), list(range(1, 81)))
+        events, complete = logs[0].since("request-1", 0)
+        self.assertEqual(len(events), 80)
+        self.assertTrue(complete)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+"""
+Tests for GraphClient's circuit breaker bookkeeping and retries, with the
+HTTP session and TokenManager replaced by stand-ins.
+
+    python -m pytest test_graph_client.py
+"""
+
+import unittest
+
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+from graph_client import TOKEN_OPERATION, GraphClient, is_retryable
+
+
+class _Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeSession:
+    """Answers requests with the queued statuses, repeating the last one"""
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses) or [200]
+        self.requests = []
+
+    def request(self, method, url, headers=None, timeout=None, **kwargs):
+        self.requests.append((method, url, headers))
+        status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+        if isinstance(status, tuple):
+            return _Response(*status)
+        return _Response(status)
+
+
+class FakeTokenManager:
+    def __init__(self, error=None):
+        self.error = error
+        self.issued = 0
+        self.invalidated = []
+
+    def get_app_token(self):
+        if self.error:
+            raise self.error
+        self.issued += 1
+        return f"token-{self.issued}"
+
+    get_delegated_token = get_app_token
+
+    def invalidate(self, kind=None, access_token=None):
+        self.invalidated.append(access_token)
+
+
+def half_open(breaker):
+    """Open the breaker and let its reset timeout pass"""
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure("test")
+    breaker._opened_at -= breaker.reset_timeout
+    return breaker
+
+
+class GraphClientBreakerTest(unittest.TestCase):
+
+    def client(self, token_manager, *statuses):
+        self.chat_breaker = CircuitBreaker("create_chat", failure_threshold=2, reset_timeout=30)
+        self.token_breaker = CircuitBreaker(TOKEN_OPERATION, failure_threshold=2, reset_timeout=30)
+        client = GraphClient(token_manager, max_retries=2, backoff_factor=0,
+                             breakers={"create_chat": self.chat_breaker, TOKEN_OPERATION: self.token_breaker})
+        client.session = FakeSession(*statuses)
+        return client
+
+    def test_token_exception_releases_the_half_open_probe(self):
+        client = self.client(FakeTokenManager(error=ConnectionError("login.microsoftonline.com unreachable")))
+        half_open(self.chat_breaker)
+        with self.assertRaises(ConnectionError):
+            client.post("/chats", json={}, operation="create_chat")
+        # The probe never reached Graph, so the next call may probe again
+        self.assertEqual(self.chat_breaker.state, HALF_OPEN)
+        self.assertTrue(self.chat_breaker.allow())
+
+    def test_token_exceptions_trip_the_token_breaker(self):
+        client = self.client(FakeTokenManager(error=ConnectionError("DNS failure")))
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                client.get("/me")
+        self.assertEqual(self.token_breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError):
+            client.get("/me")
+
+    def test_token_exception_in_half_open_token_breaker_reopens_it(self):
+        client = self.client(FakeTokenManager(error=ConnectionError("DNS failure")))
+        half_open(self.token_breaker)
+        with self.assertRaises(ConnectionError):
+            client.post("/chats", json={}, operation="create_chat")
+        self.assertEqual(self.token_breaker.state, OPEN)
+        self.assertEqual(self.chat_breaker.state, CLOSED)
+
+    def test_successful_call_closes_half_open_breakers(self):
+        client = self.client(FakeTokenManager(), 201)
+        half_open(self.chat_breaker)
+        response = client.post("/chats", json={}, operation="create_chat")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.chat_breaker.state, CLOSED)
+
+    def test_server_errors_open_the_operation_breaker(self):
+        client = self.client(FakeTokenManager(), 500)
+        for _ in range(2):
+            client.post("/chats", json={}, operation="create_chat")
+        self.assertEqual(self.chat_breaker.state, OPEN)
+        self.assertEqual(self.token_breaker.state, CLOSED)
+
+
+class GraphClientRetryTest(unittest.TestCase):
+
+    def client(self, *statuses):
+        client = GraphClient(FakeTokenManager(), max_retries=2, backoff_factor=0)
+        client.session = FakeSession(*statuses)
+        return client
+
+    def test_post_is_not_retried_on_gateway_timeout(self):
+        client = self.client(504, 201)
+        self.assertEqual(client.post("/chats", json={}).status_code, 504)
+        self.assertEqual(len(client.session.requests), 1)
+
+    def test_post_is_not_retried_on_bare_503(self):
+        client = self.client(503, 201)
+        self.assertEqual(client.post("/chats/1/messages", json={}).status_code, 503)
+        self.assertEqual(len(client.session.requests), 1)
+
+    def test_post_is_retried_on_503_with_retry_after(self):
+        client = self.client((503, {"Retry-After": "0"}), 201)
+        self.assertEqual(client.post("/subscriptions", json={}).status_code, 201)
+        self.assertEqual(len(client.session.requests), 2)
+
+    def test_post_is_retried_when_throttled(self):
+        client = self.client(429, 201)
+        self.assertEqual(client.post("/chats", json={}).status_code, 201)
+        self.assertEqual(len(client.session.requests), 2)
+
+    def test_get_is_retried_on_transient_errors(self):
+        client = self.client(504, 503, 200)
+        self.assertEqual(client.get("/chats/1").status_code, 200)
+        self.assertEqual(len(client.session.requests), 3)
+
+    def test_retries_stop_after_max_retries(self):
+        client = self.client(500)
+        self.assertEqual(client.get("/chats/1").status_code, 500)
+        self.assertEqual(len(client.session.requests), 3)
+
+    def test_rejected_token_is_refreshed_once(self):
+        client = self.client(401, 200)
+        self.assertEqual(client.get("/me").status_code, 200)
+        self.assertEqual(client.token_manager.invalidated, ["token-1"])
+        self.assertEqual(client.session.requests[1][2]["Authorization"], "Bearer token-2")
+
+    def test_second_401_is_returned(self):
+        client = self.client(401)
+        self.assertEqual(client.get("/me").status_code, 401)
+        self.assertEqual(len(client.session.requests), 2)
+
+    def test_retryable_statuses(self):
+        self.assertTrue(is_retryable(502, {}, idempotent=True))
+        self.assertFalse(is_retryable(502, {}, idempotent=False))
+        self.assertTrue(is_retryable(503, {"retry-after": "5"}, idempotent=False))
+        self.assertFalse(is_retryable(400, {}, idempotent=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+Tests for IdempotencyCache and SQLiteIdempotencyCache: ownership, replays,
+waiting for a request in flight, conflicts and failures.
+
+    python -m pytest test_idempotency.py
+"""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from idempotency import IdempotencyCache, IdempotencyConflict, SQLiteIdempotencyCache
+
+
+class IdempotencyCacheTest(unittest.TestCase):
+
+    def make_cache(self, **options):
+        return IdempotencyCache(**options)
+
+    def setUp(self):
+        self.cache = self.make_cache(pending_timeout=2)
+
+    def begin_in_thread(self, cache, key, fingerprint="fp"):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(cache.begin(key, fingerprint)))
+        thread.start()
+        return thread, result
+
+    def test_first_request_owns_the_key(self):
+        self.assertEqual(self.cache.begin("key", "fp"), (True, None))
+
+    def test_completed_response_is_replayed(self):
+        self.cache.begin("key", "fp")
+        self.cache.complete("key", {'requestId': "r1"}, 202)
+        self.assertEqual(self.cache.begin("key", "fp"), (False, ({'requestId': "r1"}, 202)))
+        self.assertEqual(self.cache.stats()['replayed'], 1)
+
+    def test_repeat_waits_for_the_request_in_flight(self):
+        self.cache.begin("key", "fp")
+        thread, result = self.begin_in_thread(self.cache, "key")
+        time.sleep(0.1)
+        self.assertEqual(result, [])
+        self.cache.complete("key", {'requestId': "r1"}, 202)
+        thread.join(2)
+        self.assertEqual(result, [(False, ({'requestId': "r1"}, 202))])
+
+    def test_waiting_gives_up_after_pending_timeout(self):
+        cache = self.make_cache(pending_timeout=0.2)
+        cache.begin("key", "fp")
+        started = time.monotonic()
+        self.assertEqual(cache.begin("key", "fp"), (False, None))
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_different_request_with_the_same_key_conflicts(self):
+        self.cache.begin("key", "fp")
+        with self.assertRaises(IdempotencyConflict):
+            self.cache.begin("key", "other")
+        self.cache.complete("key", {}, 202)
+        with self.assertRaises(IdempotencyConflict):
+            self.cache.begin("key", "other")
+
+    def test_failed_request_lets_a_retry_do_the_work(self):
+        self.cache.begin("key", "fp")
+        self.cache.fail("key")
+        self.assertEqual(self.cache.begin("key", "fp"), (True, None))
+
+    def test_failure_releases_waiters_without_a_response(self):
+        self.cache.begin("key", "fp")
+        thread, result = self.begin_in_thread(self.cache, "key")
+        time.sleep(0.1)
+        self.cache.fail("key")
+        thread.join(2)
+        self.assertEqual(result, [(False, None)])
+
+    def test_key_is_reusable_after_ttl(self):
+        cache = self.make_cache(ttl=0)
+        cache.begin("key", "fp")
+        cache.complete("key", {}, 202)
+        self.assertEqual(cache.begin("key", "other"), (True, None))
+
+
+class SQLiteIdempotencyCacheTest(IdempotencyCacheTest):
+
+    def make_cache(self, **options):
+        if not hasattr(self, 'path'):
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            self.path = os.path.join(directory.name, "idempotency.db")
+        options.setdefault('poll_interval', 0.01)
+        return SQLiteIdempotencyCache(self.path, **options)
+
+    def test_workers_share_keys(self):
+        other = self.make_cache(pending_timeout=2)
+        self.cache.begin("key", "fp")
+        thread, result = self.begin_in_thread(other, "key")
+        time.sleep(0.1)
+        self.cache.complete("key", {'requestId': "r1"}, 202)
+        thread.join(2)
+        self.assertEqual(result, [(False, ({'requestId': "r1"}, 202))])
+        self.assertEqual(other.begin("key", "fp"), (False, ({'requestId': "r1"}, 202)))
+
+    def test_abandoned_key_is_taken_over(self):
+        crashed = self.make_cache(pending_timeout=0)
+        crashed.begin("key", "fp")
+        self.assertEqual(self.cache.begin("key", "fp"), (True, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+Tests for message claims in the in-process and SQLite deduplicators,
+including SQLite claims shared between workers (separate instances on one
+database).
+
+    python -m pytest test_message_dedup.py
+"""
+
+import os
+import tempfile
+import unittest
+
+from message_dedup import MessageDeduplicator, SQLiteMessageDeduplicator, dedup_key
+
+
+class MessageDeduplicatorTest(unittest.TestCase):
+
+    def make_dedup(self, **options):
+        return MessageDeduplicator(**options)
+
+    def setUp(self):
+        self.dedup = self.make_dedup()
+        self.key = dedup_key("request-1", "message-1")
+
+    def test_first_claim_wins(self):
+        self.assertTrue(self.dedup.claim(self.key))
+        self.assertFalse(self.dedup.claim(self.key))
+        self.assertEqual(self.dedup.stats()['duplicates'], 1)
+
+    def test_claimed_message_is_in_flight_until_completed(self):
+        self.dedup.claim(self.key)
+        self.assertTrue(self.dedup.is_in_flight(self.key))
+        self.assertFalse(self.dedup.is_done(self.key))
+        self.dedup.complete(self.key)
+        self.assertFalse(self.dedup.is_in_flight(self.key))
+        self.assertTrue(self.dedup.is_done(self.key))
+        self.assertFalse(self.dedup.claim(self.key))
+
+    def test_released_claim_can_be_claimed_again(self):
+        self.dedup.claim(self.key)
+        self.dedup.release(self.key)
+        self.assertFalse(self.dedup.is_in_flight(self.key))
+        self.assertTrue(self.dedup.claim(self.key))
+
+    def test_abandoned_claim_expires(self):
+        dedup = self.make_dedup(claim_timeout=0)
+        dedup.claim(self.key)
+        self.assertFalse(dedup.is_in_flight(self.key))
+        self.assertTrue(dedup.claim(self.key))
+
+    def test_completed_message_is_forgotten_after_ttl(self):
+        dedup = self.make_dedup(ttl=0)
+        dedup.claim(self.key)
+        dedup.complete(self.key)
+        self.assertFalse(dedup.is_done(self.key))
+        self.assertTrue(dedup.claim(self.key))
+
+    def test_keys_are_per_request(self):
+        self.dedup.claim(dedup_key("request-1", "1"))
+        self.assertTrue(self.dedup.claim(dedup_key("request-2", "1")))
+
+
+class InProcessLimitTest(unittest.TestCase):
+
+    def test_oldest_entries_are_evicted_past_max_entries(self):
+        dedup = MessageDeduplicator(max_entries=2)
+        for key in ("a", "b", "c"):
+            dedup.claim(key)
+            dedup.complete(key)
+        self.assertFalse(dedup.is_done("a"))
+        self.assertTrue(dedup.is_done("c"))
+        self.assertEqual(dedup.stats()['evicted'], 1)
+
+
+class SQLiteMessageDeduplicatorTest(MessageDeduplicatorTest):
+
+    def make_dedup(self, **options):
+        if not hasattr(self, 'path'):
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            self.path = os.path.join(directory.name, "dedup.db")
+        return SQLiteMessageDeduplicator(self.path, **options)
+
+    def test_workers_share_claims(self):
+        other = self.make_dedup()
+        self.assertTrue(self.dedup.claim(self.key))
+        self.assertFalse(other.claim(self.key))
+        # The other worker sees the claim as in flight, so it asks Graph to redeliver
+        self.assertTrue(other.is_in_flight(self.key))
+
+    def test_release_lets_another_worker_claim(self):
+        other = self.make_dedup()
+        self.dedup.claim(self.key)
+        self.dedup.release(self.key)
+        self.assertTrue(other.claim(self.key))
+
+    def test_completed_message_is_refused_everywhere(self):
+        other = self.make_dedup()
+        self.dedup.claim(self.key)
+        self.dedup.complete(self.key)
+        self.assertFalse(other.claim(self.key))
+        self.assertFalse(other.is_in_flight(self.key))
+
+    def test_expired_claim_is_taken_over(self):
+        abandoned = self.make_dedup(claim_timeout=0)
+        abandoned.claim(self.key)
+        self.assertTrue(self.make_dedup().claim(self.key))
+
+
+if __name__ == '__main__':
+    unittest.main()
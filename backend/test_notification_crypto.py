@@ -0,0 +1,198 @@
+"""
+Tests for rich notification decryption and validation token checks,
+using the Graph-shaped payloads from fake_notifications.
+
+    python -m pytest test_notification_crypto.py
+"""
+
+import base64
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from fake_notifications import (encrypt_resource, generate_signing_key, generate_test_certificate, make_chat_message,
+                                make_validation_token, signing_key_jwks, write_test_certificate)
+from notification_crypto import (EncryptionKeyRing, NotificationDecryptionError, NotificationValidationError,
+                                 ValidationKeysUnavailable, ValidationTokenValidator, decrypt_notification_content)
+
+APP_ID = "11111111-2222-3333-4444-555555555555"
+TENANT_ID = "tenant-under-test"
+
+
+def flip_byte(encoded, index=0):
+    """Base64 value with one byte changed"""
+    raw = bytearray(base64.b64decode(encoded))
+    raw[index] ^= 0x01
+    return base64.b64encode(bytes(raw)).decode()
+
+
+class DecryptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cert_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cert_dir.cleanup)
+        self.certificate_id = write_test_certificate(self.cert_dir.name)
+        with open(os.path.join(self.cert_dir.name, f"{self.certificate_id}.pem"), "rb") as f:
+            self.cert_pem = f.read()
+        self.key_ring = EncryptionKeyRing(cert_dir=self.cert_dir.name)
+        self.message = make_chat_message("19:chat@thread.v2", "Hello from the agent", message_id="1700000000000")
+
+    def encrypted(self):
+        return encrypt_resource(self.message, self.cert_pem, self.certificate_id)
+
+    def test_round_trip(self):
+        self.assertEqual(decrypt_notification_content(self.key_ring, self.encrypted()), self.message)
+
+    def test_tampered_data_is_rejected(self):
+        content = self.encrypted()
+        content["data"] = flip_byte(content["data"], index=20)
+        with self.assertRaisesRegex(NotificationDecryptionError, "signature"):
+            decrypt_notification_content(self.key_ring, content)
+
+    def test_tampered_signature_is_rejected(self):
+        content = self.encrypted()
+        content["dataSignature"] = flip_byte(content["dataSignature"])
+        with self.assertRaisesRegex(NotificationDecryptionError, "signature"):
+            decrypt_notification_content(self.key_ring, content)
+
+    def test_tampered_data_key_is_rejected(self):
+        content = self.encrypted()
+        content["dataKey"] = flip_byte(content["dataKey"])
+        with self.assertRaises(NotificationDecryptionError):
+            decrypt_notification_content(self.key_ring, content)
+
+    def test_thumbprint_mismatch_is_rejected(self):
+        content = self.encrypted()
+        content["encryptionCertificateThumbprint"] = "00" * 20
+        with self.assertRaisesRegex(NotificationDecryptionError, "thumbprint"):
+            decrypt_notification_content(self.key_ring, content)
+
+    def test_content_for_another_certificate_is_rejected(self):
+        other_pem, _ = generate_test_certificate()
+        content = encrypt_resource(self.message, other_pem, self.certificate_id)
+        with self.assertRaises(NotificationDecryptionError):
+            decrypt_notification_content(self.key_ring, content)
+
+    def test_malformed_content_is_rejected(self):
+        content = self.encrypted()
+        del content["dataKey"]
+        with self.assertRaisesRegex(NotificationDecryptionError, "Malformed"):
+            decrypt_notification_content(self.key_ring, content)
+
+    def test_rotated_certificate_still_decrypts_old_content(self):
+        content = self.encrypted()
+        write_test_certificate(self.cert_dir.name)
+        self.key_ring.reload()
+        self.assertEqual(len(self.key_ring._certificates), 2)
+        self.assertEqual(decrypt_notification_content(self.key_ring, content), self.message)
+
+    def test_unknown_certificate_reloads_at_most_once_per_interval(self):
+        content = dict(self.encrypted(), encryptionCertificateId="unknown")
+        with mock.patch.object(self.key_ring, "reload", wraps=self.key_ring.reload) as reload:
+            for _ in range(5):
+                with self.assertRaisesRegex(NotificationDecryptionError, "Unknown encryption certificate"):
+                    decrypt_notification_content(self.key_ring, content)
+            self.assertEqual(reload.call_count, 0)
+
+            self.key_ring._last_reload -= self.key_ring.reload_interval
+            with self.assertRaises(NotificationDecryptionError):
+                decrypt_notification_content(self.key_ring, content)
+            self.assertEqual(reload.call_count, 1)
+
+    def test_certificate_added_since_last_reload_is_found(self):
+        self.key_ring._last_reload -= self.key_ring.reload_interval
+        new_id = write_test_certificate(self.cert_dir.name)
+        with open(os.path.join(self.cert_dir.name, f"{new_id}.pem"), "rb") as f:
+            content = encrypt_resource(self.message, f.read(), new_id)
+        self.assertEqual(decrypt_notification_content(self.key_ring, content), self.message)
+
+
+class _JWKSResponse:
+    def __init__(self, document):
+        self.document = document
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return json.loads(json.dumps(self.document))
+
+
+class ValidationTokenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.signing_key, self.key_id = generate_signing_key()
+        self.validator = ValidationTokenValidator(APP_ID, TENANT_ID, "https://keys.invalid/discovery/v2.0/keys")
+        patcher = mock.patch("notification_crypto.requests.get",
+                             return_value=_JWKSResponse(signing_key_jwks(self.signing_key, self.key_id)))
+        self.fetch = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def token(self, **claims):
+        return make_validation_token(self.signing_key, self.key_id, APP_ID, TENANT_ID, **claims)
+
+    def test_valid_token_is_accepted(self):
+        self.validator.validate([self.token()])
+
+    def test_valid_tokens_and_keys_are_cached(self):
+        token = self.token()
+        for _ in range(3):
+            self.validator.validate([token])
+        self.validator.validate([self.token(jti="another")])
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_missing_tokens_are_rejected(self):
+        for tokens in (None, [], "not-a-list"):
+            with self.assertRaises(NotificationValidationError):
+                self.validator.validate(tokens)
+
+    def test_every_token_must_be_valid(self):
+        with self.assertRaises(NotificationValidationError):
+            self.validator.validate([self.token(), self.token(aud="someone-else")])
+
+    def test_wrong_audience_is_rejected(self):
+        with self.assertRaisesRegex(NotificationValidationError, "(?i)audience"):
+            self.validator.validate([self.token(aud="someone-else")])
+
+    def test_wrong_issuer_is_rejected(self):
+        with self.assertRaisesRegex(NotificationValidationError, "issuer"):
+            self.validator.validate([self.token(iss="https://sts.windows.net/another-tenant/")])
+
+    def test_wrong_publisher_is_rejected(self):
+        with self.assertRaisesRegex(NotificationValidationError, "Graph change notifications"):
+            self.validator.validate([self.token(azp="00000000-0000-0000-0000-000000000000")])
+
+    def test_expired_token_is_rejected(self):
+        with self.assertRaisesRegex(NotificationValidationError, "expired"):
+            self.validator.validate([self.token(lifetime=-60)])
+
+    def test_token_signed_with_another_key_is_rejected(self):
+        forger_key, _ = generate_signing_key()
+        token = make_validation_token(forger_key, self.key_id, APP_ID, TENANT_ID)
+        with self.assertRaisesRegex(NotificationValidationError, "(?i)signature"):
+            self.validator.validate([token])
+
+    def test_garbage_token_is_rejected(self):
+        with self.assertRaisesRegex(NotificationValidationError, "Malformed"):
+            self.validator.validate(["not.a.jwt"])
+
+    def test_unknown_key_ids_refetch_at_most_once_per_interval(self):
+        forger_key, _ = generate_signing_key()
+        with self.assertRaisesRegex(NotificationValidationError, "Unknown"):
+            self.validator.validate([make_validation_token(forger_key, "forged-1", APP_ID, TENANT_ID)])
+        for index in range(2, 6):
+            with self.assertRaises(ValidationKeysUnavailable):
+                self.validator.validate([make_validation_token(forger_key, f"forged-{index}", APP_ID, TENANT_ID)])
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_unreachable_keys_are_reported_as_unavailable(self):
+        import requests
+        self.fetch.side_effect = requests.ConnectionError("down")
+        with self.assertRaises(ValidationKeysUnavailable):
+            self.validator.validate([self.token()])
+
+
+if __name__ == '__main__':
+    unittest.main()
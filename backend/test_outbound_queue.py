@@ -0,0 +1,159 @@
+"""
+Tests for OutboundMessageQueue: token buckets, coalescing, per-chat
+ordering and backpressure, with send() replaced by a recorder.
+
+    python -m pytest test_outbound_queue.py
+"""
+
+import threading
+import time
+import unittest
+
+from outbound_queue import OutboundMessageQueue, TokenBucket
+
+
+def wait_for(condition, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        now = bucket._refilled_at
+        for _ in range(3):
+            self.assertEqual(bucket.wait_time(now), 0)
+            bucket.take()
+        self.assertAlmostEqual(bucket.wait_time(now), 0.5)
+        self.assertEqual(bucket.wait_time(now + 0.5), 0)
+
+    def test_tokens_never_exceed_burst(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        now = bucket._refilled_at + 60
+        for _ in range(2):
+            self.assertEqual(bucket.wait_time(now), 0)
+            bucket.take()
+        self.assertGreater(bucket.wait_time(now), 0)
+
+
+class Recorder:
+    """send() stand-in: records each batch, optionally failing or holding it"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.sent = []
+        self.results = []
+        self.hold = None
+        self.lock = threading.Lock()
+
+    def send(self, chat_id, items):
+        if self.hold is not None:
+            self.hold.wait(3)
+        with self.lock:
+            self.sent.append((chat_id, list(items), time.monotonic()))
+        return None if self.fail else {'id': str(len(self.sent))}
+
+    def on_result(self, key, items, result):
+        self.results.append((key, list(items), result))
+
+
+class OutboundMessageQueueTest(unittest.TestCase):
+
+    def queue(self, recorder, **options):
+        options.setdefault('coalesce_window', 0.05)
+        return OutboundMessageQueue(recorder.send, recorder.on_result, workers=2, **options)
+
+    def test_burst_is_coalesced_in_order(self):
+        recorder = Recorder()
+        queue = self.queue(recorder)
+        for text in ("one", "two", "three"):
+            queue.enqueue("request-1", "chat-1", text)
+        self.assertTrue(wait_for(lambda: recorder.results))
+        self.assertEqual(recorder.sent[0][:2], ("chat-1", ["one", "two", "three"]))
+        self.assertEqual(recorder.results[0][:2], ("request-1", ["one", "two", "three"]))
+        self.assertEqual(queue.stats()['coalesced'], 2)
+
+    def test_one_send_in_flight_per_chat(self):
+        recorder = Recorder()
+        recorder.hold = threading.Event()
+        queue = self.queue(recorder, coalesce_window=0)
+        queue.enqueue("request-1", "chat-1", "first")
+        self.assertTrue(wait_for(lambda: queue.depth("request-1") == 0))
+        queue.enqueue("request-1", "chat-1", "second")
+        queue.enqueue("request-1", "chat-1", "third")
+        time.sleep(0.1)
+        # The first send hasn't returned, so the rest waits
+        self.assertEqual(queue.depth("request-1"), 2)
+        recorder.hold.set()
+        self.assertTrue(wait_for(lambda: queue.stats()['sent'] == 3))
+        self.assertEqual([items for _, items, _ in recorder.sent], [["first"], ["second", "third"]])
+
+    def test_chat_bucket_spaces_out_sends(self):
+        recorder = Recorder()
+        queue = self.queue(recorder, coalesce_window=0, max_batch=1, chat_rate=10, chat_burst=1)
+        for number in range(3):
+            queue.enqueue("request-1", "chat-1", number)
+        self.assertTrue(wait_for(lambda: len(recorder.sent) == 3))
+        times = [sent_at for _, _, sent_at in recorder.sent]
+        self.assertGreaterEqual(times[2] - times[0], 0.15)
+        self.assertGreater(queue.stats()['rate_limited'], 0)
+
+    def test_app_bucket_is_shared_by_all_chats(self):
+        recorder = Recorder()
+        queue = self.queue(recorder, coalesce_window=0, app_rate=10, app_burst=1)
+        for number in range(3):
+            queue.enqueue(f"request-{number}", f"chat-{number}", "hello")
+        self.assertTrue(wait_for(lambda: len(recorder.sent) == 3))
+        times = sorted(sent_at for _, _, sent_at in recorder.sent)
+        self.assertGreaterEqual(times[2] - times[0], 0.15)
+
+    def test_full_chat_queue_rejects(self):
+        recorder = Recorder()
+        recorder.hold = threading.Event()
+        self.addCleanup(recorder.hold.set)
+        queue = self.queue(recorder, max_pending=2)
+        self.assertTrue(queue.enqueue("request-1", "chat-1", "a"))
+        self.assertTrue(queue.enqueue("request-1", "chat-1", "b"))
+        self.assertFalse(queue.enqueue("request-1", "chat-1", "c"))
+        self.assertEqual(queue.stats()['rejected'], 1)
+
+    def test_failed_send_is_reported(self):
+        recorder = Recorder(fail=True)
+        queue = self.queue(recorder)
+        queue.enqueue("request-1", "chat-1", "hello")
+        self.assertTrue(wait_for(lambda: recorder.results))
+        self.assertEqual(recorder.results[0], ("request-1", ["hello"], None))
+        self.assertEqual(queue.stats()['failed'], 1)
+
+    def test_batch_refused_by_submit_is_retried(self):
+        recorder = Recorder()
+        refusals = [True]
+
+        def submit(fn, *args):
+            if refusals:
+                refusals.pop()
+                return False
+            threading.Thread(target=fn, args=args).start()
+            return True
+
+        queue = OutboundMessageQueue(recorder.send, recorder.on_result, coalesce_window=0, submit=submit)
+        queue.enqueue("request-1", "chat-1", "hello")
+        self.assertTrue(wait_for(lambda: recorder.results))
+        self.assertEqual(recorder.sent[0][1], ["hello"])
+
+    def test_forget_drops_queued_items(self):
+        recorder = Recorder()
+        queue = self.queue(recorder, coalesce_window=0.2)
+        queue.enqueue("request-1", "chat-1", "hello")
+        queue.forget("request-1")
+        time.sleep(0.3)
+        self.assertEqual(recorder.sent, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
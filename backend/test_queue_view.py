@@ -0,0 +1,147 @@
+"""
+Tests for QueueView and SQLiteQueueView: deltas, changes_since after a
+reconnect, and paging through snapshots.
+
+    python -m pytest test_queue_view.py
+"""
+
+import os
+import tempfile
+import unittest
+
+from queue_view import QueueView, SQLiteQueueView
+
+
+def created_at(second):
+    return f"2026-10-18T08:00:{second:02d}"
+
+
+class QueueViewTest(unittest.TestCase):
+
+    def make_view(self, **options):
+        return QueueView(**options)
+
+    def setUp(self):
+        self.view = self.make_view(history=5)
+
+    def add(self, number, status='pending'):
+        return self.view.upsert(f"request-{number}", status=status, userName=f"user {number}",
+                                createdAt=created_at(number))
+
+    def apply(self, items, deltas):
+        """What a dashboard does with a snapshot and the deltas that follow it"""
+        entries = {item['requestId']: item for item in items}
+        for delta in deltas:
+            if delta['op'] == 'upsert':
+                entries[delta['requestId']] = delta['entry']
+            else:
+                entries.pop(delta['requestId'], None)
+        return entries
+
+    def test_changes_bump_the_version(self):
+        first = self.add(1)
+        self.assertEqual((first['op'], first['version'], first['previousStatus']), ('upsert', 1, None))
+        changed = self.view.upsert("request-1", status='responded')
+        self.assertEqual((changed['version'], changed['previousStatus']), (2, 'pending'))
+        self.assertEqual(changed['entry']['userName'], "user 1")
+
+    def test_unchanged_upsert_is_not_a_change(self):
+        self.add(1)
+        self.assertIsNone(self.view.upsert("request-1", status='pending'))
+        self.assertIsNone(self.view.upsert("request-1", unknownField='ignored'))
+        self.assertEqual(self.view.snapshot()['version'], 1)
+
+    def test_remove(self):
+        self.add(1)
+        delta = self.view.remove("request-1")
+        self.assertEqual((delta['op'], delta['previousStatus']), ('remove', 'pending'))
+        self.assertIsNone(self.view.remove("request-1"))
+        self.assertEqual(self.view.snapshot()['counts'], {})
+
+    def test_snapshot_counts_and_oldest_per_status(self):
+        self.add(3)
+        self.add(1)
+        self.add(2, status='responded')
+        snapshot = self.view.snapshot()
+        self.assertEqual(snapshot['counts'], {'pending': 2, 'responded': 1})
+        self.assertEqual(snapshot['oldest'], {'pending': created_at(1), 'responded': created_at(2)})
+
+    def test_changes_since_replays_onto_a_snapshot(self):
+        for number in range(3):
+            self.add(number)
+        snapshot = self.view.snapshot()
+        self.view.upsert("request-0", status='responded')
+        self.view.remove("request-1")
+        self.add(5)
+        changes, complete = self.view.changes_since(snapshot['version'])
+        self.assertTrue(complete)
+        self.assertEqual([delta['version'] for delta in changes], [4, 5, 6])
+        current = {item['requestId']: item for item in self.view.snapshot()['items']}
+        self.assertEqual(self.apply(snapshot['items'], changes), current)
+
+    def test_up_to_date_client_gets_nothing(self):
+        self.add(1)
+        self.assertEqual(self.view.changes_since(1), ([], True))
+
+    def test_history_that_no_longer_reaches_back_is_incomplete(self):
+        for number in range(7):
+            self.add(number)
+        changes, complete = self.view.changes_since(1)
+        self.assertFalse(complete)
+        self.assertEqual([delta['version'] for delta in changes], [3, 4, 5, 6, 7])
+        self.assertTrue(self.view.changes_since(2)[1])
+
+    def test_version_from_the_future_is_incomplete(self):
+        self.add(1)
+        self.assertEqual(self.view.changes_since(10), ([], False))
+
+    def page_through(self, status=None, limit=2):
+        request_ids, cursor = [], None
+        while True:
+            page = self.view.snapshot(status=status, limit=limit, cursor=cursor)
+            request_ids += [item['requestId'] for item in page['items']]
+            cursor = page['nextCursor']
+            if cursor is None:
+                return request_ids
+
+    def test_pages_are_oldest_first(self):
+        for number in (4, 1, 3, 0, 2):
+            self.add(number)
+        self.assertEqual(self.page_through(), [f"request-{number}" for number in range(5)])
+
+    def test_pages_by_status(self):
+        for number in range(6):
+            self.add(number, status='pending' if number % 2 else 'responded')
+        self.assertEqual(self.page_through('pending'), ["request-1", "request-3", "request-5"])
+        self.view.upsert("request-3", status='responded')
+        self.assertEqual(self.page_through('pending'), ["request-1", "request-5"])
+        self.assertEqual(self.page_through('responded'), ["request-0", "request-2", "request-3", "request-4"])
+
+    def test_cursor_survives_changes_to_earlier_entries(self):
+        for number in range(4):
+            self.add(number)
+        page = self.view.snapshot(limit=2)
+        self.view.remove("request-0")
+        rest = self.view.snapshot(limit=2, cursor=page['nextCursor'])
+        self.assertEqual([item['requestId'] for item in rest['items']], ["request-2", "request-3"])
+
+
+class SQLiteQueueViewTest(QueueViewTest):
+
+    def make_view(self, **options):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "queue.db")
+        return SQLiteQueueView(self.path, **options)
+
+    def test_workers_share_versions(self):
+        other = SQLiteQueueView(self.path, history=5)
+        self.add(1)
+        self.assertEqual(other.upsert("request-2", status='pending')['version'], 2)
+        changes, complete = self.view.changes_since(0)
+        self.assertTrue(complete)
+        self.assertEqual([delta['requestId'] for delta in changes], ["request-1", "request-2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
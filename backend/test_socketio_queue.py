@@ -0,0 +1,71 @@
+"""
+Tests for the SQLite Socket.IO queue that fans emits out between workers
+(separate managers on one file), threaded and async.
+
+    python -m pytest test_socketio_queue.py
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from socketio_queue import (
+    AsyncSQLiteQueueManager, SQLiteQueueManager, create_async_client_manager, create_client_manager
+)
+
+
+class SQLiteQueueManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "queue.db")
+
+    def test_listener_skips_history_and_follows_new_messages(self):
+        publisher = SQLiteQueueManager(self.path)
+        publisher._publish({'method': 'emit', 'event': 'before'})
+        messages = SQLiteQueueManager(self.path, poll_interval=0.001)._listen()
+        received = []
+        thread = threading.Thread(target=lambda: received.extend([next(messages), next(messages)]), daemon=True)
+        thread.start()
+        # Let the listener pick its starting point before publishing
+        time.sleep(0.1)
+        for event in ('first', 'second'):
+            publisher._publish({'method': 'emit', 'event': event})
+        thread.join(2)
+        self.assertEqual([json.loads(message)['event'] for message in received], ['first', 'second'])
+
+    def test_channels_are_separate(self):
+        SQLiteQueueManager(self.path, channel='other')._publish({'event': 'elsewhere'})
+        listener = SQLiteQueueManager(self.path)
+        self.assertEqual(listener.queue.read_after(0), [])
+
+    def test_async_worker_reads_threaded_workers_messages(self):
+        publisher = SQLiteQueueManager(self.path)
+
+        async def receive():
+            manager = AsyncSQLiteQueueManager(self.path, poll_interval=0.001)
+            messages = manager._listen()
+            first = asyncio.ensure_future(messages.__anext__())
+            await asyncio.sleep(0.05)
+            await asyncio.to_thread(publisher._publish, {'method': 'emit', 'event': 'hello'})
+            return await asyncio.wait_for(first, 2)
+
+        self.assertEqual(json.loads(asyncio.run(receive()))['event'], 'hello')
+
+    def test_factories(self):
+        self.assertIsInstance(create_client_manager(f"sqlite:///{self.path}"), SQLiteQueueManager)
+        self.assertIsNone(create_client_manager(None))
+        self.assertIsNone(create_client_manager("redis://localhost"))
+        self.assertIsInstance(create_async_client_manager(f"sqlite:///{self.path}"), AsyncSQLiteQueueManager)
+        self.assertIsNone(create_async_client_manager(None))
+        with self.assertRaises(ValueError):
+            create_async_client_manager("amqp://localhost")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+"""
+Tests for subscription renewal timing, with a stand-in for the GraphBatcher.
+
+    python -m pytest test_subscription_scheduler.py
+"""
+
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+
+from subscription_scheduler import SubscriptionScheduler, parse_graph_datetime
+
+
+class _Response:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body or {}
+
+    def json(self):
+        return self.body
+
+
+class FakeBatcher:
+    """Answers every PATCH with the given status and records the attempts"""
+
+    def __init__(self, status_code=500):
+        self.status_code = status_code
+        self.attempts = []
+        self.lock = threading.Lock()
+
+    def submit(self, method, path, body=None):
+        with self.lock:
+            self.attempts.append((time.time(), method, path))
+        future = Future()
+        if self.status_code == 200:
+            future.set_result(_Response(200, {"expirationDateTime": body["expirationDateTime"]}))
+        elif self.status_code is None:
+            future.set_exception(ConnectionError("Graph unreachable"))
+        else:
+            future.set_result(_Response(self.status_code))
+        return future
+
+    def renewals(self):
+        with self.lock:
+            return [attempt for attempt in self.attempts if attempt[1] == "PATCH"]
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+class SubscriptionSchedulerTest(unittest.TestCase):
+
+    def scheduler(self, batcher, **options):
+        lost = []
+        options.setdefault('renew_before', timedelta(seconds=10))
+        options.setdefault('retry_interval', timedelta(seconds=0.5))
+        scheduler = SubscriptionScheduler(batcher, on_lost=lost.append, **options)
+        return scheduler, lost
+
+    def expiring_in(self, seconds):
+        return datetime.now(timezone.utc) + timedelta(seconds=seconds)
+
+    def test_subscription_is_renewed_before_it_expires(self):
+        batcher = FakeBatcher(200)
+        scheduler, lost = self.scheduler(batcher)
+        scheduler.track("sub-1", self.expiring_in(5))
+        self.assertTrue(wait_for(lambda: scheduler.renewed == 1))
+        # The renewed expiry is most of a lifetime away, so nothing else is due
+        time.sleep(0.3)
+        self.assertEqual(len(batcher.renewals()), 1)
+        self.assertGreater(scheduler.stats()['next_expiry_in_s'], 60)
+        self.assertEqual(lost, [])
+
+    def test_subscription_is_not_renewed_early(self):
+        batcher = FakeBatcher(200)
+        scheduler, _ = self.scheduler(batcher)
+        scheduler.track("sub-1", self.expiring_in(60))
+        time.sleep(0.3)
+        self.assertEqual(batcher.renewals(), [])
+
+    def test_failed_renewal_is_not_retried_before_the_interval(self):
+        batcher = FakeBatcher(500)
+        scheduler, lost = self.scheduler(batcher)
+        scheduler.track("sub-1", self.expiring_in(5))
+        self.assertTrue(wait_for(lambda: len(batcher.renewals()) == 1))
+        time.sleep(0.3)
+        self.assertEqual(len(batcher.renewals()), 1)
+
+        self.assertTrue(wait_for(lambda: len(batcher.renewals()) == 2))
+        first, second = batcher.renewals()[:2]
+        self.assertGreaterEqual(second[0] - first[0], 0.5)
+        self.assertTrue(scheduler.is_tracked("sub-1"))
+        self.assertEqual(lost, [])
+
+    def test_renewal_exception_is_retried_after_the_interval(self):
+        batcher = FakeBatcher(None)
+        scheduler, _ = self.scheduler(batcher)
+        scheduler.track("sub-1", self.expiring_in(5))
+        self.assertTrue(wait_for(lambda: len(batcher.renewals()) == 1))
+        time.sleep(0.3)
+        self.assertEqual(len(batcher.renewals()), 1)
+        self.assertEqual(scheduler.failed, 1)
+
+    def test_retries_stop_when_the_subscription_expires(self):
+        batcher = FakeBatcher(500)
+        scheduler, lost = self.scheduler(batcher, retry_interval=timedelta(seconds=60))
+        scheduler.track("sub-1", self.expiring_in(0.4))
+        # One attempt when due, one more at expiry (the retry is capped there), then it's lost
+        self.assertTrue(wait_for(lambda: lost == ["sub-1"]))
+        self.assertEqual(len(batcher.renewals()), 2)
+        self.assertFalse(scheduler.is_tracked("sub-1"))
+
+    def test_missing_subscription_is_reported_lost(self):
+        batcher = FakeBatcher(404)
+        scheduler, lost = self.scheduler(batcher)
+        scheduler.track("sub-1", self.expiring_in(5))
+        self.assertTrue(wait_for(lambda: lost == ["sub-1"]))
+        self.assertFalse(scheduler.is_tracked("sub-1"))
+        time.sleep(0.3)
+        self.assertEqual(len(batcher.renewals()), 1)
+
+    def test_renew_now_renews_immediately(self):
+        batcher = FakeBatcher(200)
+        scheduler, _ = self.scheduler(batcher)
+        scheduler.track("sub-1", self.expiring_in(600))
+        self.assertTrue(scheduler.renew_now("sub-1"))
+        self.assertTrue(wait_for(lambda: scheduler.renewed == 1))
+        self.assertFalse(scheduler.renew_now("unknown"))
+
+    def test_untracked_subscription_is_not_renewed(self):
+        batcher = FakeBatcher(200)
+        scheduler, _ = self.scheduler(batcher)
+        scheduler.track("sub-1", self.expiring_in(10.3))
+        scheduler.untrack("sub-1")
+        time.sleep(0.6)
+        self.assertEqual(batcher.renewals(), [])
+
+    def test_graph_timestamps_with_seven_fractional_digits_parse(self):
+        parsed = parse_graph_datetime("2024-01-01T12:00:00.1234567Z")
+        self.assertEqual(parsed, datetime(2024, 1, 1, 12, 0, 0, 123456, tzinfo=timezone.utc))
+        self.assertIsNone(parse_graph_datetime("not a date"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Tests for TokenManager caching and invalidation, running real MSAL client
+applications against a fake token endpoint.
+
+    python -m pytest test_token_manager.py
+"""
+
+import itertools
+import json
+import threading
+import unittest
+
+import msal
+
+from token_manager import APP_ONLY, TokenManager
+
+AUTHORITY = "https://login.test/tenant"
+SCOPE = ["https://graph.microsoft.com/.default"]
+
+
+class _Response:
+    def __init__(self, body, status_code=200):
+        self.status_code = status_code
+        self.text = json.dumps(body)
+        self.headers = {}
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeTokenEndpoint:
+    """Issues at-1, at-2, ... and answers MSAL's authority discovery"""
+
+    def __init__(self):
+        self.issued = itertools.count(1)
+        self.token_requests = 0
+        self.lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        return _Response({
+            "authorization_endpoint": f"{AUTHORITY}/oauth2/v2.0/authorize",
+            "token_endpoint": f"{AUTHORITY}/oauth2/v2.0/token",
+            "issuer": f"{AUTHORITY}/v2.0",
+        })
+
+    def post(self, url, **kwargs):
+        with self.lock:
+            self.token_requests += 1
+            return _Response({"access_token": f"at-{next(self.issued)}", "expires_in": 3600, "token_type": "Bearer"})
+
+    def close(self):
+        pass
+
+
+class TokenManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.endpoint = FakeTokenEndpoint()
+        self.manager = TokenManager("client-id", AUTHORITY, "secret", SCOPE, cache_file=None,
+                                    validate_authority=False)
+        self.manager._confidential_app = msal.ConfidentialClientApplication(
+            "client-id", authority=AUTHORITY, client_credential="secret",
+            http_client=self.endpoint, validate_authority=False
+        )
+
+    def test_token_is_cached(self):
+        self.assertEqual(self.manager.get_app_token(), "at-1")
+        self.assertEqual(self.manager.get_app_token(), "at-1")
+        self.assertEqual(self.endpoint.token_requests, 1)
+
+    def test_invalidated_token_is_replaced_not_reused_from_msal_cache(self):
+        rejected = self.manager.get_app_token()
+        self.manager.invalidate(APP_ONLY, rejected)
+        self.assertEqual(self.manager.get_app_token(), "at-2")
+        self.assertEqual(self.endpoint.token_requests, 2)
+
+    def test_invalidate_without_token_drops_the_current_one(self):
+        self.manager.get_app_token()
+        self.manager.invalidate()
+        self.assertEqual(self.manager.get_app_token(), "at-2")
+
+    def test_stale_invalidation_keeps_the_newer_token(self):
+        rejected = self.manager.get_app_token()
+        self.manager.invalidate(APP_ONLY, rejected)
+        self.manager.get_app_token()
+        # A second caller reporting the same rejected token must not force another refresh
+        self.manager.invalidate(APP_ONLY, rejected)
+        self.assertEqual(self.manager.get_app_token(), "at-2")
+        self.assertEqual(self.endpoint.token_requests, 2)
+
+    def test_concurrent_callers_share_one_refresh(self):
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(self.manager.get_app_token())) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(set(tokens), {"at-1"})
+        self.assertEqual(self.endpoint.token_requests, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
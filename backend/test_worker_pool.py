@@ -0,0 +1,184 @@
+"""
+Tests for the worker pools: priorities and their queue limits, and
+coroutine tasks run on an event loop.
+
+    python -m pytest test_worker_pool.py
+"""
+
+import asyncio
+import threading
+import time
+import unittest
+
+from worker_pool import PriorityWorkerPool, ShardedWorkerPool, WorkerPool
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+class PriorityWorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gate = threading.Event()
+        self.ran = []
+        self.addCleanup(self.gate.set)
+
+    def pool(self, **options):
+        """A one-worker pool whose worker is busy until self.gate is set"""
+        pool = PriorityWorkerPool("test", workers=1, **options)
+        started = threading.Event()
+        pool.submit(lambda: (started.set(), self.gate.wait(5)))
+        started.wait(2)
+        return pool
+
+    def task(self, name):
+        return lambda: self.ran.append(name)
+
+    def test_most_urgent_task_runs_first(self):
+        pool = self.pool(max_queue=10)
+        pool.submit_prioritized(2, None, self.task("low"))
+        pool.submit_prioritized(1, None, self.task("normal-1"))
+        pool.submit_prioritized(0, None, self.task("urgent"))
+        pool.submit_prioritized(1, None, self.task("normal-2"))
+        self.gate.set()
+        self.assertTrue(wait_for(lambda: len(self.ran) == 4))
+        self.assertEqual(self.ran, ["urgent", "normal-1", "normal-2", "low"])
+
+    def test_positions(self):
+        pool = self.pool(max_queue=10)
+        self.assertEqual(pool.submit_prioritized(1, "a", self.task("a")), 1)
+        self.assertEqual(pool.submit_prioritized(1, "b", self.task("b")), 2)
+        self.assertEqual(pool.submit_prioritized(0, "c", self.task("c")), 1)
+        self.assertEqual((pool.position("a"), pool.position("b"), pool.position("c")), (2, 3, 1))
+        self.gate.set()
+        self.assertTrue(wait_for(lambda: len(self.ran) == 3))
+        self.assertIsNone(pool.position("a"))
+
+    def test_limits_shed_less_urgent_work_first(self):
+        pool = self.pool(max_queue=4, limits={2: 1})
+        self.assertIsNotNone(pool.submit_prioritized(2, None, self.task("low-1")))
+        self.assertIsNone(pool.submit_prioritized(2, None, self.task("low-2")))
+        for name in ("a", "b", "c"):
+            self.assertIsNotNone(pool.submit_prioritized(0, None, self.task(name)))
+        # The queue itself is full now, whatever the priority
+        self.assertIsNone(pool.submit_prioritized(0, None, self.task("d")))
+        by_priority = pool.stats()['by_priority']
+        self.assertEqual(by_priority['2'], {'queued': 1, 'limit': 1, 'rejected': 1})
+        self.assertEqual(by_priority['0'], {'queued': 3, 'limit': 4, 'rejected': 1})
+
+    def test_position_changes_are_reported(self):
+        reported = []
+        pool = self.pool(max_queue=10, on_positions=reported.append, position_interval=0)
+        pool.submit_prioritized(1, "a", self.task("a"))
+        pool.submit_prioritized(1, "b", self.task("b"))
+        self.gate.set()
+        self.assertTrue(wait_for(lambda: len(self.ran) == 2))
+        # When a starts, b moves up to the front
+        self.assertIn({"b": 1}, reported)
+
+
+class EventLoopThread:
+    """An event loop on its own thread, like AsyncGraphClient's"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class CoroutineTaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoopThread()
+        self.addCleanup(self.loop.stop)
+        self.release = asyncio.Event()
+        self.started = []
+
+    def release_all(self):
+        self.loop.loop.call_soon_threadsafe(self.release.set)
+
+    async def blocked(self, name):
+        self.started.append(name)
+        await self.release.wait()
+
+    def test_waiting_coroutines_do_not_hold_workers(self):
+        pool = WorkerPool("test", workers=1, max_queue=10)
+        pool.use_event_loop(self.loop.run, concurrency=10)
+        for i in range(5):
+            pool.submit(self.blocked, i)
+        # One worker, yet all five are waiting at once
+        self.assertTrue(wait_for(lambda: len(self.started) == 5))
+        self.assertEqual(pool.stats()['in_progress'], 5)
+        self.release_all()
+        self.assertTrue(wait_for(lambda: pool.completed == 5))
+        self.assertEqual(pool.stats()['in_progress'], 0)
+
+    def test_concurrency_caps_coroutines_in_progress(self):
+        pool = WorkerPool("test", workers=1, max_queue=10)
+        pool.use_event_loop(self.loop.run, concurrency=2)
+        for i in range(4):
+            pool.submit(self.blocked, i)
+        self.assertTrue(wait_for(lambda: len(self.started) == 2))
+        time.sleep(0.1)
+        self.assertEqual(len(self.started), 2)
+        self.assertEqual(pool.depth(), 1)
+        self.release_all()
+        self.assertTrue(wait_for(lambda: pool.completed == 4))
+
+    def test_failed_coroutine_is_counted_and_frees_its_slot(self):
+        pool = WorkerPool("test", workers=1, max_queue=10)
+        pool.use_event_loop(self.loop.run, concurrency=1)
+
+        async def fail():
+            raise RuntimeError("Graph unreachable")
+
+        async def succeed():
+            pass
+
+        pool.submit(fail)
+        pool.submit(succeed)
+        self.assertTrue(wait_for(lambda: pool.completed == 1))
+        self.assertEqual(pool.failed, 1)
+
+    def test_keyed_coroutines_keep_their_order(self):
+        pool = ShardedWorkerPool("test", workers=1, max_queue=10)
+        pool.use_event_loop(self.loop.run, concurrency=10)
+        finished = []
+
+        async def step(name, delay):
+            await asyncio.sleep(delay)
+            finished.append(name)
+
+        def sync_step(name):
+            finished.append(name)
+
+        pool.submit_keyed("chat", step, "first", 0.1)
+        pool.submit_keyed("chat", step, "second", 0)
+        pool.submit_keyed("chat", sync_step, "third")
+        self.assertTrue(wait_for(lambda: len(finished) == 3))
+        self.assertEqual(finished, ["first", "second", "third"])
+
+    def test_plain_functions_still_run_on_the_workers(self):
+        pool = WorkerPool("test", workers=1, max_queue=10)
+        pool.use_event_loop(self.loop.run, concurrency=10)
+        threads = []
+        pool.submit(lambda: threads.append(threading.current_thread().name))
+        self.assertTrue(wait_for(lambda: threads))
+        self.assertEqual(threads, ["test-0"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,280 @@
+"""
+Graph Token Manager
+
+Holds the app-only (client credentials) and delegated (device code) Graph
+tokens for the whole process. Tokens are kept in memory, refreshed in the
+background shortly before they expire, and concurrent refreshes of the same
+credential are coalesced into a single call to the token endpoint. The
+delegated MSAL cache is only written back to disk when it actually changed.
+"""
+
+import os
+import threading
+import time
+
+import msal
+
+from structured_log import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Refresh tokens this many seconds before they expire
+DEFAULT_REFRESH_MARGIN = 300
+
+APP_ONLY = 'app'
+DELEGATED = 'delegated'
+
+
+class _TokenSlot:
+    """In-memory state for one credential type"""
+
+    def __init__(self):
+        self.access_token = None
+        self.expires_at = 0.0
+        # Token Graph rejected; it must leave MSAL's cache before the next refresh
+        self.rejected = None
+        # Serializes refreshes so concurrent callers share one token request
+        self.refresh_lock = threading.Lock()
+
+    def is_fresh(self, margin):
+        return self.access_token is not None and time.time() < self.expires_at - margin
+
+
+class TokenManager:
+    """
+    Process-wide cache for Graph access tokens.
+    Use get_app_token() for application permissions and get_delegated_token()
+    for operations that need a signed-in user (e.g. sending Teams messages).
+    """
+
+    def __init__(self, client_id, authority, client_secret, scope,
+                 cache_file="token_cache.json", refresh_margin=DEFAULT_REFRESH_MARGIN,
+                 validate_authority=True):
+        self.client_id = client_id
+        self.authority = authority
+        self.client_secret = client_secret
+        self.scope = scope
+        self.cache_file = cache_file
+        self.refresh_margin = refresh_margin
+        # False for authorities MSAL doesn't know (e.g. the load test's fake Graph)
+        self.validate_authority = validate_authority
+
+        self._slots = {APP_ONLY: _TokenSlot(), DELEGATED: _TokenSlot()}
+        self._confidential_app = None
+        self._public_app = None
+        self._token_cache = None
+        self._init_lock = threading.Lock()
+        self._cache_file_lock = threading.Lock()
+
+        self._refresher = None
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+
+    # MSAL client applications are built once and reused for every request
+
+    def _get_confidential_app(self):
+        with self._init_lock:
+            if self._confidential_app is None:
+                self._confidential_app = msal.ConfidentialClientApplication(
+                    self.client_id,
+                    authority=self.authority,
+                    client_credential=self.client_secret,
+                    validate_authority=self.validate_authority
+                )
+            return self._confidential_app
+
+    def _get_public_app(self):
+        with self._init_lock:
+            if self._public_app is None:
+                cache = msal.SerializableTokenCache()
+                if self.cache_file and os.path.exists(self.cache_file):
+                    with open(self.cache_file, "r") as f:
+                        cache.deserialize(f.read())
+                self._token_cache = cache
+                self._public_app = msal.PublicClientApplication(
+                    self.client_id,
+                    authority=self.authority,
+                    token_cache=cache,
+                    validate_authority=self.validate_authority
+                )
+            return self._public_app
+
+    def _persist_cache(self):
+        """Write the delegated token cache to disk, but only if MSAL changed it"""
+        cache = self._token_cache
+        if cache is None or not self.cache_file or not cache.has_state_changed:
+            return
+        with self._cache_file_lock:
+            if not cache.has_state_changed:
+                return
+            tmp_file = f"{self.cache_file}.tmp"
+            with open(tmp_file, "w") as f:
+                f.write(cache.serialize())
+            os.replace(tmp_file, self.cache_file)
+            cache.has_state_changed = False
+
+    # Public API
+
+    def get_app_token(self):
+        """Return an app-only access token, refreshing it if needed"""
+        return self._get_token(APP_ONLY, interactive=False)
+
+    def get_delegated_token(self, interactive=True):
+        """
+        Return a delegated access token, refreshing it silently if needed.
+        When no account is cached and interactive is True this falls back to the
+        device code flow, which blocks until the user signs in.
+        """
+        return self._get_token(DELEGATED, interactive=interactive)
+
+    def invalidate(self, kind=None, access_token=None):
+        """
+        Drop cached tokens (e.g. after Graph rejected one with 401), here and
+        in MSAL's cache, so the next call gets a new token rather than MSAL
+        handing back the same one. Given the rejected access_token, a slot
+        that has already moved on to another token is left alone.
+        """
+        kinds = [kind] if kind else list(self._slots)
+        for k in kinds:
+            slot = self._slots[k]
+            with slot.refresh_lock:
+                if access_token is not None and slot.access_token not in (None, access_token):
+                    continue
+                if slot.access_token is not None:
+                    slot.rejected = slot.access_token
+                slot.access_token = None
+                slot.expires_at = 0.0
+
+    def _get_token(self, kind, interactive):
+        slot = self._slots[kind]
+        if slot.is_fresh(self.refresh_margin):
+            return slot.access_token
+
+        with slot.refresh_lock:
+            # Another thread may have refreshed while we were waiting
+            if slot.is_fresh(self.refresh_margin):
+                return slot.access_token
+            self._refresh(kind, interactive)
+
+        # A failed proactive refresh still leaves a usable token until it expires
+        if slot.is_fresh(0):
+            return slot.access_token
+        return None
+
+    def _refresh(self, kind, interactive):
+        """Fetch a new token for the slot. Caller must hold slot.refresh_lock."""
+        slot = self._slots[kind]
+        if slot.rejected is not None:
+            self._evict_cached_token(kind, slot.rejected)
+            slot.rejected = None
+
+        if kind == APP_ONLY:
+            result = self._acquire_app_token()
+        else:
+            result = self._acquire_delegated_token(interactive)
+
+        if not result or "access_token" not in result:
+            if result:
+                log.error(f"Error getting {kind} token: {result.get('error')}",
+                          description=result.get('error_description'))
+            return False
+
+        slot.access_token = result["access_token"]
+        slot.expires_at = time.time() + int(result.get("expires_in", 3600))
+        self._wakeup.set()
+        return True
+
+    def _evict_cached_token(self, kind, access_token):
+        """
+        Remove an access token from MSAL's cache. acquire_token_for_client
+        doesn't take force_refresh, so this is how a revoked token is replaced.
+        """
+        app = self._confidential_app if kind == APP_ONLY else self._public_app
+        if app is None:
+            return
+        cache = app.token_cache
+        for entry in list(cache.search(msal.TokenCache.CredentialType.ACCESS_TOKEN, query={"secret": access_token})):
+            cache.remove_at(entry)
+        if kind == DELEGATED:
+            self._persist_cache()
+
+    def _acquire_app_token(self):
+        return self._get_confidential_app().acquire_token_for_client(scopes=self.scope)
+
+    def _acquire_delegated_token(self, interactive):
+        app = self._get_public_app()
+
+        accounts = app.get_accounts()
+        if accounts:
+            result = app.acquire_token_silent(self.scope, account=accounts[0])
+            if result and "access_token" in result:
+                self._persist_cache()
+                return result
+
+        if not interactive:
+            return None
+
+        # No suitable token in cache, we need to acquire a new one using device code flow
+        flow = app.initiate_device_flow(scopes=self.scope)
+        if "user_code" not in flow:
+            log.error("Failed to create device flow")
+            return None
+
+        log.warning(f"To sign in, use a web browser to open the page {flow['verification_uri']} and enter the code {flow['user_code']} to authenticate.")
+
+        # This will block until user authenticates or times out
+        result = app.acquire_token_by_device_flow(flow)
+        self._persist_cache()
+        return result
+
+    # Background refresh
+
+    def start(self):
+        """Start the background thread that refreshes tokens before they expire"""
+        if self._refresher and self._refresher.is_alive():
+            return
+        self._stop.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop, name="graph-token-refresher", daemon=True)
+        self._refresher.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _next_refresh_in(self):
+        deadlines = [
+            slot.expires_at - self.refresh_margin
+            for slot in self._slots.values()
+            if slot.access_token is not None
+        ]
+        if not deadlines:
+            # Nothing to refresh until someone asks for a token
+            return None
+        return max(0.0, min(deadlines) - time.time())
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            delay = self._next_refresh_in()
+            if delay is None or delay > 0:
+                self._wakeup.wait(timeout=delay)
+                continue
+
+            for kind, slot in self._slots.items():
+                if slot.access_token is None or slot.is_fresh(self.refresh_margin):
+                    continue
+                # Non-blocking: if a request thread is already refreshing, let it finish
+                if not slot.refresh_lock.acquire(blocking=False):
+                    continue
+                try:
+                    if not slot.is_fresh(self.refresh_margin):
+                        if not self._refresh(kind, interactive=False):
+                            # Back off instead of spinning on a failing endpoint
+                            self._stop.wait(timeout=30)
+                except Exception as e:
+                    log.error(f"Exception refreshing {kind} token: {str(e)}")
+                    self._stop.wait(timeout=30)
+                finally:
+                    slot.refresh_lock.release()
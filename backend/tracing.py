@@ -0,0 +1,287 @@
+"""
+Request Tracing
+
+Span trees showing where the time of one support request or webhook
+notification went (token, chat creation, message send, subscription...),
+so a slow /api/support can be broken down step by step.
+
+    @tracing.traced()
+    def provision_support_chat(request_id, ...):        # starts a trace
+        with tracing.span("support_directory"):          # child span
+            ...
+
+A traced function called with no trace in progress starts one; nested
+traced calls and spans become children of the current span. span() and
+add_span() only record inside a trace, so shared code (the Graph client)
+can call them unconditionally. Traces are tagged with the function's
+request_id argument or set_request_id(), which ties together the traces a
+request leaves on different threads (HTTP handler, intake worker,
+notification worker).
+
+The current span follows contextvars, so it carries over into asyncio
+tasks, asyncio.to_thread and coroutines handed to AsyncGraphClient.
+
+Finished traces are kept in memory (TRACE_BUFFER request IDs, most recent
+first out) for /api/admin/traces, and appended as JSON lines to TRACE_FILE
+if set, by a background thread so a slow disk never stalls a request.
+TRACING=off disables it.
+"""
+
+import atexit
+import contextlib
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class Span:
+    __slots__ = ('name', 'start', 'duration', 'attrs', 'error', 'children', '_started')
+
+    def __init__(self, name, attrs, duration=None):
+        self.name = name
+        self.attrs = attrs
+        self.error = None
+        self.children = []
+        self._started = time.perf_counter()
+        self.duration = duration
+        self.start = time.time() - (duration or 0)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._started
+
+    def to_dict(self):
+        span = {
+            'name': self.name,
+            'start': round(self.start, 6),
+            'ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+        }
+        if self.attrs:
+            span['attrs'] = self.attrs
+        if self.error:
+            span['error'] = self.error
+        if self.children:
+            span['children'] = [child.to_dict() for child in list(self.children)]
+        return span
+
+
+class Trace:
+    __slots__ = ('trace_id', 'request_id', 'root', 'thread')
+
+    def __init__(self, trace_id, request_id):
+        self.trace_id = trace_id
+        self.request_id = request_id
+        self.root = None
+        self.thread = threading.current_thread().name
+
+    def to_dict(self):
+        return {
+            'traceId': self.trace_id,
+            'requestId': self.request_id,
+            'thread': self.thread,
+            'root': self.root.to_dict(),
+        }
+
+
+# (Trace, Span) being recorded in this context
+_current = contextvars.ContextVar('tracing_current', default=None)
+
+
+class Tracer:
+    """Keeps finished traces by request ID and hands them to the file writer"""
+
+    def __init__(self, max_requests=1000, per_request=50, recent=1000):
+        self.enabled = True
+        self.max_requests = max_requests
+        self.per_request = per_request
+        # request_id -> deque of Trace, least recently finished first
+        self._by_request = OrderedDict()
+        self._recent = deque(maxlen=recent)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._prefix = f"{os.getpid():x}-"
+        self._file_queue = None
+        self.path = None
+        self.finished = 0
+        self.dropped = 0
+
+    def next_id(self):
+        return f"{self._prefix}{next(self._ids):x}"
+
+    def finish(self, trace):
+        with self._lock:
+            self.finished += 1
+            self._recent.append(trace)
+            if trace.request_id is not None:
+                traces = self._by_request.get(trace.request_id)
+                if traces is None:
+                    traces = self._by_request[trace.request_id] = deque(maxlen=self.per_request)
+                    while len(self._by_request) > self.max_requests:
+                        self._by_request.popitem(last=False)
+                else:
+                    self._by_request.move_to_end(trace.request_id)
+                traces.append(trace)
+        if self._file_queue is not None:
+            try:
+                self._file_queue.put_nowait(trace)
+            except queue.Full:
+                self.dropped += 1
+
+    def traces(self, request_id):
+        with self._lock:
+            traces = list(self._by_request.get(request_id, ()))
+        return [trace.to_dict() for trace in traces]
+
+    def recent(self, limit=20, min_ms=0):
+        """Most recent traces first, optionally only those slower than min_ms"""
+        threshold = min_ms / 1000
+        with self._lock:
+            traces = list(self._recent)
+        slow = [trace for trace in reversed(traces) if trace.root.duration >= threshold]
+        return [trace.to_dict() for trace in slow[:limit]]
+
+    def write_to(self, path, max_queue=10000):
+        """Also append finished traces to path, one JSON object per line"""
+        self.path = path
+        self._file_queue = queue.Queue(maxsize=max_queue)
+        writer = threading.Thread(target=self._write_loop, args=(path, self._file_queue),
+                                  name="trace-writer", daemon=True)
+        writer.start()
+        atexit.register(self._file_queue.put, None)
+
+    def _write_loop(self, path, file_queue):
+        with open(path, 'a') as output:
+            while True:
+                trace = file_queue.get()
+                if trace is None:
+                    break
+                output.write(json.dumps(trace.to_dict(), default=str) + "\n")
+                if file_queue.empty():
+                    output.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'requests': len(self._by_request),
+                'finished': self.finished,
+                'file': self.path,
+                'file_queued': self._file_queue.qsize() if self._file_queue is not None else None,
+                'dropped': self.dropped,
+            }
+
+
+TRACER = Tracer()
+
+
+@contextlib.contextmanager
+def trace(name, request_id=None, **attrs):
+    """Span that starts a new trace when none is in progress"""
+    if not TRACER.enabled:
+        yield None
+        return
+    current = _current.get()
+    if current is None:
+        active, parent = Trace(TRACER.next_id(), request_id), None
+    else:
+        active, parent = current
+        if active.request_id is None:
+            active.request_id = request_id
+    node = Span(name, attrs)
+    if parent is None:
+        active.root = node
+    else:
+        parent.children.append(node)
+    token = _current.set((active, node))
+    try:
+        yield node
+    except BaseException as e:
+        node.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        node.finish()
+        _current.reset(token)
+        if parent is None:
+            TRACER.finish(active)
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Child of the current span; records nothing outside a trace"""
+    if _current.get() is None:
+        yield None
+        return
+    with trace(name, **attrs) as node:
+        yield node
+
+
+def add_span(name, duration, **attrs):
+    """Record an already finished step (duration in seconds) under the current span"""
+    current = _current.get()
+    if current is not None:
+        current[1].children.append(Span(name, attrs, duration=duration))
+
+
+def set_request_id(request_id):
+    """Tag the trace in progress once its request ID is known"""
+    current = _current.get()
+    if current is not None:
+        current[0].request_id = request_id
+
+
+def traced(name=None, root=True):
+    """
+    Decorator recording each call as a span named after the function.
+    The function's request_id argument, if it has one, tags the trace.
+    With root=False it only records when called inside a trace.
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+        parameters = list(inspect.signature(func).parameters)
+        position = parameters.index('request_id') if 'request_id' in parameters else None
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not root and _current.get() is None:
+                return func(*args, **kwargs)
+            if position is not None and position < len(args):
+                request_id = args[position]
+            else:
+                request_id = kwargs.get('request_id')
+            with trace(span_name, request_id=request_id):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def configure_tracing(enabled=None, max_requests=None, path=None):
+    """Apply TRACING, TRACE_BUFFER and TRACE_FILE (or the given values)"""
+    if enabled is None:
+        enabled = os.getenv("TRACING", "on").lower() not in ("off", "0", "false")
+    TRACER.enabled = enabled
+    TRACER.max_requests = max_requests or int(os.getenv("TRACE_BUFFER", TRACER.max_requests))
+    path = path or os.getenv("TRACE_FILE")
+    if enabled and path and TRACER.path is None:
+        TRACER.write_to(path)
+    return TRACER
+
+
+def traces(request_id):
+    return TRACER.traces(request_id)
+
+
+def recent_traces(limit=20, min_ms=0):
+    return TRACER.recent(limit=limit, min_ms=min_ms)
+
+
+def tracing_stats():
+    return TRACER.stats()
@@ -0,0 +1,419 @@
+"""
+Bounded Worker Pool
+
+A small fixed-size pool of background threads fed from a bounded queue.
+Used to move slow Graph work off the HTTP request path. When the queue is
+full submit() refuses new work so callers can push back on the client
+instead of piling up unbounded threads.
+
+ShardedWorkerPool is the ordered variant: tasks submitted with the same key
+always run on the same worker, one after another, in submission order.
+
+PriorityWorkerPool runs the most urgent waiting task first and caps how much
+of the queue each priority class may take.
+
+After use_event_loop(run, concurrency), tasks that are coroutine functions
+run on that event loop instead (the Graph client's, in async mode): a
+worker only hands the coroutine over and moves on, so up to `concurrency`
+tasks can be waiting on Graph without each holding a thread. The queue,
+priorities and per-key ordering apply to them as to any other task.
+"""
+
+import asyncio
+import heapq
+import inspect
+import itertools
+import queue
+import threading
+import time
+import zlib
+from collections import deque
+
+from structured_log import get_logger
+
+
+log = get_logger(__name__)
+
+
+_LATENCY_WINDOW = 500
+
+
+class _QueueLatency:
+    """Rolling record of how long tasks waited before a worker picked them up"""
+
+    def __init__(self):
+        self._samples = deque(maxlen=_LATENCY_WINDOW)
+        self.max_seconds = 0.0
+
+    def record(self, waited):
+        self._samples.append(waited)
+        self.max_seconds = max(self.max_seconds, waited)
+
+    def summary(self):
+        ordered = sorted(self._samples)
+        if not ordered:
+            return {'avg_ms': None, 'p95_ms': None, 'max_ms': 0.0}
+        p95 = ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))]
+        return {
+            'avg_ms': round(sum(ordered) / len(ordered) * 1000, 1),
+            'p95_ms': round(p95 * 1000, 1),
+            'max_ms': round(self.max_seconds * 1000, 1),
+        }
+
+
+class WorkerPool:
+    """
+    Run submitted callables on a fixed number of daemon threads.
+    max_queue bounds how many tasks may wait for a free worker.
+    """
+
+    def __init__(self, name, workers=4, max_queue=100):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._in_progress = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._latency = _QueueLatency()
+        self._run_coroutine = None
+        self._slots = None
+        self.concurrency = None
+
+    def use_event_loop(self, run, concurrency):
+        """
+        Run coroutine-function tasks with run(coroutine), which schedules the
+        coroutine on an event loop and returns a concurrent.futures.Future.
+        At most `concurrency` of them are in progress at once; past that the
+        workers wait for one to finish, and the queue backs up as usual.
+        """
+        self._run_coroutine = run
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self.concurrency = concurrency
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs) for a worker.
+        Returns False without queueing if the pool is saturated.
+        """
+        self.start()
+        try:
+            self._queue.put_nowait((fn, args, kwargs, time.monotonic()))
+            return True
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+
+    def depth(self):
+        """Number of tasks waiting for a worker"""
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'concurrency': self.concurrency,
+                'max_queue': self.max_queue,
+                'queued': self.depth(),
+                'in_progress': self._in_progress,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'queue_latency': self._latency.summary(),
+            }
+
+    def _run(self):
+        self._work(self._queue)
+
+    def _work(self, work_queue):
+        while True:
+            fn, args, kwargs, queued_at = work_queue.get()
+            try:
+                self._execute(fn, args, kwargs, queued_at)
+            finally:
+                work_queue.task_done()
+
+    def _execute(self, fn, args, kwargs, queued_at, after=None):
+        """
+        Run one task. A coroutine task is only started: the Future it runs
+        under is returned, and the task starts once `after` (the previous
+        task's Future, if any) has finished.
+        """
+        if self._run_coroutine is not None and inspect.iscoroutinefunction(fn):
+            return self._start_coroutine(fn(*args, **kwargs), queued_at, after)
+        if after is not None:
+            # Keep order behind a coroutine task that's still running
+            _wait_for(after)
+        with self._lock:
+            self._in_progress += 1
+            self._latency.record(time.monotonic() - queued_at)
+        try:
+            fn(*args, **kwargs)
+            with self._lock:
+                self.completed += 1
+        except Exception as e:
+            log.exception(f"Exception in {self.name} worker: {str(e)}")
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self._in_progress -= 1
+            self._task_finished()
+        return None
+
+    def _start_coroutine(self, coroutine, queued_at, after):
+        self._slots.acquire()
+        with self._lock:
+            self._in_progress += 1
+            self._latency.record(time.monotonic() - queued_at)
+        future = self._run_coroutine(_after(after, coroutine) if after is not None else coroutine)
+        future.add_done_callback(self._coroutine_finished)
+        return future
+
+    def _coroutine_finished(self, future):
+        error = None if future.cancelled() else future.exception()
+        with self._lock:
+            self._in_progress -= 1
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+        self._slots.release()
+        if error is not None:
+            log.error(f"Exception in {self.name} task: {type(error).__name__}: {str(error)}")
+        self._task_finished()
+
+    def _task_finished(self):
+        """Called when any task has finished"""
+
+
+def _wait_for(future):
+    """Block until a task's Future is done, whatever its outcome (the pool logs failures)"""
+    try:
+        future.result()
+    except Exception:
+        pass
+
+
+async def _after(previous, coroutine):
+    """Run coroutine once the previous task's Future is done"""
+    try:
+        await asyncio.wrap_future(previous)
+    except Exception:
+        pass
+    return await coroutine
+
+
+class ShardedWorkerPool(WorkerPool):
+    """
+    Worker pool that preserves ordering per key.
+    Each worker owns its own queue and a key is always hashed to the same one,
+    so tasks for one key run sequentially while different keys run in parallel.
+    """
+
+    def __init__(self, name, workers=4, max_queue=100):
+        super().__init__(name, workers=workers, max_queue=max_queue)
+        per_shard = max(1, max_queue // workers)
+        self._shards = [queue.Queue(maxsize=per_shard) for _ in range(workers)]
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i, shard in enumerate(self._shards):
+                thread = threading.Thread(target=self._work, args=(shard,), name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self, shard):
+        # A shard's coroutine tasks are chained, so they keep their order
+        # without the shard's worker waiting on any of them
+        previous = None
+        while True:
+            fn, args, kwargs, queued_at = shard.get()
+            try:
+                if previous is not None and previous.done():
+                    previous = None
+                previous = self._execute(fn, args, kwargs, queued_at, after=previous) or previous
+            finally:
+                shard.task_done()
+
+    def _shard_for(self, key):
+        return self._shards[zlib.crc32(str(key).encode()) % len(self._shards)]
+
+    def submit_keyed(self, key, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs) behind any earlier tasks for the same key.
+        Returns False without queueing if that key's worker is saturated.
+        """
+        self.start()
+        try:
+            self._shard_for(key).put_nowait((fn, args, kwargs, time.monotonic()))
+            return True
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+
+    def submit(self, fn, *args, **kwargs):
+        return self.submit_keyed(id(fn), fn, *args, **kwargs)
+
+    def depth(self):
+        return sum(shard.qsize() for shard in self._shards)
+
+
+class PriorityWorkerPool(WorkerPool):
+    """
+    Worker pool that always runs the most urgent waiting task next.
+    Priorities are small integers, 0 being the most urgent; tasks of the same
+    priority run in submission order.
+
+    limits caps how many tasks of a priority may wait (max_queue for any
+    priority not listed), so less urgent work is shed first and can't fill
+    the queue that more urgent work needs.
+
+    Tasks may carry a key. While the queue moves, on_positions({key: position})
+    is called with the keys whose 1-based position changed, at most every
+    position_interval seconds.
+    """
+
+    def __init__(self, name, workers=4, max_queue=100, limits=None, default_priority=0,
+                 on_positions=None, position_interval=1.0):
+        super().__init__(name, workers=workers, max_queue=max_queue)
+        self.limits = limits or {}
+        self.default_priority = default_priority
+        self.on_positions = on_positions
+        self.position_interval = position_interval
+
+        # (priority, seq, key, fn, args, kwargs, queued_at)
+        self._heap = []
+        self._seq = itertools.count()
+        self._ready = threading.Condition(self._lock)
+        self._waiting = {}
+        self._rejected_by_priority = {}
+        # key -> (priority, seq) of its waiting task
+        self._keys = {}
+        self._reported = {}
+        self._reported_at = 0.0
+        self._finished = deque(maxlen=100)
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        return self.submit_prioritized(self.default_priority, None, fn, *args, **kwargs) is not None
+
+    def submit_prioritized(self, priority, key, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs) at the given priority.
+        Returns the task's 1-based queue position, or None without queueing
+        if the pool or the priority's share of it is full.
+        """
+        self.start()
+        with self._lock:
+            waiting = self._waiting.get(priority, 0)
+            if len(self._heap) >= self.max_queue or waiting >= self.limits.get(priority, self.max_queue):
+                self.rejected += 1
+                self._rejected_by_priority[priority] = self._rejected_by_priority.get(priority, 0) + 1
+                return None
+            seq = next(self._seq)
+            heapq.heappush(self._heap, (priority, seq, key, fn, args, kwargs, time.monotonic()))
+            self._waiting[priority] = waiting + 1
+            if key is not None:
+                self._keys[key] = (priority, seq)
+            self._ready.notify()
+            return self._position(priority, seq)
+
+    def _position(self, priority, seq):
+        """Caller holds the lock."""
+        return 1 + sum(1 for entry in self._heap if (entry[0], entry[1]) < (priority, seq))
+
+    def position(self, key):
+        """1-based queue position of key's waiting task, or None if it isn't waiting"""
+        with self._lock:
+            location = self._keys.get(key)
+            return self._position(*location) if location else None
+
+    def depth(self):
+        return len(self._heap)
+
+    def estimated_wait(self, position):
+        """Rough seconds until the task at `position` starts, from recent throughput; None if unknown"""
+        recent = time.monotonic() - 60
+        with self._lock:
+            finished = [finished_at for finished_at in self._finished if finished_at >= recent]
+        if len(finished) < 2 or finished[-1] == finished[0]:
+            return None
+        rate = (len(finished) - 1) / (finished[-1] - finished[0])
+        return position / rate
+
+    def _changed_positions(self, now):
+        """Caller holds the lock."""
+        if self.on_positions is None or now - self._reported_at < self.position_interval:
+            return None
+        self._reported_at = now
+        positions = {}
+        for index, entry in enumerate(sorted(self._heap, key=lambda entry: (entry[0], entry[1]))):
+            key = entry[2]
+            if key is not None:
+                positions[key] = index + 1
+        changed = {key: position for key, position in positions.items() if self._reported.get(key) != position}
+        self._reported = positions
+        return changed
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._heap:
+                    self._ready.wait()
+                priority, seq, key, fn, args, kwargs, queued_at = heapq.heappop(self._heap)
+                self._waiting[priority] -= 1
+                if key is not None and self._keys.get(key) == (priority, seq):
+                    del self._keys[key]
+                    self._reported.pop(key, None)
+                changed = self._changed_positions(time.monotonic())
+            if changed:
+                try:
+                    self.on_positions(changed)
+                except Exception as e:
+                    log.error(f"Exception reporting {self.name} queue positions: {str(e)}")
+            self._execute(fn, args, kwargs, queued_at)
+
+    def _task_finished(self):
+        with self._lock:
+            self._finished.append(time.monotonic())
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            priorities = sorted(set(self._waiting) | set(self._rejected_by_priority))
+            stats['by_priority'] = {
+                str(priority): {
+                    'queued': self._waiting.get(priority, 0),
+                    'limit': self.limits.get(priority, self.max_queue),
+                    'rejected': self._rejected_by_priority.get(priority, 0),
+                }
+                for priority in priorities
+            }
+        wait = self.estimated_wait(max(1, self.depth()))
+        stats['estimated_wait_s'] = round(wait, 1) if wait is not None else None
+        return stats
@@ -16,8 +16,17 @@ function App() {
   const [requestId, setRequestId] = useState(null);
   const [isConnected, setIsConnected] = useState(false);
   const [isLoading, setIsLoading] = useState(false);
+  // Position of our new request in the backend's intake queue, while it waits
+  const [queuePosition, setQueuePosition] = useState(null);
   const socketRef = useRef(null);
   const messagesEndRef = useRef(null);
+  // Reused by every attempt to submit the same support request, so double
+  // clicks and retries don't open a second Teams chat
+  const supportRequestKeyRef = useRef(null);
+  // Sequence numbers of the conversation events we've applied, so a
+  // reconnect only asks the backend for the ones we missed
+  const lastSeqRef = useRef(0);
+  const seenSeqsRef = useRef(new Set());
 
   // Add these state variables
   const [chatbotActive, setChatbotActive] = useState(true);
@@ -334,7 +343,9 @@ function App() {
             },
             body: JSON.stringify({
               requestId,
-              message: newMessage
+              message: newMessage,
+              // Lets us match the delivery result that arrives over the socket
+              clientMessageId: `${Date.now()}-${Math.random().toString(36).slice(2, 10)}`
             })
           });
           
@@ -381,11 +392,16 @@ function App() {
             ? chatHistory.map(msg => `${msg.sender}: ${msg.text}`).join('\n')
             : '';
           
+          if (!supportRequestKeyRef.current) {
+            supportRequestKeyRef.current = `${Date.now()}-${Math.random().toString(36).slice(2, 12)}`;
+          }
+          
           // Send support request to backend
           const response = await fetch(`${API_URL}/api/support`, {
             method: 'POST',
             headers: {
-              'Content-Type': 'application/json'
+              'Content-Type': 'application/json',
+              'Idempotency-Key': supportRequestKeyRef.current
             },
             body: JSON.stringify({
               message: newMessage,
@@ -400,13 +416,19 @@ function App() {
           console.log("New request response data:", data);
           
           if (data.success) {
-            // Store request ID
+            // The next support request is a new one
+            supportRequestKeyRef.current = null;
+            
+            // Store request ID; its events are numbered from scratch
+            lastSeqRef.current = 0;
+            seenSeqsRef.current = new Set();
             setRequestId(data.requestId);
+            setQueuePosition(data.queuePosition > 1 ? data.queuePosition : null);
             sessionStorage.setItem('currentRequestId', data.requestId);
             
             // Register for WebSocket updates with this request ID
             if (socketRef.current && socketRef.current.connected) {
-              socketRef.current.emit('register', { requestId: data.requestId });
+              socketRef.current.emit('register', { requestId: data.requestId, lastSeq: lastSeqRef.current });
             }
             
             // Add system message
@@ -426,7 +448,8 @@ function App() {
               ...prevMessages,
               {
                 sender: 'System',
-                text: `Error: ${data.message || 'Failed to submit support request'}`,
+                text: `Error: ${data.message || 'Failed to submit support request'}`
+                  + (data.retryAfter ? ` (try again in ${data.retryAfter} seconds)` : ''),
                 timestamp: new Date().toISOString(),
                 isUser: false,
                 isSystem: true,
@@ -481,17 +504,19 @@ function App() {
 
   // Initialize WebSocket connection
   useEffect(() => {
-    // Create socket connection
-    socketRef.current = io(SOCKET_URL);
+    // Create socket connection. Websocket only, so that every request of a
+    // session stays on one backend worker when running several of them.
+    socketRef.current = io(SOCKET_URL, { transports: ['websocket'] });
     
     // Set up event listeners
     socketRef.current.on('connect', () => {
       console.log('Connected to WebSocket server');
       setIsConnected(true);
       
-      // Register for existing request if available
+      // Register for existing request if available, and get whatever
+      // was sent to it while we were disconnected
       if (requestId) {
-        socketRef.current.emit('register', { requestId });
+        socketRef.current.emit('register', { requestId, lastSeq: lastSeqRef.current });
       }
     });
     
@@ -500,12 +525,28 @@ function App() {
       setIsConnected(false);
     });
     
-    socketRef.current.on('support_response', (data) => {
+    // False for an event we've already applied (seen live and in a replay)
+    const acceptSeq = (data) => {
+      if (data.seq === undefined) {
+        return true;
+      }
+      if (seenSeqsRef.current.has(data.seq)) {
+        return false;
+      }
+      seenSeqsRef.current.add(data.seq);
+      lastSeqRef.current = Math.max(lastSeqRef.current, data.seq);
+      return true;
+    };
+
+    const handleSupportResponse = (data) => {
       console.log('Received support response:', data);
       
       // Only process the message if it matches our current requestId
       // This prevents responses from previous conversations appearing in a new one
       if (data.requestId === requestId) {
+        if (!acceptSeq(data)) {
+          return;
+        }
         // Add response to messages
         setMessages(prevMessages => [
           ...prevMessages,
@@ -522,8 +563,108 @@ function App() {
       } else {
         console.log('Ignoring message from different request ID:', data.requestId);
       }
-    });
+    };
     
+    // Where our request is in line while the backend is busy
+    socketRef.current.on('support_queue', (data) => {
+      if (data.requestId === requestId) {
+        setQueuePosition(data.position);
+      }
+    });
+
+    // Progress of the Teams chat being set up for this request
+    const handleSupportStatus = (data) => {
+      console.log('Received support status:', data);
+
+      if (data.requestId !== requestId || !acceptSeq(data)) {
+        return;
+      }
+
+      // A worker has picked the request up
+      setQueuePosition(null);
+
+      if (data.status === 'agent_notified') {
+        setMessages(prevMessages => [
+          ...prevMessages,
+          {
+            sender: 'System',
+            text: 'A support agent has been notified of your request.',
+            timestamp: new Date().toISOString(),
+            isUser: false,
+            isSystem: true
+          }
+        ]);
+      }
+    };
+
+    // Follow-up messages are delivered to Teams in the background
+    const handleMessageDelivery = (data) => {
+      console.log('Received message delivery result:', data);
+
+      if (data.requestId !== requestId || !acceptSeq(data)) {
+        return;
+      }
+
+      if (data.status === 'failed') {
+        setMessages(prevMessages => [
+          ...prevMessages,
+          {
+            sender: 'System',
+            text: 'Error: Your last message could not be delivered to the support team',
+            timestamp: new Date().toISOString(),
+            isUser: false,
+            isSystem: true,
+            isError: true
+          }
+        ]);
+        setIsLoading(false);
+      }
+    };
+
+    socketRef.current.on('support_response', handleSupportResponse);
+    socketRef.current.on('support_status', handleSupportStatus);
+    socketRef.current.on('message_delivery', handleMessageDelivery);
+
+    // Events sent to our request while we were disconnected, oldest first
+    socketRef.current.on('support_replay', (data) => {
+      console.log('Received missed events:', data);
+
+      if (data.requestId !== requestId) {
+        return;
+      }
+
+      if (data.lastSeq < lastSeqRef.current) {
+        // The backend's log was reset, so its numbers start over
+        lastSeqRef.current = 0;
+        seenSeqsRef.current = new Set();
+      }
+
+      const handlers = {
+        support_response: handleSupportResponse,
+        support_status: handleSupportStatus,
+        message_delivery: handleMessageDelivery
+      };
+      data.events.forEach(({ event, data: eventData }) => {
+        const handler = handlers[event];
+        if (handler) {
+          handler(eventData);
+        }
+      });
+
+      if (!data.complete) {
+        setMessages(prevMessages => [
+          ...prevMessages,
+          {
+            sender: 'System',
+            text: 'Some earlier updates to this conversation could not be restored.',
+            timestamp: new Date().toISOString(),
+            isUser: false,
+            isSystem: true
+          }
+        ]);
+      }
+    });
+
     // Add event listener for user_message_echo
     socketRef.current.on('user_message_echo', (data) => {
       console.log('Received user message echo:', data);
@@ -580,7 +721,10 @@ function App() {
     cleanupConversation();
     
     // Clear current state
+    lastSeqRef.current = 0;
+    seenSeqsRef.current = new Set();
     setRequestId(null);
+    setQueuePosition(null);
     setMessages([]);
     setChatHistory([]);
     setChatbotActive(true);
@@ -700,6 +844,12 @@ function App() {
             </>
           )}
           
+          {queuePosition > 1 && (
+            <div className="queue-position">
+              Support is busy: you are number {queuePosition} in line
+            </div>
+          )}
+          
           {isLoading && (
             <div className="loading-indicator">
               <div className="loading-dot"></div>